@@ -3,6 +3,9 @@ import os
 import osmium
 import time
 
+import modules.id_store as id_store
+import modules.runner as runner
+
 logger = logging.getLogger(__name__)
 
 
@@ -11,7 +14,7 @@ logger = logging.getLogger(__name__)
 class collect_admin_relation_ways(osmium.SimpleHandler):
     def __init__(self):
         super().__init__()
-        self.all_ways = {}
+        self.all_ways = id_store.id_multimap()
 
     def relation(self, r):
         admin_level = r.tags.get("admin_level")
@@ -32,13 +35,11 @@ class collect_admin_relation_ways(osmium.SimpleHandler):
         if int(admin_level) in [1, 2, 3, 4]:
             self.__add_members(r, int(admin_level))
 
-    # Add all member ways of relation r to dict all_ways with r's admin level
+    # Add all member ways of relation r to all_ways with r's admin level
     def __add_members(self, r, admin_level):
         for m in r.members:
             if m.type == "w":
-                if m.ref not in self.all_ways:
-                    self.all_ways[m.ref] = []
-                self.all_ways[m.ref].append(admin_level)
+                self.all_ways.add(m.ref, admin_level)
 
 
 # Pass ways in all_ways to the writer, but only for the lowest admin_level
@@ -67,14 +68,10 @@ class process_ways(osmium.SimpleHandler):
             self.way_id += 1
 
 
-def run(file_in, file_out):
+def run(file_in, file_out, tmp_dir):
     start_time = time.time()
 
-    if os.path.exists(file_out):
-        logging.info(f"    File {file_out} already exists.")
-        return
-
-    temp_file = "tmp/temp_admin_ways.pbf"
+    temp_file = os.path.join(tmp_dir, "temp_admin_ways.pbf")
 
     carw = collect_admin_relation_ways()
     try:
@@ -99,7 +96,7 @@ def run(file_in, file_out):
 
     # sort output file
     cmd = f"osmosis -q --rbf {temp_file} --s --wb {file_out} omitmetadata=true"
-    result = os.system(cmd)
+    result = runner.run(cmd)
     if result != 0:
         logger.error(f"osmosis failed with exit code {result}")
         return
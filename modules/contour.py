@@ -5,6 +5,8 @@ import sys
 import time
 
 import modules.functions as functions
+import modules.polygon as polygon
+import modules.runner as runner
 
 logger = logging.getLogger(__name__)
 
@@ -19,10 +21,12 @@ def coord_to_int(coord):
         return int(coord)
 
 
-# Get a set of hgt tile filenames which are relevant to cover the bounding
-# box of polygon. Limit this set to files which are present in hgt_dir.
-def get_hgt_tile_set(polygon, hgt_dir):
-    min_lat, min_lon, max_lat, max_lon = functions.min_max_lat_lon(polygon)
+# Get a set of hgt tile filenames which are relevant to cover the polygon of
+# poly_path: tiles within its bounding box that overlap the polygon.
+# Limit this set to files which are present in hgt_dir.
+def get_hgt_tile_set(poly_path, hgt_dir):
+    p = polygon.load(poly_path)
+    min_lat, min_lon, max_lat, max_lon = p.bbox()
 
     # adapt min/max values to hgt grid
     min_lat = coord_to_int(min_lat)
@@ -47,9 +51,10 @@ def get_hgt_tile_set(polygon, hgt_dir):
             y_segments.append("N" + str(y).zfill(2))
 
     poly_tile_set = set()
-    for y in y_segments:
-        for x in x_segments:
-            poly_tile_set.add(y + x + ".hgt")
+    for y, lat in zip(y_segments, range(min_lat, max_lat + 1)):
+        for x, lon in zip(x_segments, range(min_lon, max_lon + 1)):
+            if p.intersects(lat, lon, lat + 1, lon + 1):
+                poly_tile_set.add(y + x + ".hgt")
 
     hgt_tile_set = set()
     for subdir, dirs, files in os.walk(hgt_dir):
@@ -79,18 +84,14 @@ def create_bbox_area_polygon(polygon, filename):
         fp.writelines(poly_str)
 
 
-def run(map_, file_out):
+def run(map_, file_out, tmp_dir):
     start_time = time.time()
     polygon = "polygons/" + map_["name"] + ".poly"
 
     # only needed in case of custom hgt tiles
-    temp_poly = "tmp/temp_poly.poly"
-
-    if os.path.exists(file_out):
-        logging.info("    File %s already exists." % file_out)
-        return
+    temp_poly = os.path.join(tmp_dir, "temp_poly.poly")
 
-    prefix = "tmp/rc_" + map_["name"]
+    prefix = os.path.join(tmp_dir, "rc_" + map_["name"])
     hgt_dir = "tmp/hgt/"
     config = map_["contour"]
 
@@ -115,7 +116,7 @@ def run(map_, file_out):
         # *.hgt instead of specific files can be very slow. To speed up, pass a
         # specifict list of hgt files to pyhgtmap which is defined as the
         # intersecting set of the existing custom hgt files and the hgt files
-        # necessary to cover the map polygon's bounding box.
+        # necessary to cover the map polygon.
         hgt_tile_set = get_hgt_tile_set(polygon, custom_dir)
         if not hgt_tile_set:
             logger.error("Error: custom hgt tiles are missing.")
@@ -156,7 +157,7 @@ def run(map_, file_out):
 
     cmd += ">/dev/null 2>&1"
 
-    result = os.system(cmd)
+    result = runner.run(cmd)
     if result != 0:
         logger.error("pyhgtmap failed with exit code %s" % result)
         sys.exit()
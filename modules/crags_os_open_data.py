@@ -4,10 +4,11 @@ from osgeo import ogr
 import osmium
 import sys
 import time
-import zipfile
 
 import modules.esri_shp_to_osm as shp_to_osm
 import modules.functions as functions
+import modules.polygon as polygon
+import modules.runner as runner
 
 start_rel_id = -80000000000
 start_way_id = -80000000000
@@ -31,29 +32,18 @@ def EPSG_27700_to_WGS_84(file_in, file_out):
            "-t_srs " + t_srs + " -s_srs " + s_srs + " "
            + file_out + " " + file_in + " "
            ">/dev/null 2>&1")
+    # the exit code was never checked, a failed conversion doesn't stop the
+    # build
     try:
-        os.system(cmd)
+        runner.run(cmd, check=False)
     except Exception as e:
         logger.error("Error executing command: %s" % e)
         sys.exit()
 
-# check if two ranges overlap each other
-def ranges_overlap(a1, a2, b1, b2):
-    if a1 <= b1 <= a2:
-        return True
-    elif a1 <= b2 <= a2:
-        return True
-    elif b1 <= a1 <= b2:
-        return True
-    elif b1 <= a2 <= b2:
-        return True
-    else:
-        return False
-
-# check if shape file overlaps with polygon bounding box
-def shp_is_relevant_for_poly_bb(poly, f):
-    # polygon extent
-    p_min_y, p_min_x, p_max_y, p_max_x = functions.min_max_lat_lon(poly)
+# check if shape file overlaps with polygon bounding box or, with use_shape,
+# with the polygon itself
+def shp_is_relevant_for_poly_bb(poly, f, use_shape=False):
+    p = polygon.load(poly)
 
     # layer extent
     ogr.DontUseExceptions()
@@ -61,11 +51,9 @@ def shp_is_relevant_for_poly_bb(poly, f):
     layer = ds.GetLayer()
     f_min_x, f_max_x, f_min_y, f_max_y = layer.GetExtent()
 
-    if ranges_overlap(p_min_x, p_max_x, f_min_x, f_max_x):
-        if ranges_overlap(p_min_y, p_max_y, f_min_y, f_max_y):
-            return True
-
-    return False
+    if use_shape:
+        return p.intersects(f_min_y, f_min_x, f_max_y, f_max_x)
+    return p.bbox_intersects(f_min_y, f_min_x, f_max_y, f_max_x)
 
 # wrapper function to call shp to osm converson with continuous osm ids
 def convert_WGS84_shp_to_osm(file_set, file_out):
@@ -89,35 +77,13 @@ def convert_WGS84_shp_to_osm(file_set, file_out):
 
     writer.close()
 
-# Download source data and/or extract zip file if necessary. Delete
-# unnecessary data.
-# Convert all shp files to WGS84.
+# Convert all shp files to WGS84. The source data is downloaded and extracted
+# with the auxiliary sources (see functions.download_auxiliary_sources()).
 # Return one set with all files and one set with converted WGS84 files.
-def download_and_convert_source_data(folder):
-    src = ("https://api.os.uk/downloads/v1/products/VectorMapDistrict/"
-           "downloads?area=GB&format=ESRI%C2%AE+Shapefile&redirect")
-    target = folder + "vmdvec_essh_gb.zip"
+def convert_source_data(folder):
     if not os.path.exists(folder + "readme.txt"):
-        if not os.path.exists(target):
-            try:
-                functions.wget(src, target)
-            except Exception as e:
-                logger.error("Error downloading source data: %s" % e)
-                sys.exit()
-
-        # extract data
-        with zipfile.ZipFile(target, 'r') as zip_ref:
-            zip_ref.extractall(folder)
-
-        # Delete unnecessary data
-        for subdir, dirs, files in os.walk(folder + "data/"):
-            for f in files:
-                if f[-13:-3] != "_Ornament.":
-                    os.remove(os.path.join(subdir, f))
-
-        os.remove(target)
-    else:
-        logging.info("    Use existing crag source data files.")
+        logger.error("OS Open Data files not found in %s" % folder)
+        sys.exit()
 
     # Convert all shp files to WGS84, remember the converted files in a set
     file_set = set()
@@ -143,13 +109,9 @@ def download_and_convert_source_data(folder):
 
     return file_set, file_set_WGS84
 
-def run(folder, map_, file_out):
+def run(folder, map_, file_out, tmp_dir):
     start_time = time.time()
 
-    if os.path.exists(file_out):
-        logging.info("    File %s already exists." % file_out)
-        return
-
     use_polygon_shape = map_["use_polygon_shape"]
     polygon = "polygons/" + map_["name"] + ".poly"
 
@@ -160,7 +122,7 @@ def run(folder, map_, file_out):
             logger.error("Error creating directory %s: %s" % (folder, e))
             sys.exit()
 
-    file_set, file_set_WGS84 = download_and_convert_source_data(folder)
+    file_set, file_set_WGS84 = convert_source_data(folder)
 
     # Delete unnecessary EPSG_27700 shp/dbf/prj/shx files
     for f in file_set:
@@ -176,12 +138,12 @@ def run(folder, map_, file_out):
     # Get set of shp files that are relevant for the area of interest.
     file_set_target = set()
     for shp_file in file_set_WGS84:
-        if shp_is_relevant_for_poly_bb(polygon, shp_file):
+        if shp_is_relevant_for_poly_bb(polygon, shp_file, use_polygon_shape):
             file_set_target.add(shp_file)
 
     # pass list of relevant files to function that calls shp_to_osm with one
     # writer and continuous osm ids
-    temp_crag_data = "tmp/temp_crag_data.pbf"
+    temp_crag_data = os.path.join(tmp_dir, "temp_crag_data.pbf")
     convert_WGS84_shp_to_osm(file_set_target, temp_crag_data)
 
     # sort crags data and cut to area of interest
@@ -195,7 +157,7 @@ def run(folder, map_, file_out):
     cmd += ("clipIncompleteEntities=true "
             "--wb " + file_out + " omitmetadata=true")
     try:
-        os.system(cmd)
+        runner.run(cmd, check=False)
     except Exception as e:
         logger.error("Error executing command: %s" % e)
         sys.exit()
@@ -0,0 +1,779 @@
+import concurrent.futures
+import fcntl
+import hashlib
+import http.client
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# Environment variable with the base url of a mirror for all downloads, e.g.
+# http://localhost:8000/. https://host/path is then fetched from
+# <mirror>/host/path (see configure()).
+env_mirror = "OSM_MAP_GENERATOR_MIRROR"
+
+# Environment variable with the number of days after which downloaded
+# resources are revalidated with the server, a negative value disables
+# revalidation (see configure()).
+env_refresh = "OSM_MAP_GENERATOR_REFRESH_DAYS"
+default_refresh_days = 7
+
+# Downloads are stored here (atomically, see fetch_resource()) before they
+# are copied or extracted to their target location. Shared by all builds.
+cache_dir = "tmp/downloads/"
+
+# Index of the versions of all files installed from downloaded resources in
+# cache_dir (see record_versions()).
+versions_file = "versions.json"
+
+# Number of parallel downloads.
+default_jobs = 4
+
+timeout = 60
+max_redirects = 10
+max_retries = 3
+chunk_size = 1024 * 1024
+user_agent = "osm-map-generator"
+
+
+# A file to download. The file is copied to target or, if extract_to is set,
+# the zip archive is extracted to folder extract_to (only members for which
+# members(name) is True). The resource is present if marker (default: target)
+# exists.
+class resource:
+    def __init__(self, url, target=None, extract_to=None, marker=None,
+                 members=None, description=None):
+        self.url = url
+        self.target = target
+        self.extract_to = extract_to
+        self.marker = marker or target
+        self.members = members
+        self.description = description or os.path.basename(self.marker)
+
+    def is_present(self):
+        return os.path.exists(self.marker)
+
+    # Name of the file in the download cache.
+    def cache_name(self):
+        parts = urllib.parse.urlsplit(self.url)
+        name = (parts.netloc + parts.path).strip("/").replace("/", "_")
+        if parts.query:
+            name += "_" + hashlib.sha1(parts.query.encode()).hexdigest()[:8]
+        return name
+
+
+def configure(mirror=None, refresh_days=None):
+    if mirror:
+        os.environ[env_mirror] = mirror
+    if refresh_days is not None:
+        os.environ[env_refresh] = str(refresh_days)
+
+
+# Time in seconds after which present resources are revalidated, None if
+# they are never revalidated.
+def refresh_interval():
+    try:
+        days = float(os.environ.get(env_refresh, default_refresh_days))
+    except ValueError:
+        days = default_refresh_days
+    if days < 0:
+        return None
+    return days * 86400
+
+
+# Return url rewritten to the mirror, if one is configured.
+def mirror_url(url):
+    mirror = os.environ.get(env_mirror)
+    if not mirror:
+        return url
+    parts = urllib.parse.urlsplit(url)
+    path = parts.netloc + parts.path
+    if parts.query:
+        path += "?" + parts.query
+    return mirror.rstrip("/") + "/" + path
+
+
+# Connections are kept open per thread and host, so several files from the
+# same host are downloaded over one connection.
+connections = threading.local()
+
+
+def get_connection(scheme, netloc):
+    if not hasattr(connections, "pool"):
+        connections.pool = {}
+    key = (scheme, netloc)
+    if key not in connections.pool:
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=timeout)
+        connections.pool[key] = conn
+    return connections.pool[key]
+
+
+def close_connection(scheme, netloc):
+    pool = getattr(connections, "pool", {})
+    conn = pool.pop((scheme, netloc), None)
+    if conn is not None:
+        conn.close()
+
+
+# Send a request for url and follow redirects. Return the response, the
+# (scheme, netloc) of its connection and the final url. headers are sent to
+# all locations.
+def request(url, headers, method="GET"):
+    for i in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        conn = get_connection(parts.scheme, parts.netloc)
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # the server may have closed a reused connection
+            close_connection(parts.scheme, parts.netloc)
+            conn = get_connection(parts.scheme, parts.netloc)
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader("Location")
+            response.read()
+            if response.will_close:
+                close_connection(parts.scheme, parts.netloc)
+            if not location:
+                raise Exception("Redirect without location for %s" % url)
+            url = urllib.parse.urljoin(url, location)
+            continue
+
+        return response, (parts.scheme, parts.netloc), url
+
+    raise Exception("Too many redirects for %s" % url)
+
+
+# Return the validators (ETag, Last-Modified) of a response.
+def validators(response):
+    return {"etag": response.getheader("ETag"),
+            "last_modified": response.getheader("Last-Modified")}
+
+
+# Download url to path. Data is appended to an existing partial file path
+# with a range request, if the server supports it. Return the number of bytes
+# received and the validators of the remote file. The number of bytes is None
+# if a conditional request (If-None-Match / If-Modified-Since in headers)
+# found the file unchanged. If tee is given, all received data is written to
+# tee as well.
+def download(url, path, headers=None, tee=None):
+    request_headers = headers
+    headers = dict(headers or {})
+    headers["User-Agent"] = user_agent
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    if offset:
+        headers["Range"] = "bytes=%d-" % offset
+
+    response, conn_key, url = request(url, headers)
+    complete = False
+    try:
+        if response.status == 416 and offset:
+            # the partial file is invalid (e.g. the remote file changed)
+            response.read()
+            complete = True
+            if tee is not None:
+                raise Exception("Can't resume streamed download of %s, the "
+                                "partial file doesn't match the remote file"
+                                % url)
+            os.remove(path)
+            return download(url, path, request_headers)
+        if response.status == 304:
+            response.read()
+            complete = True
+            return None, validators(response)
+        if response.status == 200:
+            if offset and tee is not None:
+                raise Exception("Can't resume streamed download of %s, the "
+                                "server doesn't support range requests" % url)
+            mode = "wb"
+            offset = 0
+        elif response.status == 206:
+            content_range = response.getheader("Content-Range", "")
+            start = content_range.split()[-1].split("-")[0]
+            if not start.isdigit() or int(start) != offset:
+                raise Exception("Unexpected content range %s for %s"
+                                % (content_range, url))
+            mode = "ab"
+        else:
+            response.read()
+            complete = True
+            raise Exception("HTTP error %d %s for %s"
+                            % (response.status, response.reason, url))
+
+        length = response.getheader("Content-Length")
+        received = 0
+        with open(path, mode) as f:
+            for chunk in iter(lambda: response.read(chunk_size), b""):
+                f.write(chunk)
+                if tee is not None:
+                    tee.write(chunk)
+                received += len(chunk)
+
+        if length is not None and received != int(length):
+            raise http.client.IncompleteRead(b"", int(length) - received)
+        complete = True
+        return received, validators(response)
+    finally:
+        # the connection can only be reused after a complete response
+        if response.will_close or not complete:
+            close_connection(*conn_key)
+
+
+# Lock for a cache file, so parallel builds don't download the same file at
+# the same time.
+class cache_lock:
+    def __init__(self, path):
+        self.path = path + ".lock"
+
+    def __enter__(self):
+        self.f = open(self.path, "w")
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+# Extract the zip archive to folder. Members are extracted to a temporary
+# folder first and then moved in place, the member containing marker last.
+# Return the extracted files.
+def extract(archive, folder, marker, members=None):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    temp = tempfile.mkdtemp(prefix=".part_", dir=folder)
+    try:
+        with zipfile.ZipFile(archive, "r") as zip_ref:
+            names = [n for n in zip_ref.namelist()
+                     if members is None or members(n)]
+            zip_ref.extractall(temp, names)
+
+        files = []
+        for subdir, dirs, filenames in os.walk(temp):
+            for f in filenames:
+                rel = os.path.relpath(os.path.join(subdir, f), temp)
+                files.append(os.path.join(folder, rel))
+
+        rel_marker = os.path.relpath(marker, folder).split(os.sep)[0]
+        entries = sorted(os.listdir(temp), key=lambda e: e == rel_marker)
+        for e in entries:
+            dst = os.path.join(folder, e)
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+            elif os.path.exists(dst):
+                os.remove(dst)
+            os.replace(os.path.join(temp, e), dst)
+        return files
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+
+
+# Copy src to target, hard link if possible.
+def install(src, target):
+    folder = os.path.dirname(target)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    temp = target + ".part"
+    if os.path.exists(temp):
+        os.remove(temp)
+    try:
+        os.link(src, temp)
+    except OSError:
+        shutil.copy2(src, temp)
+    os.replace(temp, target)
+
+
+def load_meta(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_meta(path, meta):
+    temp = path + ".%d" % os.getpid()
+    with open(temp, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(temp, path)
+
+
+# Whether a resource checked at time meta["checked"] needs to be revalidated.
+def is_due(meta):
+    interval = refresh_interval()
+    if interval is None:
+        return False
+    if meta is None:
+        return True
+    return time.time() - meta.get("checked", 0) >= interval
+
+
+# Headers for a conditional request, empty if meta has no validators.
+def conditional_headers(meta):
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+# Version of the remote file: ETag or Last-Modified, None if the server
+# sends neither.
+def remote_version(meta):
+    return meta.get("etag") or meta.get("last_modified")
+
+
+# Download a resource to the cache (resuming a partial download if one
+# exists) and copy or extract it to its target location. A present resource
+# is revalidated every refresh_interval() seconds with a conditional request
+# and only downloaded again if it changed on the server. ETag, Last-Modified
+# and the time of the last check are stored in a sidecar file next to the
+# cached file.
+def fetch_resource(r, folder=cache_dir):
+    path = os.path.join(folder, r.cache_name())
+    meta_path = path + ".json"
+    url = mirror_url(r.url)
+    with cache_lock(path):
+        meta = load_meta(meta_path)
+
+        # another build may have fetched the resource in the meantime
+        if r.is_present() and not is_due(meta):
+            logging.info("    %s already exists." % r.description)
+            return 0
+
+        start_time = time.time()
+        part = path + ".part"
+        present = r.is_present()
+        cached = os.path.exists(path) and meta is not None
+        received = 0
+        if present and not conditional_headers(meta):
+            # resource of an earlier version without validators: take the
+            # local copy as current
+            response, conn_key, _ = request(url, {"User-Agent": user_agent},
+                                            "HEAD")
+            response.read()
+            if response.will_close:
+                close_connection(*conn_key)
+            save_meta(meta_path, dict(validators(response), url=r.url,
+                                      checked=time.time()))
+            logging.info("    %s already exists." % r.description)
+            return 0
+
+        if present or (cached and is_due(meta)):
+            if os.path.exists(part):
+                os.remove(part)
+            received, remote = download(url, part, conditional_headers(meta))
+            if received is None:
+                meta["checked"] = time.time()
+                save_meta(meta_path, meta)
+                if present:
+                    logging.info("    %s is up to date." % r.description)
+                    return 0
+                received = 0
+                remote = meta
+            else:
+                logging.info("    %s changed on the server." % r.description)
+                os.replace(part, path)
+        elif cached:
+            remote = meta
+        else:
+            for attempt in range(max_retries):
+                try:
+                    received, remote = download(url, part)
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    if attempt == max_retries - 1:
+                        raise
+                    logger.warning("Download of %s interrupted (%s), "
+                                   "resuming" % (url, e))
+            os.replace(part, path)
+
+        if r.extract_to is not None:
+            files = extract(path, r.extract_to, r.marker, r.members)
+            # archives are not needed after extraction
+            os.remove(path)
+        else:
+            install(path, r.target)
+            files = [r.target]
+
+        meta = dict(remote, url=r.url, checked=time.time())
+        save_meta(meta_path, meta)
+        record_versions(files, r, meta, folder)
+
+        logging.info("    %s: %s MB in %s seconds"
+                     % (r.description, round(received / 1024**2, 1),
+                        round(time.time() - start_time, 1)))
+        return received
+
+
+# Remember the remote version of all files installed from resource r, so
+# the stage cache can identify them without hashing (see file_version()).
+def record_versions(files, r, meta, folder=cache_dir):
+    version = remote_version(meta)
+    index_path = os.path.join(folder, versions_file)
+    with cache_lock(index_path):
+        index = load_meta(index_path) or {}
+        for f in files:
+            key = os.path.abspath(f)
+            if version is None:
+                index.pop(key, None)
+                continue
+            root = r.extract_to or os.path.dirname(r.target)
+            digest = hashlib.sha256("\n".join(
+                [r.url, version, os.path.relpath(f, root)]).encode())
+            st = os.stat(f)
+            index[key] = [st.st_size, st.st_mtime_ns, digest.hexdigest()]
+        save_meta(index_path, index)
+
+
+# Return a version id of a file installed from a downloaded resource, None if
+# the file is unknown or was modified after it was installed.
+def file_version(path, folder=cache_dir):
+    index = load_meta(os.path.join(folder, versions_file))
+    if not index:
+        return None
+    entry = index.get(os.path.abspath(path))
+    if entry is None:
+        return None
+    st = os.stat(path)
+    if entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+        return None
+    return entry[2]
+
+
+# Fetch all missing resources, up to jobs downloads at a time.
+def fetch(resources, jobs=default_jobs, folder=cache_dir):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    start_time = time.time()
+    errors = []
+    received = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(fetch_resource, r, folder): r
+                   for r in resources}
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                received += f.result()
+            except Exception as e:
+                logger.error("Download of %s failed: %s"
+                             % (futures[f].url, e))
+                errors.append(e)
+
+    if errors:
+        raise errors[0]
+
+    if received:
+        logging.info("    Downloaded %s MB in %s seconds"
+                     % (round(received / 1024**2, 1),
+                        round(time.time() - start_time, 1)))
+
+
+# Large files (osm source files) are downloaded with up to default_segments
+# parallel range requests of at least min_segment_size bytes each.
+default_segments = 8
+min_segment_size = 64 * 1024 * 1024
+
+# The state of a segmented download is saved every state_interval seconds.
+state_interval = 5
+
+
+# Return size of url (None if unknown) and whether the server supports range
+# requests.
+def remote_info(url):
+    response, conn_key, url = request(url, {"User-Agent": user_agent},
+                                      "HEAD")
+    response.read()
+    if response.will_close:
+        close_connection(*conn_key)
+    if response.status != 200:
+        return None, False
+
+    length = response.getheader("Content-Length")
+    ranges = response.getheader("Accept-Ranges", "").lower() == "bytes"
+    return int(length) if length is not None else None, ranges
+
+
+def remote_size(url):
+    try:
+        return remote_info(mirror_url(url))[0]
+    except (http.client.HTTPException, OSError, ValueError):
+        return None
+
+
+# Return the md5 checksum published as url + ".md5", None if there is none.
+def published_md5(url):
+    try:
+        response, conn_key, _ = request(url + ".md5",
+                                        {"User-Agent": user_agent})
+        data = response.read()
+        if response.will_close:
+            close_connection(*conn_key)
+    except (http.client.HTTPException, OSError):
+        return None
+    if response.status != 200:
+        return None
+
+    fields = data.decode(errors="replace").split()
+    if fields and re.fullmatch(r"[0-9a-fA-F]{32}", fields[0]):
+        return fields[0].lower()
+    return None
+
+
+def file_md5(path):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Download of url to file part with parallel range requests. The file is
+# allocated with its full size and each segment writes to its own range.
+# The bytes received per segment are saved in part + ".json", so an
+# interrupted download continues where each segment stopped.
+class segmented_download:
+    def __init__(self, url, part, size, segments):
+        self.url = url
+        self.part = part
+        self.size = size
+        self.state_file = part + ".json"
+        self.lock = threading.Lock()
+        self.saved = 0
+        self.logged = 0
+
+        self.segments = self.load()
+        if self.segments is None:
+            self.segments = self.split(segments)
+        else:
+            logging.info("    Resuming download at %s of %s MB"
+                         % (round(self.received() / 1024**2),
+                            round(size / 1024**2)))
+
+    # Return the saved segments if they belong to the same remote file.
+    def load(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if state.get("url") != self.url or state.get("size") != self.size:
+            return None
+        if not os.path.exists(self.part) or \
+                os.path.getsize(self.part) != self.size:
+            return None
+        return state["segments"]
+
+    # Split the file into segments [start, end, received bytes].
+    def split(self, segments):
+        n = max(1, min(segments, self.size // min_segment_size))
+        bounds = [self.size * i // n for i in range(n + 1)]
+        with open(self.part, "wb") as f:
+            f.truncate(self.size)
+        return [[bounds[i], bounds[i + 1], 0] for i in range(n)]
+
+    def received(self):
+        return sum(s[2] for s in self.segments)
+
+    def save(self, force=False):
+        with self.lock:
+            now = time.time()
+            if not force and now - self.saved < state_interval:
+                return
+            self.saved = now
+
+            temp = self.state_file + ".%d" % os.getpid()
+            with open(temp, "w") as f:
+                json.dump({"url": self.url, "size": self.size,
+                           "segments": self.segments}, f)
+            os.replace(temp, self.state_file)
+
+            # log progress in steps of 10%
+            percent = 100 * self.received() // self.size
+            if percent >= self.logged + 10 and percent < 100:
+                self.logged = percent - percent % 10
+                logging.info("    %d%% of %s MB" % (percent,
+                                                    round(self.size / 1024**2)))
+
+    def fetch_range(self, segment):
+        start, end, received = segment
+        if start + received >= end:
+            return
+
+        headers = {"User-Agent": user_agent,
+                   "Range": "bytes=%d-%d" % (start + received, end - 1)}
+        response, conn_key, _ = request(self.url, headers)
+        complete = False
+        try:
+            if response.status != 206:
+                raise Exception("HTTP status %d instead of a range for %s"
+                                % (response.status, self.url))
+
+            fd = os.open(self.part, os.O_WRONLY)
+            try:
+                for chunk in iter(lambda: response.read(chunk_size), b""):
+                    os.pwrite(fd, chunk, start + segment[2])
+                    segment[2] += len(chunk)
+                    self.save()
+            finally:
+                os.close(fd)
+
+            if start + segment[2] != end:
+                raise http.client.IncompleteRead(b"",
+                                                 end - start - segment[2])
+            complete = True
+        finally:
+            if response.will_close or not complete:
+                close_connection(*conn_key)
+
+    def fetch_segment(self, segment):
+        for attempt in range(max_retries):
+            try:
+                self.fetch_range(segment)
+                return
+            except (http.client.HTTPException, OSError) as e:
+                if attempt == max_retries - 1:
+                    raise
+                logger.warning("Download of %s interrupted (%s), resuming"
+                               % (self.url, e))
+
+    def run(self):
+        jobs = len(self.segments)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(self.fetch_segment, s)
+                       for s in self.segments]
+            try:
+                for f in futures:
+                    f.result()
+            finally:
+                self.save(force=True)
+
+    def remove_state(self):
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+
+# Check file part against the checksum published as url + ".md5". The file is
+# removed if the checksum doesn't match.
+def verify(url, part):
+    md5 = published_md5(url)
+    if md5 is None:
+        logger.warning("No checksum published for %s, download not "
+                       "verified" % url)
+    elif file_md5(part) != md5:
+        os.remove(part)
+        raise Exception("Checksum mismatch for %s" % url)
+    else:
+        logging.info("    Checksum verified.")
+
+
+# Download a large file from url to path, with parallel range requests if
+# the server supports them. Interrupted downloads are resumed. If a checksum
+# is published (url + ".md5"), the file is verified before it is moved to
+# path.
+def download_large(url, path, segments=default_segments):
+    start_time = time.time()
+    url = mirror_url(url)
+    part = path + ".part"
+    size, ranges = remote_info(url)
+
+    if size is not None and ranges:
+        d = segmented_download(url, part, size, segments)
+        d.run()
+    else:
+        logger.warning("Server doesn't support range requests for %s, "
+                       "using a single connection" % url)
+        # a partial file of a segmented download has gaps
+        state_file = part + ".json"
+        if os.path.exists(state_file):
+            os.remove(state_file)
+            if os.path.exists(part):
+                os.remove(part)
+        d = None
+        for attempt in range(max_retries):
+            try:
+                download(url, part)
+                break
+            except (http.client.HTTPException, OSError) as e:
+                if attempt == max_retries - 1:
+                    raise
+                logger.warning("Download of %s interrupted (%s), resuming"
+                               % (url, e))
+
+    try:
+        verify(url, part)
+    except Exception:
+        if d is not None:
+            d.remove_state()
+        raise
+
+    os.replace(part, path)
+    if d is not None:
+        d.remove_state()
+
+    seconds = time.time() - start_time
+    size = os.path.getsize(path) / 1024**2
+    logging.info("    %s MB in %s seconds (%s MB/s)"
+                 % (round(size), round(seconds, 1),
+                    round(size / seconds, 1) if seconds else 0))
+
+
+# Download url to path over a single connection and write the data to pipe
+# at the same time, e.g. to the stdin of an extraction tool, so download and
+# processing overlap. Like download_large(), the file is verified before it is
+# moved to path. A partial file is only resumed if it was streamed as well.
+def download_stream(url, path, pipe):
+    start_time = time.time()
+    url = mirror_url(url)
+    part = path + ".part"
+
+    # a partial file of a segmented download has gaps
+    if os.path.exists(part + ".json"):
+        os.remove(part + ".json")
+        if os.path.exists(part):
+            os.remove(part)
+
+    # resume: pass the data received so far to pipe first
+    if os.path.exists(part):
+        with open(part, "rb") as f:
+            shutil.copyfileobj(f, pipe, chunk_size)
+
+    for attempt in range(max_retries):
+        try:
+            download(url, part, tee=pipe)
+            break
+        except (http.client.HTTPException, OSError) as e:
+            if attempt == max_retries - 1 or isinstance(e, BrokenPipeError):
+                raise
+            logger.warning("Download of %s interrupted (%s), resuming"
+                           % (url, e))
+
+    verify(url, part)
+    os.replace(part, path)
+
+    seconds = time.time() - start_time
+    size = os.path.getsize(path) / 1024**2
+    logging.info("    %s MB in %s seconds (%s MB/s)"
+                 % (round(size), round(seconds, 1),
+                    round(size / seconds, 1) if seconds else 0))
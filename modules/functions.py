@@ -1,65 +1,64 @@
+import json
 import logging
 import os
-import subprocess
 import time
-import zipfile
+
+import osmium
+
+import modules.downloads as downloads
+import modules.governor as governor
+import modules.polygon as polygon
+import modules.replication as replication
+import modules.runner as runner
 
 logger = logging.getLogger(__name__)
 
+# mapwriter uses type=hd for input files larger than this size (in bytes)
+mapwriter_hd_size = 300000000
+
 
-# Determine a conservative number of threads to run in parallel
+# Number of threads for multi-threaded tools (mapwriter, pyhgtmap), based on
+# the usable and currently idle CPUs and the parallel stages and builds (see
+# governor.thread_count()).
 def get_thread_count():
-    logical_cpus = os.cpu_count()
-    if logical_cpus is None:
-        return 1
-    else:
-        return max(1, int(logical_cpus*0.4))
+    return governor.thread_count()
 
 
-# Returns all lon/lat coordinates from a poly file.
-def poly_to_lon_lat(poly_path):
-    try:
-        with open(poly_path) as f:
-            lon = []  # lon / x = East
-            lat = []  # lat / y = North
-            for line in f:
-                if line[0] == " ":
-                    data = line.strip()
-                    data = " ".join(data.split())
-                    data = data.split()
-                    data = list(map(float, data))
-                    lon.append(data[0])
-                    lat.append(data[1])
-            return lon, lat
-    except Exception as e:
-        logger.error(f"Error reading polygon file {poly_path}: {e}")
-        raise
+# Returns the lon/lat coordinates of each ring (outer rings and holes) of a
+# poly file: a list of (lon, lat) lists.
+def poly_to_rings(poly_path):
+    rings = []
+    for r in polygon.load(poly_path).rings:
+        rings.append(([p[0] for p in r], [p[1] for p in r]))
+    return rings
 
 
 # Return min_lat, min_lon and max_lat, max_lon coordinates from a
 # polygon file.
 def min_max_lat_lon(poly_path):
-    try:
-        lon, lat = poly_to_lon_lat(poly_path)
-        return min(lat), min(lon), max(lat), max(lon)
-    except Exception as e:
-        logger.error(f"Error calculating min/max lat/lon for {poly_path}: {e}")
-        raise
+    return polygon.load(poly_path).bbox()
 
 
-def wget(source, target):
-    try:
-        cmd = ["wget", "-q", "--show-progress", source, "-O", target]
-        subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
-    except subprocess.CalledProcessError as e:
-        logger.error(f"wget failed for {source}: {e}")
-        raise
-    except Exception as e:
-        logger.error(f"Unexpected error during wget for {source}: {e}")
-        raise
+# Temporary name for a file that is still being written. The extension is
+# kept, as osmconvert / osmosis determine the file format by it.
+def part_file(path):
+    base, ext = os.path.splitext(path)
+    return base + ".part" + ext
+
 
+# Writer for file_out. pbf files are written without metadata (like
+# osmconvert --drop-version), no stage uses version and author.
+def osm_writer(file_out):
+    if os.path.exists(file_out):
+        os.remove(file_out)
+    if file_out.endswith(".pbf"):
+        return osmium.SimpleWriter(osmium.io.File(file_out,
+                                                  "pbf,add_metadata=false"))
+    return osmium.SimpleWriter(file_out)
 
-def download_osm_source(map_, use_planet):
+
+# Return download url and local filename of the osm source file.
+def osm_source(map_, use_planet):
     if use_planet:
         src = ("https://ftp5.gwdg.de/pub/misc/openstreetmap/"
                "planet.openstreetmap.org/pbf/planet-latest.osm.pbf")
@@ -68,162 +67,177 @@ def download_osm_source(map_, use_planet):
         file_out = "tmp/" + map_["name"] + ".osm.pbf"
         src = map_["source"]
 
+    return src, file_out
+
+
+# Download the osm source file. With update, an existing source file is
+# brought up to date with replication diffs instead (see replication.py).
+def download_osm_source(map_, use_planet, update=False):
+    src, file_out = osm_source(map_, use_planet)
+
     try:
         if os.path.exists(file_out):
+            if update and replication.update(file_out, map_, use_planet):
+                return file_out
             logging.info("    File %s already exists." % file_out)
             return file_out
 
         if not os.path.isdir("tmp"):
             os.makedirs("tmp")
-        
-        wget(src, file_out)
+
+        downloads.download_large(src, file_out)
         return file_out
     except Exception as e:
         logger.error(f"Error in download_osm_source: {e}")
         raise
 
 
-def download_auxiliary_sources():
+# Margin (degrees) around the area of interest for pre_extract_osm_source().
+stream_margin = 0.2
 
-    themes_path = "themes"
-    if not os.path.isdir(themes_path):
-        try:
-            os.makedirs(themes_path)
-        except OSError as e:
-            logger.error(f"Failed to create directory {themes_path}: {e}")
-            raise
-
-    elevate = ("https://ftp.gwdg.de/pub/misc/openstreetmap/openandromaps/"
-               "themes/elevate/Elevate.zip")
-    elevate_target = themes_path + "/Elevate.zip"
-    elevate_xml = themes_path + "/Elevate/Elevate.xml"
-    try:
-        if not os.path.exists(elevate_xml):
-            wget(elevate, elevate_target)
-            with zipfile.ZipFile(elevate_target, 'r') as zip_ref:
-                zip_ref.extractall(themes_path + "/Elevate/")
-            os.remove(elevate_target)
-        else:
-            logging.info("    Map theme already exists.")
-    except Exception as e:
-        logger.error(f"Error downloading/extracting Elevate theme: {e}")
-        raise
-
-    tt_tm_path = "tt_tm"
-    if not os.path.isdir(tt_tm_path):
-        try:
-            os.makedirs(tt_tm_path)
-        except OSError as e:
-            logger.error(f"Failed to create directory {tt_tm_path}: {e}")
-            raise
-
-    tt = ("https://www.openandromaps.org/wp-content/snippets/makes/"
-          "tt_andromaps.xml")
-    tt_target = tt_tm_path + "/tt_andromaps.xml"
-    try:
-        if not os.path.exists(tt_target):
-            wget(tt, tt_target)
-        else:
-            logging.info("    Tag-transform file already exists.")
-    except Exception as e:
-        logger.error(f"Error downloading tag-transform file: {e}")
-        raise
-
-    tm_min = ("https://www.openandromaps.org/wp-content/snippets/makes/"
-              "tagmapping-min.xml")
-    tm_min_target = tt_tm_path + "/tagmapping-min.xml"
+# Download the osm source file and at the same time cut out the bounding box
+# of the area of interest plus stream_margin to file_out, so the download and
+# the first extraction pass overlap. osmconvert can't complete ways and
+# relations when reading from stdin, therefore this pre-extract only contains
+# the parts of ways and relations within the margin. extract_target_area() on
+# the pre-extract completes all objects that don't leave the margin.
+def pre_extract_osm_source(map_, use_planet, file_out):
     try:
-        if not os.path.exists(tm_min_target):
-            wget(tm_min, tm_min_target)
+        start_time = time.time()
+        src, data_source = osm_source(map_, use_planet)
+        poly_file = "polygons/" + map_["name"] + ".poly"
+
+        min_lat, min_lon, max_lat, max_lon = min_max_lat_lon(poly_file)
+        box = [max(-180, min_lon - stream_margin),
+               max(-90, min_lat - stream_margin),
+               min(180, max_lon + stream_margin),
+               min(90, max_lat + stream_margin)]
+        temp = part_file(file_out)
+        cmd = ["osmconvert", "-",
+               "-b=" + ",".join(str(round(b, 7)) for b in box),
+               "-o=" + temp]
+
+        if os.path.exists(data_source):
+            logging.info("    File %s already exists." % data_source)
+            cmd[1] = data_source
+            result = runner.run(cmd)
         else:
-            logging.info("    Tag-mapping-min file already exists.")
-    except Exception as e:
-        logger.error(f"Error downloading tag-mapping-min file: {e}")
-        raise
+            if not os.path.isdir("tmp"):
+                os.makedirs("tmp")
+            result = runner.run(cmd, feed=lambda pipe: downloads.
+                                download_stream(src, data_source, pipe))
+        if result != 0:
+            logger.error(f"osmconvert failed with exit code {result}")
+            raise Exception("osmconvert command failed")
+        os.replace(temp, file_out)
 
-    tm_urban = ("https://www.openandromaps.org/wp-content/snippets/makes/"
-                "tagmapping-urban.xml")
-    tm_urban_target = tt_tm_path + "/tagmapping-urban.xml"
-    try:
-        if not os.path.exists(tm_urban_target):
-            wget(tm_urban, tm_urban_target)
-        else:
-            logging.info("    Tag-mapping-urban file already exists.")
+        logging.info("    %s seconds" % round((time.time() - start_time), 1))
     except Exception as e:
-        logger.error(f"Error downloading tag-mapping-urban file: {e}")
+        logger.error(f"Error in pre_extract_osm_source: {e}")
+        remove_files([part_file(file_out)])
         raise
 
-    pps_path = "popcat_peaks_saddles"
-    if not os.path.isdir(pps_path):
-        try:
-            os.makedirs(pps_path)
-        except OSError as e:
-            logger.error(f"Failed to create directory {pps_path}: {e}")
-            raise
 
-    ti = ("https://geo.dianacht.de/topo/"
-          "topographic_isolation_viefinderpanoramas.txt")
-    ti_target = pps_path + "/topographic_isolation_viefinderpanoramas.txt"
-    try:
-        if not os.path.exists(ti_target):
-            wget(ti, ti_target)
-        else:
-            logging.info("    Topographic isolation file already exists.")
-    except Exception as e:
-        logger.error(f"Error downloading topographic isolation file: {e}")
-        raise
+# Members of the OS Open Data VectorMap District archive needed for crags:
+# readme.txt and the *_Ornament shp/dbf/prj/shx files.
+def is_crag_file(name):
+    return not name.startswith("data/") or name[-13:-3] == "_Ornament."
+
+
+# Download all missing auxiliary sources of map target map_ (map theme,
+# tag-transform / tag-mapping files, peak/saddle/popcat data and, if needed,
+# land polygons and OS Open Data) in parallel.
+def download_auxiliary_sources(map_):
+    oam = "https://www.openandromaps.org/wp-content/snippets/makes/"
+    topo = "https://geo.dianacht.de/topo/"
+    pps_path = "popcat_peaks_saddles/"
+
+    resources = [
+        downloads.resource(
+            "https://ftp.gwdg.de/pub/misc/openstreetmap/openandromaps/"
+            "themes/elevate/Elevate.zip",
+            extract_to="themes/Elevate/",
+            marker="themes/Elevate/Elevate.xml",
+            description="Map theme"),
+        downloads.resource(oam + "tt_andromaps.xml",
+                           "tt_tm/tt_andromaps.xml",
+                           description="Tag-transform file"),
+        downloads.resource(oam + "tagmapping-min.xml",
+                           "tt_tm/tagmapping-min.xml",
+                           description="Tag-mapping-min file"),
+        downloads.resource(oam + "tagmapping-urban.xml",
+                           "tt_tm/tagmapping-urban.xml",
+                           description="Tag-mapping-urban file"),
+        downloads.resource(
+            topo + "topographic_isolation_viefinderpanoramas.txt",
+            pps_path + "topographic_isolation_viefinderpanoramas.txt",
+            description="Topographic isolation file"),
+        downloads.resource(
+            topo + "saddledirection_viefinderpanoramas.100.txt",
+            pps_path + "saddledirection_viefinderpanoramas.100.txt",
+            description="Saddle direction file"),
+        downloads.resource(
+            "https://ftp.gwdg.de/pub/misc/openstreetmap/openandromaps/world/"
+            "PopCatFile4OAM.csv",
+            pps_path + "PopCatFile4OAM.csv",
+            description="Popcat file"),
+    ]
+
+    if map_["has_sea"]:
+        resources.append(downloads.resource(
+            "https://osmdata.openstreetmap.de/download/"
+            "land-polygons-split-4326.zip",
+            extract_to="tmp/",
+            marker="tmp/land-polygons-split-4326/land_polygons.shp",
+            description="Land polygon file"))
+
+    if map_["has_crags"]:
+        resources.append(downloads.resource(
+            "https://api.os.uk/downloads/v1/products/VectorMapDistrict/"
+            "downloads?area=GB&format=ESRI%C2%AE+Shapefile&redirect",
+            extract_to="tmp/os_open_data/",
+            marker="tmp/os_open_data/readme.txt",
+            members=is_crag_file,
+            description="OS Open Data file"))
 
-    sd = ("https://geo.dianacht.de/topo/"
-          "saddledirection_viefinderpanoramas.100.txt")
-    sd_target = pps_path + "/saddledirection_viefinderpanoramas.100.txt"
     try:
-        if not os.path.exists(sd_target):
-            wget(sd, sd_target)
-        else:
-            logging.info("    Saddle direction file already exists.")
+        downloads.fetch(resources)
     except Exception as e:
-        logger.error(f"Error downloading saddle direction file: {e}")
+        logger.error(f"Error downloading auxiliary sources: {e}")
         raise
 
-    popcat = ("https://ftp.gwdg.de/pub/misc/openstreetmap/openandromaps/world/"
-              "PopCatFile4OAM.csv")
-    popcat_target = pps_path + "/PopCatFile4OAM.csv"
-    try:
-        if not os.path.exists(popcat_target):
-            wget(popcat, popcat_target)
-        else:
-            logging.info("    Popcat file already exists.")
-    except Exception as e:
-        logger.error(f"Error downloading Popcat file: {e}")
-        raise
 
+# Extract the area of interest of map_ from file_in with osmconvert or, with
+# the map target option "extract_engine": "osmium", with osmium extract (see
+# extract_target_areas()).
+def extract_target_area(file_in, map_, file_out, tmp_dir):
+    if map_["extract_engine"] == "osmium":
+        extract_target_areas(file_in, [map_], [file_out], tmp_dir)
+        return
 
-def extract_target_area(file_in, map_, file_out):
     try:
         start_time = time.time()
-        polygon = "polygons/" + map_["name"] + ".poly"
-
-        if os.path.exists(file_out):
-            logging.info("    File %s already exists." % file_out)
-            return
+        poly_file = "polygons/" + map_["name"] + ".poly"
 
         # do not use "--drop-broken-refs" here, it causes problems (e.g. border
         # river in Uruguay)
         cmd = "osmconvert " + file_in + " "
         if map_["use_polygon_shape"]:
-            cmd += "-B=" + polygon + " "
+            # several rings and holes are combined with the even-odd rule
+            cmd += "-B=" + poly_file + " "
         else:
-            min_lat, min_lon, max_lat, max_lon = min_max_lat_lon(polygon)
+            min_lat, min_lon, max_lat, max_lon = min_max_lat_lon(poly_file)
             box = [min_lon, min_lat, max_lon, max_lat]
             cmd += "-b=" + ",".join(str(b) for b in box) + " "
         cmd += ("--complete-multipolygons "
                 "--complete-boundaries "
                 "--complete-ways "
-                "--hash-memory=4000 "
-                "--max-objects=600000000 "
+                "--hash-memory=" + str(governor.hash_memory()) + " "
+                "--max-objects=" + str(governor.max_objects(file_in)) + " "
+                "-t=" + os.path.join(tmp_dir, "osmconvert_tempfile") + " "
                 "-o="+file_out)
         
-        result = os.system(cmd)
+        result = runner.run(cmd)
         if result != 0:
             logger.error(f"osmconvert failed with exit code {result}")
             raise Exception("osmconvert command failed")
@@ -234,39 +248,58 @@ def extract_target_area(file_in, map_, file_out):
         raise
 
 
-def filter_data(file_in, map_, file_out):
+# Extract the areas of several map targets from file_in in one run of osmium
+# extract, so the source file is only read once for all targets. The smart
+# strategy with types multipolygon and boundary completes ways, multipolygons
+# and boundaries like osmconvert does in extract_target_area(). A single
+# target is extracted with its extract engine.
+def extract_target_areas(file_in, map_list, file_out_list, tmp_dir):
+    if len(map_list) == 1 and map_list[0]["extract_engine"] != "osmium":
+        extract_target_area(file_in, map_list[0], file_out_list[0], tmp_dir)
+        return
+
     try:
         start_time = time.time()
 
-        if os.path.exists(file_out):
-            logging.info("    File %s already exists." % file_out)
-            return
-
-        # filter data and us pipe for conversion to pbf format
-        cmd = ("osmfilter " + file_in + " "
-               "--parameter-file=osmfilter_parameters/tags_filter_data.txt |"
-               " osmconvert - --drop-version -o=" + file_out)
-        
-        result = os.system(cmd)
+        extracts = []
+        for map_, file_out in zip(map_list, file_out_list):
+            poly_file = "polygons/" + map_["name"] + ".poly"
+            extract = {"output": os.path.abspath(file_out)}
+            if map_["use_polygon_shape"]:
+                extract["polygon"] = {"file_name": os.path.abspath(poly_file),
+                                      "file_type": "poly"}
+            else:
+                min_lat, min_lon, max_lat, max_lon = min_max_lat_lon(poly_file)
+                extract["bbox"] = [min_lon, min_lat, max_lon, max_lat]
+            extracts.append(extract)
+
+        config = os.path.join(tmp_dir, "temp_extracts.json")
+        with open(config, "w") as f:
+            json.dump({"extracts": extracts}, f)
+
+        cmd = ("osmium extract "
+               "--config=" + config + " "
+               "--strategy=smart "
+               "--option=types=multipolygon,boundary "
+               "--overwrite "
+               "--no-progress " + file_in)
+        result = runner.run(cmd)
+        os.remove(config)
         if result != 0:
-            logger.error(f"osmfilter/osmconvert failed with exit code {result}")
-            raise Exception("osmfilter command failed")
+            logger.error(f"osmium extract failed with exit code {result}")
+            raise Exception("osmium extract command failed")
 
         logging.info("    %s seconds" % round((time.time() - start_time), 1))
     except Exception as e:
-        logger.error(f"Error in filter_data: {e}")
+        logger.error(f"Error in extract_target_areas: {e}")
         raise
 
 
-def merge_map_and_tt(file_list, file_out, silent):
+def merge_map_and_tt(file_list, file_out, silent,
+                     tt="tt_tm/tt_andromaps.xml"):
     try:
-        if os.path.exists(file_out):
-            logging.info("    File %s already exists." % file_out)
-            return
-
         start_time = time.time()
 
-        tt = "tt_tm/tt_andromaps.xml"
         cmd = "osmosis -q"
         for i in range(0, len(file_list)):
             if file_list[i][-3:] == "osm":
@@ -279,7 +312,7 @@ def merge_map_and_tt(file_list, file_out, silent):
         cmd += (" --tag-transform file=" + tt + " "
                 "--wb " + file_out + " omitmetadata=true")
         
-        result = os.system(cmd)
+        result = runner.run(cmd)
         if result != 0:
             logger.error(f"osmosis failed with exit code {result}")
             raise Exception("osmosis command failed")
@@ -291,33 +324,6 @@ def merge_map_and_tt(file_list, file_out, silent):
         raise
 
 
-def merge_map_osmconvert(file_list, file_subtract, file_out):
-    try:
-        if os.path.exists(file_out):
-            logging.info("    File %s already exists." % file_out)
-            return
-
-        start_time = time.time()
-
-        cmd = "osmconvert "
-        for i, f in enumerate(file_list):
-            if i > 0:
-                cmd += " | osmconvert - "
-            cmd += f
-        cmd += (" | osmconvert - --subtract " + file_subtract + " "
-                "--drop-version -o=" + file_out)
-        
-        result = os.system(cmd)
-        if result != 0:
-            logger.error(f"osmconvert failed with exit code {result}")
-            raise Exception("osmconvert command failed")
-        
-        logging.info("    %s seconds" % round((time.time() - start_time), 1))
-    except Exception as e:
-        logger.error(f"Error in merge_map_osmconvert: {e}")
-        raise
-
-
 def start_mapwriter(file_in, map_, file_out):
     try:
         bbox = min_max_lat_lon("polygons/" + map_["name"] + ".poly")
@@ -338,10 +344,11 @@ def start_mapwriter(file_in, map_, file_out):
                "threads=" + str(get_thread_count()) + " "
                "comment=\"https://github.com/marfrh/osm-map-generator\"")
 
-        if os.path.getsize(file_in) > 300000000:
+        if governor.mapwriter_type(os.path.getsize(file_in),
+                                   mapwriter_hd_size) == "hd":
             cmd += " type=hd"
         
-        result = os.system(cmd)
+        result = runner.run(cmd)
         if result != 0:
             logger.error(f"osmosis mapwriter failed with exit code {result}")
             raise Exception("osmosis mapwriter command failed")
@@ -0,0 +1,210 @@
+import logging
+import math
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Environment variables to pass the number of parallel osmosis stages,
+# parallel stages per build and parallel builds to the stage processes (see
+# configure()).
+env_jvm_jobs = "OSM_MAP_GENERATOR_JVM_JOBS"
+env_jobs = "OSM_MAP_GENERATOR_JOBS"
+env_builds = "OSM_MAP_GENERATOR_BUILDS"
+
+# Memory (MB) left for the operating system, page cache and python stage
+# processes.
+reserved_memory = 1024
+
+# Limits for osmconvert's hash memory (MB).
+min_hash_memory = 256
+max_hash_memory = 4000
+
+# Limits for osmconvert's object table, a pbf file needs at least ~2 bytes
+# per object.
+min_max_objects = 25000000
+max_max_objects = 600000000
+
+# Minimum osmosis heap size (MB).
+min_heap = 512
+
+# mapwriter type=ram needs a heap of roughly this multiple of the input size.
+mapwriter_ram_factor = 10
+
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+# Memory limit of the cgroup of the current process in MB, None if unlimited.
+def cgroup_memory_limit():
+    for path in ["/sys/fs/cgroup/memory.max",
+                 "/sys/fs/cgroup/memory/memory.limit_in_bytes"]:
+        value = read_file(path)
+        if value is not None and value.isdigit():
+            limit = int(value) / 1024**2
+            # cgroup v1 reports a huge number if there is no limit
+            if limit < 2**40:
+                return limit
+    return None
+
+
+def cgroup_memory_usage():
+    for path in ["/sys/fs/cgroup/memory.current",
+                 "/sys/fs/cgroup/memory/memory.usage_in_bytes"]:
+        value = read_file(path)
+        if value is not None and value.isdigit():
+            return int(value) / 1024**2
+    return 0
+
+
+def meminfo():
+    info = {}
+    content = read_file("/proc/meminfo") or ""
+    for line in content.splitlines():
+        key, value = line.split(":", 1)
+        info[key] = int(value.split()[0]) / 1024
+    return info
+
+
+# Total memory usable by the build in MB.
+def total_memory():
+    total = meminfo().get("MemTotal", 4096)
+    limit = cgroup_memory_limit()
+    if limit is not None:
+        total = min(total, limit)
+    return total
+
+
+# Memory that is currently available in MB.
+def available_memory():
+    info = meminfo()
+    available = info.get("MemAvailable", info.get("MemFree", 1024))
+    limit = cgroup_memory_limit()
+    if limit is not None:
+        available = min(available, limit - cgroup_memory_usage())
+    return max(0, available)
+
+
+# Number of CPUs the process may use (CPU affinity and cgroup CPU quota).
+def cpu_count():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = None
+    value = read_file("/sys/fs/cgroup/cpu.max")
+    if value is not None and not value.startswith("max"):
+        q, period = value.split()
+        quota = int(q) / int(period)
+    else:
+        q = read_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        period = read_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+        if q is not None and period is not None and int(q) > 0:
+            quota = int(q) / int(period)
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+
+    return max(1, cpus)
+
+
+# Default number of parallel stages (-j): a fraction of the CPUs, the rest
+# is left for the multi-threaded tools.
+def default_jobs():
+    return max(1, int(cpu_count() * 0.4))
+
+
+# Number of threads for a multi-threaded tool started now (mapwriter,
+# pyhgtmap): the CPUs that are not busy with other processes (runnable tasks
+# in /proc/loadavg, without the current process), minus one CPU for every
+# other stage of the build that may start in parallel, shared by the builds
+# that run in parallel. Within a build, these tools never run at the same
+# time (the mapwriter depends on the contour lines).
+def thread_count():
+    cpus = cpu_count()
+    busy = 0
+    value = read_file("/proc/loadavg")
+    if value is not None:
+        try:
+            busy = int(value.split()[3].split("/")[0]) - 1
+        except (IndexError, ValueError):
+            pass
+    idle = cpus - busy - (env_count(env_jobs) - 1)
+    return max(1, idle // env_count(env_builds))
+
+
+# Tell the stage processes how many osmosis stages may run at the same time
+# (jvm_jobs of all parallel builds together), how many stages a build runs
+# in parallel (jobs) and how many builds run in parallel.
+def configure(jvm_jobs, jobs=1, builds=1):
+    os.environ[env_jvm_jobs] = str(max(1, jvm_jobs))
+    os.environ[env_jobs] = str(max(1, jobs))
+    os.environ[env_builds] = str(max(1, builds))
+
+
+def env_count(name):
+    try:
+        return max(1, int(os.environ.get(name, "1")))
+    except ValueError:
+        return 1
+
+
+def parallel_jvms():
+    return env_count(env_jvm_jobs)
+
+
+# osmosis heap size in MB: a share of the total memory for each osmosis
+# stage that may run in parallel, but not more than currently available.
+def osmosis_heap():
+    share = (total_memory() - reserved_memory) / parallel_jvms()
+    available = available_memory() - reserved_memory
+    return int(max(min_heap, min(share, available)))
+
+
+# Environment for an osmosis invocation with a heap size set by the governor.
+# A -Xmx option in JAVACMD_OPTIONS takes precedence.
+def osmosis_env():
+    env = dict(os.environ)
+    options = env.get("JAVACMD_OPTIONS", "")
+    if "-Xmx" not in options:
+        heap = osmosis_heap()
+        options = re.sub(r"-Xms\S+", "", options)
+        env["JAVACMD_OPTIONS"] = ("-Xms%dM -Xmx%dM %s"
+                                  % (min(heap, 1024), heap, options)).strip()
+    return env
+
+
+# Heap size in MB of an osmosis process started with osmosis_env().
+def heap_size():
+    m = re.search(r"-Xmx(\d+)([gGmMkK]?)",
+                  osmosis_env().get("JAVACMD_OPTIONS", ""))
+    unit = {"g": 1024, "m": 1, "k": 1 / 1024, "": 1 / 1024**2}
+    return int(int(m.group(1)) * unit[m.group(2).lower()])
+
+
+# osmconvert --hash-memory in MB. With too little hash memory, osmconvert
+# silently writes incomplete ways and relations for large id ranges (europe,
+# planet), so the former fixed 4000 MB are used whenever the total memory
+# allows it, independent of the memory available at the moment.
+def hash_memory():
+    return int(max(min_hash_memory,
+                   min(max_hash_memory, total_memory() - reserved_memory)))
+
+
+# osmconvert --max-objects for input file file_in.
+def max_objects(file_in):
+    return int(max(min_max_objects,
+                   min(max_max_objects, os.path.getsize(file_in) // 2)))
+
+
+# mapwriter type: ram is faster, but needs a lot of heap space.
+def mapwriter_type(input_size, hd_size):
+    if input_size > hd_size or \
+            input_size / 1024**2 * mapwriter_ram_factor > heap_size():
+        return "hd"
+    return "ram"
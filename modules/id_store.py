@@ -0,0 +1,193 @@
+import array
+import bisect
+
+# Compact containers for osm ids collected by the pyosmium handlers. A python
+# int in a set or dict costs ~60-100 bytes, these containers store ids and
+# values in arrays (8 bytes per id and value). Ids are added in any order and
+# sorted in one go before the first lookup. Lookups are binary searches, a
+# bitmap of id blocks answers most lookups of ids that are not in the
+# container without a search.
+
+
+# Lookup of ids in the sorted array self.ids. The bitmap has a bit for every
+# block of 2^shift ids >= 0, shift is chosen so that the bitmap is not larger
+# than the id array.
+class sorted_ids:
+    def index(self, ids):
+        self.ids = ids
+        self.blocks = 0
+        self.shift = 0
+        self.bitmap = bytearray()
+        if ids and ids[-1] >= 0:
+            self.shift = (ids[-1] // (64 * len(ids))).bit_length()
+            self.blocks = (ids[-1] >> self.shift) + 1
+            self.bitmap = bytearray((self.blocks + 7) // 8)
+            for oid in ids:
+                if oid >= 0:
+                    b = oid >> self.shift
+                    self.bitmap[b >> 3] |= 1 << (b & 7)
+
+    # index range of oid in self.ids (empty if not found)
+    def find(self, oid):
+        if oid >= 0:
+            b = oid >> self.shift
+            if b >= self.blocks or not self.bitmap[b >> 3] >> (b & 7) & 1:
+                return 0, 0
+        ids = self.ids
+        i = bisect.bisect_left(ids, oid)
+        if i < len(ids) and ids[i] == oid:
+            return i, bisect.bisect_right(ids, oid, i)
+        return i, i
+
+
+# Set of osm ids.
+class id_set(sorted_ids):
+    def __init__(self, ids=()):
+        self.index(array.array("q"))
+        self.pending = array.array("q")
+        # adding an id only appends it to the pending ids
+        self.add = self.pending.append
+        self.update(ids)
+
+    # batched insert of an iterable of ids
+    def update(self, ids):
+        self.pending.extend(ids)
+
+    # sort all added ids, duplicates are removed
+    def freeze(self):
+        if self.pending:
+            ids = set(self.pending)
+            del self.pending[:]
+            ids.update(self.ids)
+            self.index(array.array("q", sorted(ids)))
+        return self
+
+    def __contains__(self, oid):
+        if self.pending:
+            self.freeze()
+        if oid >= 0:
+            b = oid >> self.shift
+            if b >= self.blocks or not self.bitmap[b >> 3] >> (b & 7) & 1:
+                return False
+        ids = self.ids
+        i = bisect.bisect_left(ids, oid)
+        return i < len(ids) and ids[i] == oid
+
+    def __len__(self):
+        return len(self.freeze().ids)
+
+    # ids in ascending order
+    def __iter__(self):
+        return iter(self.freeze().ids)
+
+    # ids of this set and other (id_set or iterable)
+    def union(self, other):
+        result = id_set(self)
+        result.update(other)
+        return result
+
+    # ids of this set not in other (id_set or sorted iterable)
+    def difference(self, other):
+        result = id_set()
+        other = iter(other)
+        o = next(other, None)
+        for oid in self:
+            while o is not None and o < oid:
+                o = next(other, None)
+            if o != oid:
+                result.add(oid)
+        return result
+
+
+# Map of osm ids to numbers (array typecode, e.g. "l"). An id can be added
+# several times, values() returns all values of an id in the order they were
+# added.
+class id_map(sorted_ids):
+    def __init__(self, typecode="q"):
+        self.typecode = typecode
+        self.index(array.array("q"))
+        self.data = array.array(typecode)
+        self.pending = array.array("q")
+        self.pending_data = array.array(typecode)
+
+    def add(self, oid, value):
+        self.pending.append(oid)
+        self.pending_data.append(value)
+
+    # sort all added ids together with the frozen ids (sorted() is stable,
+    # values of the same id stay in insertion order)
+    def freeze(self):
+        if self.pending:
+            ids = self.ids + self.pending
+            data = self.data + self.pending_data
+            self.pending = array.array("q")
+            self.pending_data = array.array(self.typecode)
+            order = sorted(range(len(ids)), key=ids.__getitem__)
+            self.data = array.array(self.typecode, [data[i] for i in order])
+            self.index(array.array("q", [ids[i] for i in order]))
+        return self
+
+    def __contains__(self, oid):
+        if self.pending:
+            self.freeze()
+        if oid >= 0:
+            b = oid >> self.shift
+            if b >= self.blocks or not self.bitmap[b >> 3] >> (b & 7) & 1:
+                return False
+        ids = self.ids
+        i = bisect.bisect_left(ids, oid)
+        return i < len(ids) and ids[i] == oid
+
+    # first value of oid
+    def __getitem__(self, oid):
+        if self.pending:
+            self.freeze()
+        i, j = self.find(oid)
+        if i == j:
+            raise KeyError(oid)
+        return self.data[i]
+
+    def get(self, oid, default=None):
+        if self.pending:
+            self.freeze()
+        i, j = self.find(oid)
+        return self.data[i] if i < j else default
+
+    def values(self, oid):
+        if self.pending:
+            self.freeze()
+        i, j = self.find(oid)
+        return self.data[i:j]
+
+    # number of (id, value) entries
+    def __len__(self):
+        return len(self.freeze().ids)
+
+
+# Map of osm ids to lists of python objects, e.g. the tags of all parent
+# relations of a way. Objects are stored once in a table and referenced by
+# index, adding the same object for all members of a relation only costs the
+# index. m[oid] returns the list of objects of oid in the order they were
+# added.
+class id_multimap(id_map):
+    def __init__(self):
+        id_map.__init__(self, "q")
+        self.table = []
+
+    def add(self, oid, value):
+        if not self.table or self.table[-1] is not value:
+            self.table.append(value)
+        self.pending.append(oid)
+        self.pending_data.append(len(self.table) - 1)
+
+    def __getitem__(self, oid):
+        values = self.values(oid)
+        if not values:
+            raise KeyError(oid)
+        return values
+
+    def get(self, oid, default=None):
+        return self.values(oid) or default
+
+    def values(self, oid):
+        return [self.table[i] for i in id_map.values(self, oid)]
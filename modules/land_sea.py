@@ -2,11 +2,11 @@ import glob
 import logging
 import os
 import time
-import zipfile
 
 import modules.esri_shp_to_osm as shp_to_osm
 import modules.land_sea_grid_split as land_grid_split
 import modules.functions as functions
+import modules.runner as runner
 
 logger = logging.getLogger(__name__)
 
@@ -33,15 +33,11 @@ def insert_min_max_lat_long(template_path, result_path, coords):
         raise
 
 
-def run(map_, file_out):
+def run(map_, file_out, tmp_dir):
     try:
         start_time = time.time()
         polygon = "polygons/" + map_["name"] + ".poly"
 
-        if os.path.exists(file_out):
-            logging.info("    File %s already exists." % file_out)
-            return
-
         min_lat, min_lon, max_lat, max_lon = functions.min_max_lat_lon(polygon)
 
         # prepare sea file
@@ -49,43 +45,35 @@ def run(map_, file_out):
         sea_margin = 0.00006
         coords = [min_lat+sea_margin, min_lon+sea_margin,
                   max_lat-sea_margin, max_lon-sea_margin]
-        output_sea = "tmp/temp_sea.osm"
+        output_sea = os.path.join(tmp_dir, "temp_sea.osm")
         insert_min_max_lat_long("templates/sea_template.osm", output_sea, coords)
 
-        # download and unzip split land polygons
-        land_poly = ("https://osmdata.openstreetmap.de/download/"
-                     "land-polygons-split-4326.zip")
-        land_poly_target = "tmp/land-polygons-split-4326.zip"
+        # split land polygons are downloaded with the auxiliary sources
         land_poly_shp = "tmp/land-polygons-split-4326/land_polygons.shp"
         if not os.path.exists(land_poly_shp):
-            functions.wget(land_poly, land_poly_target)
-            with zipfile.ZipFile(land_poly_target, 'r') as zip_ref:
-                zip_ref.extractall("tmp/")
-            os.remove(land_poly_target)
-        else:
-            logging.info("    Land polygon file already exists.")
+            raise Exception("Land polygon file %s not found" % land_poly_shp)
 
         # cut land polygons to area of interest
         # note ogr2ogr coordinate sequence: minLon minLat maxLon maxLat
-        output_land = "tmp/temp_land.shp"
+        output_land = os.path.join(tmp_dir, "temp_land.shp")
         cl = [min_lon, min_lat, max_lon, max_lat]
         clipsrc = " ".join(str(c) for c in cl)
         cmd = ("ogr2ogr -overwrite -skipfailures -clipsrc " + clipsrc + " "
                + output_land + " " + land_poly_shp + " "
                ">/dev/null 2>&1")
-        result = os.system(cmd)
+        result = runner.run(cmd)
         if result != 0:
             logger.error(f"ogr2ogr failed with exit code {result}")
             raise Exception("ogr2ogr command failed")
 
         # convert land shp to osm
-        temp_land = "tmp/temp_land.pbf"
+        temp_land = os.path.join(tmp_dir, "temp_land.pbf")
         if map_["use_land_grid_split"]:
             # Use self-invented grid split function to cut large land polygons into
             # smaller overlapping polygons. This can save a small amount of
             # rendering time for large maps (e.g. 15 minutes for whole Italy with
             # processing time of around 5 minutes).
-            temp_land_conv = "tmp/temp_land_conv.pbf"
+            temp_land_conv = os.path.join(tmp_dir, "temp_land_conv.pbf")
             shp_to_osm.run(output_land, temp_land_conv)
 
             # grid split
@@ -100,14 +88,14 @@ def run(map_, file_out):
         # merge land and sea, sort land file
         cmd = ("osmosis -q --rx " + output_sea + " --s --rbf " + temp_land + " "
                "--s --m --wb " + file_out + " omitmetadata=true")
-        result = os.system(cmd)
+        result = runner.run(cmd)
         if result != 0:
             logger.error(f"osmosis failed with exit code {result}")
             raise Exception("osmosis command failed")
 
         # remove temporary files
         os.remove(output_sea)
-        for d in glob.glob("tmp/temp_land."+"*"):
+        for d in glob.glob(os.path.join(tmp_dir, "temp_land.") + "*"):
             try:
                 os.remove(d)
             except OSError as e:
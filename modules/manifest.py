@@ -0,0 +1,67 @@
+import json
+import logging
+import os
+
+import modules.stage_cache as stage_cache
+
+logger = logging.getLogger(__name__)
+
+
+# List of the completed stages of a build, saved as json file after every
+# stage. A stage counts as completed if it is listed and its arguments and
+# the checksums of its input, config and output files are unchanged. When a
+# build is resumed, completed stages are skipped, so the build continues at
+# the first incomplete stage.
+class manifest:
+    def __init__(self, path, resume=False, memo_dir=None):
+        self.path = path
+        self.memo_dir = memo_dir
+        self.stages = {}
+
+        if resume and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.stages = json.load(f)["stages"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Ignoring invalid manifest %s: %s" % (path, e))
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def is_complete(self, s):
+        entry = self.stages.get(s.name)
+        if entry is None or not s.outputs:
+            return False
+
+        for f in s.inputs + s.outputs:
+            if not os.path.exists(f):
+                return False
+
+        return entry == self.stage_checksums(s)
+
+    # Checksums of all files the stage reads and writes and the stage
+    # arguments. Computed in the process that ran the stage.
+    def stage_checksums(self, s):
+        return {
+            "args": json.dumps(stage_cache.relevant_args(s), sort_keys=True,
+                               default=str),
+            "inputs": {f: stage_cache.fingerprint(f, self.memo_dir)
+                       for f in s.inputs},
+            "config": {f: stage_cache.fingerprint(f, self.memo_dir)
+                       for f in s.config if os.path.exists(f)},
+            "outputs": {f: stage_cache.fingerprint(f, self.memo_dir)
+                        for f in s.outputs},
+        }
+
+    def add(self, s, checksums):
+        self.stages[s.name] = checksums
+        self.save()
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        temp = self.path + ".%d" % os.getpid()
+        with open(temp, "w") as f:
+            json.dump({"stages": self.stages}, f, indent=2)
+        os.replace(temp, self.path)
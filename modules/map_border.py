@@ -1,5 +1,4 @@
 import logging
-import os
 import osmium
 import time
 
@@ -38,26 +37,33 @@ def create_map_border(map_, file_out):
     polygon = "polygons/" + map_["name"] + ".poly"
 
     with osmium.SimpleWriter(file_out) as writer:
-        # use polygon as map border
+        # use polygon as map border, one border for each ring (outer rings
+        # and holes)
         if map_["use_polygon_shape"]:
-            lon, lat = functions.poly_to_lon_lat(polygon)
+            rings = functions.poly_to_rings(polygon)
 
         # create rectangular box as map border
         else:
             min_lat, min_lon, max_lat, max_lon = functions.min_max_lat_lon(polygon)
             lon = [min_lon, max_lon, max_lon, min_lon]  # lon_x
             lat = [max_lat, max_lat, min_lat, min_lat]  # lat_y
-
-            # close map border - last node with same coordinates as first node
-            lon.append(lon[0])
-            lat.append(lat[0])
-
-        # build and write node list
-        node_id = -len(lon)
-        nodes = []
-        for i in range(len(lon)):
-            nodes.append(node_id)
-            node_id = write_node(writer, node_id, [lon[i], lat[i]])
+            rings = [(lon, lat)]
+
+        # close map border - last node with same coordinates as first node
+        for lon, lat in rings:
+            if (lon[0], lat[0]) != (lon[-1], lat[-1]):
+                lon.append(lon[0])
+                lat.append(lat[0])
+
+        # build and write node lists
+        node_id = -sum(len(lon) for lon, lat in rings)
+        node_lists = []
+        for lon, lat in rings:
+            nodes = []
+            for i in range(len(lon)):
+                nodes.append(node_id)
+                node_id = write_node(writer, node_id, [lon[i], lat[i]])
+            node_lists.append(nodes)
 
         # only tag value "(c)www.OpenAndroMaps.org" is included in tag-mapping.
         # change tag mapping to "%s" to use arbitrary strings
@@ -67,20 +73,17 @@ def create_map_border(map_, file_out):
         tag_list["contour_ext"] = "elevation_major"
 
         # write separate way for each poly segment to avoid cubic interpolation
-        i = 0
-        way_id = -len(nodes)
-        while (i < len(nodes)-1):
-            way_id = write_way(writer, way_id, nodes[i:i+2], tag_list)
-            i += 1
+        way_id = -sum(len(nodes) for nodes in node_lists)
+        for nodes in node_lists:
+            i = 0
+            while (i < len(nodes)-1):
+                way_id = write_way(writer, way_id, nodes[i:i+2], tag_list)
+                i += 1
 
 
 def run(map_, file_out):
     start_time = time.time()
 
-    if os.path.exists(file_out):
-        logging.info(f"    File {file_out} already exists.")
-        return
-
     try:
         create_map_border(map_, file_out)
     except Exception as e:
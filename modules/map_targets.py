@@ -32,6 +32,17 @@ contour1_custom = {
 default_map_dict = {
     "name": "",
     "source": "",
+    # replication server for --update, empty: from the source file header
+    "replication": "",
+    # tool to extract the area of interest: "osmconvert" or "osmium" (osmium
+    # extract, see README, Extraction engine)
+    "extract_engine": "osmconvert",
+    # tool for the selections of the filter stage: "osmfilter" or "pyosmium"
+    "filter_engine": "osmfilter",
+    # tool to merge and tag-transform the first set of data: "osmosis",
+    # "pyosmium" or "auto" (pyosmium once utilities/compare_tag_transform.py
+    # found the same tags as osmosis for the tag-transform file)
+    "tag_transform_engine": "auto",
     "has_sea": False,
     "use_land_grid_split": False,
     "has_crags": False,
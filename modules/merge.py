@@ -0,0 +1,119 @@
+import heapq
+import logging
+import os
+import time
+
+import osmium
+
+import modules.functions as functions
+import modules.runner as runner
+
+logger = logging.getLogger(__name__)
+
+# Order of object types in osm files
+type_order = {"n": 0, "w": 1, "r": 2}
+
+
+# (type, id) of the objects of the id list file_in (.txt, one object per line
+# like "w123", see reduce_data.write_ids). Objects to subtract come from the
+# source data, negative ids (generated objects like the map border) are never
+# subtracted.
+def read_id_list(file_in):
+    with open(file_in) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#") and line[1] != "-":
+                yield line[0], int(line[1:])
+
+
+# Objects of the osm files of file_list merged by type and id. All files are
+# read at the same time, the next object is the smallest (type, id) of the
+# current objects of all files. If several files contain an object with the
+# same type and id, only the object of the last file in file_list is returned
+# (osmconvert) or, with last_wins=False, the object of the first file
+# (osmosis --merge). Like both tools, the files are expected to be sorted by
+# type and id. An object is only valid until the next object is requested.
+def objects(file_list, last_wins=True):
+    if len(file_list) == 1:
+        yield from osmium.FileProcessor(file_list[0])
+        return
+
+    readers = [iter(osmium.FileProcessor(f)) for f in file_list]
+    current = [None] * len(readers)
+    heap = []
+
+    def advance(i):
+        o = next(readers[i], None)
+        current[i] = o
+        if o is not None:
+            heapq.heappush(heap, (type_order[o.type_str()], o.id, i))
+
+    for i in range(len(readers)):
+        advance(i)
+
+    while heap:
+        t, oid, i = heapq.heappop(heap)
+        # same object in later files (higher index)
+        while heap and heap[0][0] == t and heap[0][1] == oid:
+            j = heapq.heappop(heap)[2]
+            if last_wins:
+                advance(i)
+                i = j
+            else:
+                advance(j)
+        yield current[i]
+        advance(i)
+
+
+# Write the ids of the id list file_in (see read_id_list) as empty objects to
+# the osm file file_out, e.g. for osmconvert --subtract. Objects are written
+# sorted by type and id like osmconvert expects.
+def write_id_file(file_in, file_out):
+    ids = {t: [] for t in type_order}
+    for t, oid in read_id_list(file_in):
+        ids[t].append(oid)
+    with functions.osm_writer(file_out) as writer:
+        for oid in sorted(ids["n"]):
+            writer.add_node(osmium.osm.mutable.Node(id=oid, location=(0, 0)))
+        for oid in sorted(ids["w"]):
+            writer.add_way(osmium.osm.mutable.Way(id=oid, nodes=[]))
+        for oid in sorted(ids["r"]):
+            writer.add_relation(osmium.osm.mutable.Relation(id=oid,
+                                                            members=[]))
+
+
+# Merge the osm files of file_list into file_out with a chain of osmconvert
+# calls and drop all objects with an id in file_subtract:
+#   osmconvert f1 | osmconvert - f2 | ... | osmconvert - --subtract s
+# Objects with the same osm id are taken from the last file. osmconvert can't
+# read the id list, file_subtract is written to an osm file of empty objects
+# first (see write_id_file()).
+def run(file_list, file_subtract, file_out, tmp_dir):
+    try:
+        start_time = time.time()
+
+        if file_subtract.endswith(".txt"):
+            subtract_osm = os.path.join(tmp_dir, "temp_merge_subtract.pbf")
+            write_id_file(file_subtract, subtract_osm)
+        else:
+            subtract_osm = file_subtract
+
+        cmd = "osmconvert "
+        for i, f in enumerate(file_list):
+            if i > 0:
+                cmd += " | osmconvert - "
+            cmd += f
+        cmd += (" | osmconvert - --subtract " + subtract_osm + " "
+                "--drop-version -o=" + file_out)
+        result = runner.run(cmd)
+        if result != 0:
+            logger.error(f"osmconvert failed with exit code {result}")
+            raise Exception("osmconvert command failed")
+
+        if subtract_osm != file_subtract:
+            os.remove(subtract_osm)
+
+        logging.info("    %s seconds" % round((time.time() - start_time), 1))
+    except Exception as e:
+        logger.error(f"Error in run/merge.py: {e}")
+        raise
@@ -71,22 +71,11 @@ class process_peaks_saddles(osmium.SimpleHandler):
         return dist_group
 
 
+# file_in contains the peaks and saddles selected by peaks_saddles.txt (see
+# prefilter.py).
 def run(file_in, map_, file_out):
     start_time = time.time()
 
-    if os.path.exists(file_out):
-        logging.info("    File %s already exists." % file_out)
-        return
-
-    tmp_file = file_out[:-3] + "o5m"
-    cmd = ("osmfilter " + file_in + " "
-           "--parameter-file=osmfilter_parameters/peaks_saddles.txt "
-           "-o=" + tmp_file)
-    result = os.system(cmd)
-    if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
-        return
-
     ti = "popcat_peaks_saddles/topographic_isolation_viefinderpanoramas.txt"
     sd = "popcat_peaks_saddles/saddledirection_viefinderpanoramas.100.txt"
 
@@ -121,15 +110,10 @@ def run(file_in, map_, file_out):
     try:
         writer = osmium.SimpleWriter(file_out)
         peak_saddle_parser = process_peaks_saddles(writer, peak_data, saddle_data)
-        peak_saddle_parser.apply_file(tmp_file)
+        peak_saddle_parser.apply_file(file_in)
         writer.close()
     except Exception as e:
         logger.error("Error processing OSM data: %s" % str(e))
         return
 
-    try:
-        os.remove(tmp_file)
-    except Exception as e:
-        logging.warning("Warning removing temp file %s: %s" % (tmp_file, str(e)))
-
     logging.info("    %s seconds" % round((time.time() - start_time), 1))
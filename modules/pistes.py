@@ -3,7 +3,9 @@ import osmium
 import os
 import time
 
+import modules.id_store as id_store
 import modules.reduce_data as reduce_data
+import modules.runner as runner
 
 logger = logging.getLogger(__name__)
 
@@ -13,13 +15,13 @@ tag_set = {"route", "piste:type", "piste:grooming", "piste:oneway",
 
 # Collect tag information of piste relations and store this information for
 # all member ways
-# - all_rels: dict of all piste relation member ways, value is a list of dicts
-#             with piste tag information of all parent piste relations this way
-#             is a member of.
+# - way_rels: all piste relation member ways (id_store.id_multimap), value is
+#             a list of dicts with piste tag information of all parent piste
+#             relations this way is a member of.
 class Collect_Piste_Rels(osmium.SimpleHandler):
     def __init__(self):
         osmium.SimpleHandler.__init__(self)
-        self.way_rels = {}
+        self.way_rels = id_store.id_multimap()
 
     def relation(self, r):
         if r.tags.get("type") == "route" and r.tags.get("route") == "piste":
@@ -31,9 +33,7 @@ class Collect_Piste_Rels(osmium.SimpleHandler):
 
             for m in r.members:
                 if m.type == "w":
-                    if m.ref not in self.way_rels:
-                        self.way_rels[m.ref] = []
-                    self.way_rels[m.ref].append(tags)
+                    self.way_rels.add(m.ref, tags)
 
 
 # Process two types of ways:
@@ -94,17 +94,13 @@ class Process_Piste_Ways(osmium.SimpleHandler):
             self.way_id = self.way_id + 1
 
 
-def run(file_in, map_, file_out):
+def run(file_in, map_, file_out, tmp_dir):
     start_time = time.time()
 
-    if os.path.exists(file_out):
-        logging.info("    File %s already exists." % file_out)
-        return
-
     cpr = Collect_Piste_Rels()
     cpr.apply_file(file_in)
 
-    temp_file = "tmp/temp_pistes.pbf"
+    temp_file = os.path.join(tmp_dir, "temp_pistes.pbf")
 
     try:
         if os.path.exists(temp_file):
@@ -122,25 +118,25 @@ def run(file_in, map_, file_out):
         logger.error("Error processing pistes data: %s" % str(e))
         return
 
-    temp_file_sorted = "tmp/temp_pistes_sorted.pbf"
+    temp_file_sorted = os.path.join(tmp_dir, "temp_pistes_sorted.pbf")
     cmd = "osmosis -q --rbf " + temp_file + " --s --wb " + temp_file_sorted
-    result = os.system(cmd)
+    result = runner.run(cmd)
     if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
+        logger.error("runner.run() failed for command: %s" % cmd)
         return
 
     # check tag limit
-    temp_pistes_limit = "tmp/temp_pistes_tags_limited.pbf"
-    reduce_data.run(temp_file_sorted, "", temp_pistes_limit)
+    temp_pistes_limit = os.path.join(tmp_dir, "temp_pistes_tags_limited.pbf")
+    reduce_data.run(temp_file_sorted, "", temp_pistes_limit, tmp_dir)
 
     # merge original routes and routes with limited tags (last file has
     # highest priority for osmconvert"
     cmd = ("osmconvert " + temp_file_sorted + " "
            "| osmconvert - " + temp_pistes_limit + " "
            "--drop-version -o=" + file_out)
-    result = os.system(cmd)
+    result = runner.run(cmd)
     if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
+        logger.error("runner.run() failed for command: %s" % cmd)
         return
 
     try:
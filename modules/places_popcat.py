@@ -90,23 +90,11 @@ class process_nodes(osmium.SimpleHandler):
         return popcat
 
 
+# file_in contains the place nodes selected by popcat_nodes.txt (see
+# prefilter.py).
 def run(file_in, map_, file_out):
     start_time = time.time()
 
-    if os.path.exists(file_out):
-        logging.info("    File %s already exists." % file_out)
-        return
-
-    # filter places nodes
-    tmp_file = file_out[:-3] + "o5m"
-    cmd = ("osmfilter " + file_in + " "
-           "--parameter-file=osmfilter_parameters/popcat_nodes.txt "
-           "-o=" + tmp_file)
-    result = os.system(cmd)
-    if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
-        return
-
     # read popcat data an transpose and convert to list
     file_popcat = "popcat_peaks_saddles/PopCatFile4OAM.csv"
     try:
@@ -128,8 +116,7 @@ def run(file_in, map_, file_out):
     try:
         writer = osmium.SimpleWriter(file_out)
         pn = process_nodes(writer, popcat_data)
-        pn.apply_file(tmp_file)
-        os.remove(tmp_file)
+        pn.apply_file(file_in)
         writer.close()
     except Exception as e:
         logger.error("Error processing places data: %s" % str(e))
@@ -0,0 +1,498 @@
+import glob
+import json
+import logging
+import math
+import os
+import re
+import struct
+import zlib
+
+import modules.downloads as downloads
+import modules.functions as functions
+import modules.governor as governor
+import modules.polygon as polygon
+import modules.scheduler as scheduler
+
+logger = logging.getLogger(__name__)
+
+# Density of osm data (MB per km²) used if neither the source file nor
+# profiles of the map target are available.
+default_density = 0.01
+
+# Number of data blobs of the source file decoded to estimate the share of
+# nodes in the area of interest.
+sample_blobs = 32
+
+# Main parameter stage runtime, memory and output size depend on:
+# - data: size of the extracted area of interest (MB)
+# - area: area of the map polygon (km²)
+# - source: size of the osm source file (MB)
+# - none: constant
+stage_drivers = {
+    "source": "source",
+    "extract": "source",
+    "auxiliary": "none",
+    "map_border": "area",
+    "contour": "area",
+    "land_sea": "area",
+    "crags": "area",
+}
+
+# Rough default models [seconds, peak memory MB, output MB] per MB (or km²)
+# of the stage driver, used until build profiles are available.
+default_models = {
+    "source": [0.05, 50, 1.0],
+    "extract": [0.02, 4000, 0.0],
+    "auxiliary": [0, 50, 0],
+    "filter": [0.05, 100, 0.6],
+    "map_border": [0.00001, 100, 0.00001],
+    "admin": [0.1, 0, 0.02],
+    "poly_nodes": [0.2, 0, 0.02],
+    "peaks_saddles": [0.05, 200, 0.001],
+    "popcat": [0.05, 200, 0.001],
+    "pistes": [0.1, 0, 0.005],
+    "tag_transform": [0.6, 100, 0.6],
+    "routes": [0.3, 0, 0.05],
+    "contour": [0.002, 500, 0.002],
+    "land_sea": [0.0005, 0, 0.0005],
+    "crags": [0.0005, 0, 0.0001],
+    "reduce": [0.2, 0, 0.01],
+    "merge": [0.1, 100, 0.8],
+    "validate": [0.05, 200, 0],
+    "mapwriter": [1.5, 0, 0.3],
+}
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+# Iterate over (field number, value) of a protobuf message.
+def read_fields(buf):
+    pos = 0
+    while pos < len(buf):
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wire_type)
+        yield key >> 3, value
+
+
+def zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def read_packed_sint(buf):
+    values = []
+    pos = 0
+    while pos < len(buf):
+        n, pos = read_varint(buf, pos)
+        values.append(zigzag(n))
+    return values
+
+
+# Read the index of all blobs of a pbf file without decompressing them.
+# Returns a list of (blob type, offset of blob data, size of blob data).
+def read_blob_index(path):
+    index = []
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(4)
+            if len(data) < 4:
+                break
+            header = f.read(struct.unpack(">I", data)[0])
+            blob_type = ""
+            size = 0
+            for field, value in read_fields(header):
+                if field == 1:
+                    blob_type = value.decode()
+                elif field == 3:
+                    size = value
+            index.append((blob_type, f.tell(), size))
+            f.seek(size, os.SEEK_CUR)
+    return index
+
+
+def read_blob(f, offset, size):
+    f.seek(offset)
+    for field, value in read_fields(f.read(size)):
+        if field == 1:
+            return value
+        elif field == 3:
+            return zlib.decompress(value)
+    raise ValueError("Unsupported blob compression")
+
+
+# Return the bounding box [min_lon, min_lat, max_lon, max_lat] from the
+# header block of a pbf file, None if the header contains no bounding box.
+def read_header_bbox(path, index):
+    with open(path, "rb") as f:
+        for blob_type, offset, size in index:
+            if blob_type != "OSMHeader":
+                continue
+            for field, value in read_fields(read_blob(f, offset, size)):
+                if field == 1:
+                    box = {k: zigzag(v) * 1e-9 for k, v in read_fields(value)}
+                    return [box[1], box[4], box[2], box[3]]
+    return None
+
+
+# Return the coordinates (lon, lat) of all dense nodes of a primitive block.
+def read_dense_nodes(block):
+    granularity = 100
+    lat_offset = lon_offset = 0
+    groups = []
+    for field, value in read_fields(block):
+        if field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = value
+        elif field == 20:
+            lon_offset = value
+
+    coords = []
+    for group in groups:
+        for field, value in read_fields(group):
+            if field != 2:
+                continue
+            lat = lon = 0
+            dense = dict(read_fields(value))
+            lats = read_packed_sint(dense.get(8, b""))
+            lons = read_packed_sint(dense.get(9, b""))
+            for d_lat, d_lon in zip(lats, lons):
+                lat += d_lat
+                lon += d_lon
+                coords.append(
+                    (1e-9 * (lon_offset + granularity * lon),
+                     1e-9 * (lat_offset + granularity * lat)))
+    return coords
+
+
+# Estimate the share of the osm data of a pbf file inside bbox. Nodes are
+# stored before ways and relations, so the first blob without nodes is
+# searched by bisection and a sample of the node blobs is decoded.
+def data_share(path, index, bbox):
+    data = [(o, s) for t, o, s in index if t == "OSMData"]
+    if not data:
+        return 0
+
+    with open(path, "rb") as f:
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if read_dense_nodes(read_blob(f, *data[mid])):
+                lo = mid + 1
+            else:
+                hi = mid
+        node_blobs = data[:lo] if lo > 0 else data
+
+        step = max(1, len(node_blobs) // sample_blobs)
+        total = inside = 0
+        for offset, size in node_blobs[::step]:
+            for lon, lat in read_dense_nodes(read_blob(f, offset, size)):
+                total += 1
+                if bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]:
+                    inside += 1
+
+    return inside / total if total else 0
+
+
+# Area of a polygon file in km² (all rings, equirectangular approximation).
+def polygon_area(poly_path):
+    return polygon.load(poly_path).area
+
+
+def bbox_area(bbox):
+    lat_0 = math.radians((bbox[1] + bbox[3]) / 2)
+    return (math.radians(bbox[2] - bbox[0]) * math.cos(lat_0) * 6371
+            * math.radians(bbox[3] - bbox[1]) * 6371)
+
+
+# Return all stage records of build profiles in profile_dir together with the
+# stage drivers of the build.
+def read_profiles(profile_dir):
+    result = []
+    for path in glob.glob(os.path.join(profile_dir, "*.json")):
+        try:
+            with open(path) as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        drivers = {"none": 1}
+        poly_file = "polygons/" + report["map"] + ".poly"
+        if os.path.exists(poly_file):
+            drivers["area"] = polygon_area(poly_file)
+        for r in report["stages"]:
+            name = re.sub(r"_\d+$", "", r["name"])
+            if name == "filter" and "input_bytes" in r:
+                drivers["data"] = r["input_bytes"] / 1024**2
+            elif name == "extract" and "input_bytes" in r:
+                drivers["source"] = r["input_bytes"] / 1024**2
+
+        for r in report["stages"]:
+            if r.get("cached") or "output_bytes" not in r:
+                continue
+            result.append((report["map"], re.sub(r"_\d+$", "", r["name"]),
+                           drivers, r))
+    return result
+
+
+# Peak memory of a stage in MB: the stage process itself or its largest
+# external command.
+def peak_memory(record):
+    rss = [record["max_rss_kb"]] + [c["max_rss_kb"]
+                                    for c in record["commands"]]
+    return max(rss) / 1024
+
+
+# Fit y = a + b * x to points with least squares. Falls back to y = b * x if
+# there are not enough different points or the fit is not plausible.
+def fit(points):
+    n = len(points)
+    mean_x = sum(p[0] for p in points) / n
+    mean_y = sum(p[1] for p in points) / n
+    var = sum((p[0] - mean_x)**2 for p in points)
+    if var > 0:
+        b = sum((p[0] - mean_x) * (p[1] - mean_y) for p in points) / var
+        a = mean_y - b * mean_x
+        if a >= 0 and b >= 0:
+            return a, b
+    if mean_x > 0:
+        return 0, mean_y / mean_x
+    return mean_y, 0
+
+
+# Models [(a, b) for seconds, memory MB, output MB] per stage, calibrated
+# with all profiles that contain the stage.
+def calibrate(profiles):
+    points = {}
+    for map_name, name, drivers, r in profiles:
+        driver = stage_drivers.get(name, "data")
+        if driver not in drivers:
+            continue
+        x = drivers[driver]
+        points.setdefault(name, []).append(
+            (x, r["wall"], peak_memory(r), r["output_bytes"] / 1024**2))
+
+    models = {}
+    for name, p in points.items():
+        models[name] = [fit([(x[0], x[i]) for x in p]) for i in (1, 2, 3)]
+    return models
+
+
+def default_model(s):
+    seconds, memory, output = default_models.get(s.name, [0.1, 0, 0.1])
+    start_time = 0
+    if s.resource == scheduler.resource_jvm:
+        # JVM startup
+        start_time = 5
+        memory += governor.heap_size() + 200
+    return [(start_time, seconds), (memory, 0), (0, output)]
+
+
+# Simulate the scheduler (see scheduler.run_parallel) with the predicted
+# stage runtimes. Returns start and end time of each stage.
+def simulate(stage_list, runtime, jobs, jvm_jobs):
+    jobs = max(1, jobs)
+    pending = scheduler.topological_order(stage_list)
+    limits = {scheduler.resource_jvm: max(1, min(jvm_jobs, jobs)),
+              scheduler.resource_light: jobs}
+    start = {}
+    end = {}
+    running = []
+    now = 0
+    while pending or running:
+        for s in list(pending):
+            if len(running) >= jobs:
+                break
+            if not all(d in end and end[d] <= now for d in s.depends):
+                continue
+            if sum(1 for r in running
+                   if r.resource == s.resource) >= limits[s.resource]:
+                continue
+            start[s.name] = now
+            end[s.name] = now + runtime[s.name]
+            running.append(s)
+            pending.remove(s)
+
+        s = min(running, key=lambda r: end[r.name])
+        running.remove(s)
+        now = end[s.name]
+
+    return start, end
+
+
+# Peak disk usage (MB) of the stage outputs. The outputs of a stage exist
+# from its start until the end of the last stage reading them. With keep, or
+# if no stage reads them, they are kept until the end of the build.
+def peak_disk(stage_list, output, start, end, keep):
+    finish = max(end.values())
+    events = []
+    for s in stage_list:
+        for f in s.outputs:
+            size = output[s.name] / len(s.outputs)
+            readers = [end[r.name] for r in stage_list if f in r.inputs]
+            removed = max(readers) if readers and not keep else finish
+            events.append((start[s.name], size))
+            events.append((removed, -size))
+
+    # files are removed before the next stages start
+    disk = 0
+    peak = 0
+    for t, size in sorted(events):
+        disk += size
+        peak = max(peak, disk)
+    return peak
+
+
+def format_time(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+# Estimate the size of the extracted area of interest in MB. Uses (in this
+# order) an existing extract, the source file's blob index or the polygon
+# area. Returns the size and a description of the estimate.
+def estimate_data_size(map_, data_source, data_extracted, bbox, area):
+    if data_extracted is not None and os.path.exists(data_extracted):
+        return (os.path.getsize(data_extracted) / 1024**2,
+                "size of existing extract " + data_extracted)
+
+    if data_source is not None and os.path.exists(data_source):
+        index = read_blob_index(data_source)
+        source_size = os.path.getsize(data_source) / 1024**2
+        source_bbox = read_header_bbox(data_source, index)
+        share = data_share(data_source, index, bbox)
+        if map_["use_polygon_shape"]:
+            share *= min(1, area / bbox_area(bbox))
+        text = ("%d blobs, %d MB, %.1f %% of sampled nodes in bounding box"
+                % (len(index), source_size, 100 * share))
+        if source_bbox is not None:
+            text += ", source bounding box " + ",".join(
+                str(round(c, 2)) for c in source_bbox)
+        return source_size * share, text
+
+    return area * default_density, "polygon area (source file not available)"
+
+
+# Print the predicted schedule, resource usage and decisions of a build.
+# stage_list are the stages of the build (see create_stages()), data_source
+# the osm source file (None in batch mode), data_extracted the extracted area
+# of interest.
+def plan(map_, stage_list, data_source, data_extracted, args,
+         profile_dir="tmp/profiles/"):
+    poly_file = "polygons/" + map_["name"] + ".poly"
+    min_lat, min_lon, max_lat, max_lon = functions.min_max_lat_lon(poly_file)
+    bbox = [min_lon, min_lat, max_lon, max_lat]
+    area = polygon_area(poly_file)
+
+    logging.info("\n*** Build plan for map target %s" % map_["name"])
+    logging.info("    Polygon area: %d km²" % area)
+
+    drivers = {"none": 1, "area": area}
+    drivers["data"], text = estimate_data_size(map_, data_source,
+                                               data_extracted, bbox, area)
+    logging.info("    Estimated size of extracted data: %d MB (%s)"
+                 % (drivers["data"], text))
+
+    if data_source is not None:
+        if os.path.exists(data_source):
+            drivers["source"] = os.path.getsize(data_source) / 1024**2
+        else:
+            url = functions.osm_source(map_, args.planet)[0]
+            size = downloads.remote_size(url)
+            drivers["source"] = (size / 1024**2 if size is not None
+                                 else drivers["data"])
+
+    profiles = read_profiles(profile_dir)
+    models = calibrate(profiles)
+    maps = sorted({p[0] for p in profiles})
+    if maps:
+        logging.info("    Calibrated with profiles of %s" % ", ".join(maps))
+    else:
+        logging.info("    No build profiles in %s, using default estimates "
+                     "(use --profile to record profiles)" % profile_dir)
+
+    runtime = {}
+    memory = {}
+    output = {}
+    for s in stage_list:
+        name = re.sub(r"_\d+$", "", s.name)
+        model = models.get(name, default_model(s))
+        x = drivers.get(stage_drivers.get(name, "data"), 0)
+        runtime[s.name], memory[s.name], output[s.name] = \
+            [a + b * x for a, b in model]
+
+    start, end = simulate(stage_list, runtime, args.jobs, args.jvm_jobs)
+
+    logging.info("\n    %-15s %9s %9s %9s %9s"
+                 % ("stage", "start", "end", "memory", "output"))
+    for s in sorted(stage_list, key=lambda s: start[s.name]):
+        logging.info("    %-15s %9s %9s %6d MB %6d MB"
+                     % (s.name, format_time(start[s.name]),
+                        format_time(end[s.name]), memory[s.name],
+                        output[s.name]))
+
+    # peak memory of all stages running at the same time
+    peak = max(sum(memory[s.name] for s in stage_list
+                   if start[s.name] <= start[t.name] < end[s.name]
+                   or s is t)
+               for t in stage_list)
+    disk = drivers["data"] + peak_disk(stage_list, output, start, end,
+                                       args.keep_temp)
+
+    logging.info("\n    Estimated total runtime: %s"
+                 % format_time(max(end.values())))
+    logging.info("    Estimated peak memory: %d MB" % peak)
+    logging.info("    Estimated peak disk usage of intermediate files: %d MB"
+                 % disk)
+
+    logging.info("\n    Decisions:")
+    logging.info("    - %d parallel stages (-j), %d parallel osmosis stages "
+                 "(-jj)" % (args.jobs, args.jvm_jobs))
+    logging.info("    - osmosis heap: %d MB, osmconvert hash memory: %d MB"
+                 % (governor.heap_size(), governor.hash_memory()))
+    if args.keep_temp:
+        removal = "kept until the end of the build (-k)"
+    else:
+        removal = "removed when no longer needed (not stored in the cache)"
+    logging.info("    - intermediate files: %s" % removal)
+    if "merge" in output:
+        mapwriter_type = governor.mapwriter_type(output["merge"] * 1024**2,
+                                                 functions.mapwriter_hd_size)
+        logging.info("    - mapwriter: type=%s (estimated input %d MB), "
+                     "threads=%d" % (mapwriter_type, output["merge"],
+                                     governor.thread_count()))
+    logging.info("    - pyhgtmap: --jobs=%d" % governor.thread_count())
+    if map_["has_sea"]:
+        # grid split takes ~5 minutes and saves ~15 minutes of mapwriter
+        # runtime for Italy (~300000 km²)
+        useful = area > 100000
+        logging.info("    - land grid split: %s (%s for a polygon area of "
+                     "%d km²)"
+                     % ("on" if map_["use_land_grid_split"] else "off",
+                        "recommended" if useful else "not recommended",
+                        area))
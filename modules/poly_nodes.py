@@ -2,111 +2,93 @@ import logging
 import os
 import time
 
-import modules.functions as functions
+import modules.prefilter as prefilter
+import modules.runner as runner
+import modules.tag_transform as tag_transform
 
 logger = logging.getLogger(__name__)
 
 
 # Create a single node for certain polygon categories and add a bboxweight
-# tag for these nodes
-def run(file_in, map_, file_out):
+# tag for these nodes. poly_data and building_relations are the selections of
+# poly_labels.txt and building_relations_step_1.txt (see prefilter.py).
+def run(poly_data, building_relations, map_, file_out, tmp_dir):
     start_time = time.time()
 
-    if os.path.exists(file_out):
-        logging.info("    File %s already exists." % file_out)
-        return
-
-    # Filter relevant polygon categories
-    temp_poly_data = "tmp/temp_poly_data.osm"
-    cmd = ("osmfilter " + file_in + " "
-           "--parameter-file=osmfilter_parameters/poly_labels.txt "
-           "-o=" + temp_poly_data)
-    result = os.system(cmd)
-    if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
-        return
+    # prefix for temporary files of osmconvert
+    osmconvert_temp = "-t=" + os.path.join(tmp_dir, "osmconvert_tempfile") + " "
 
     # Apply tag-transform for name abbreviations and unifications
-    temp_poly_data_tt = "tmp/temp_poly_data_tt.pbf"
-    functions.merge_map_and_tt([temp_poly_data], temp_poly_data_tt, True)
+    temp_poly_data_tt = os.path.join(tmp_dir, "temp_poly_data_tt.pbf")
+    tag_transform.run([poly_data], temp_poly_data_tt,
+                      map_["tag_transform_engine"], True)
 
     # Add bboxweight tags
-    temp_bboxweight = "tmp/temp_bboxweight.pbf"
+    temp_bboxweight = os.path.join(tmp_dir, "temp_bboxweight.pbf")
     cmd = ("osmconvert " + temp_poly_data_tt + " "
            "--add-bboxweight-tags "
            "-o=" + temp_bboxweight)
-    result = os.system(cmd)
+    result = runner.run(cmd)
     if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
+        logger.error("osmconvert failed with exit code %s: %s"
+                     % (result, cmd))
         return
 
     # Convert to nodes
     # info: cannot apply --complete-multipolygons when reading standard input,
     # therefore separate execution of osmconvert
-    poly_nodes = "tmp/temp_poly_nodes.pbf"
+    poly_nodes = os.path.join(tmp_dir, "temp_poly_nodes.pbf")
     cmd = ("osmconvert " + temp_bboxweight + " "
            "--all-to-nodes "
            "--object-type-offset=100000000000+1 "
            "--max-objects=200000000 "
            "--complete-multipolygons "
            "--drop-broken-refs "
+           + osmconvert_temp +
            "-o=" + poly_nodes)
-    result = os.system(cmd)
+    result = runner.run(cmd)
     if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
-        return
-
-    # Filter building relations
-    temp_building_relations = "tmp/temp_building_relations.o5m"
-    cmd = ("osmfilter " + file_in + " "
-           "--parameter-file="
-           "osmfilter_parameters/building_relations_step_1.txt "
-           "-o=" + temp_building_relations)
-    result = os.system(cmd)
-    if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
+        logger.error("osmconvert failed with exit code %s: %s"
+                     % (result, cmd))
         return
 
     # Convert building-multipolygon-relationens (with house number) to a node
     # with house number
-    temp_building_nodes = "tmp/temp_building_relation_nodes.o5m"
-    cmd = ("osmconvert " + temp_building_relations + " "
+    temp_building_nodes = os.path.join(tmp_dir,
+                                       "temp_building_relation_nodes.pbf")
+    cmd = ("osmconvert " + building_relations + " "
            "--all-to-nodes "
            "--object-type-offset=200000000000+1 "
            "--max-objects=200000000 "
            "--complete-multipolygons "
            "--drop-broken-refs "
+           + osmconvert_temp +
            "-o=" + temp_building_nodes)
-    result = os.system(cmd)
+    result = runner.run(cmd)
     if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
+        logger.error("osmconvert failed with exit code %s: %s"
+                     % (result, cmd))
         return
 
     # Only keep nodes
-    building_nodes_filt = "tmp/temp_building_nodes_filt.osm"
-    cmd = ("osmfilter " + temp_building_nodes + " "
-           "--parameter-file="
-           "osmfilter_parameters/building_relations_step_2.txt "
-           "-o=" + building_nodes_filt)
-    result = os.system(cmd)
-    if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
-        return
+    building_nodes_filt = os.path.join(tmp_dir, "temp_building_nodes_filt.pbf")
+    prefilter.run(temp_building_nodes,
+                  ["osmfilter_parameters/building_relations_step_2.txt"],
+                  [building_nodes_filt])
 
     # Merge node categories
     cmd = ("osmconvert " + poly_nodes + " " + building_nodes_filt + " "
            "| osmconvert - " + temp_bboxweight + " "
            "--drop-version -o=" + file_out)
-    result = os.system(cmd)
+    result = runner.run(cmd)
     if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
+        logger.error("osmconvert failed with exit code %s: %s"
+                     % (result, cmd))
         return
 
     try:
-        os.remove(temp_poly_data)
         os.remove(temp_poly_data_tt)
         os.remove(poly_nodes)
-        os.remove(temp_building_relations)
         os.remove(temp_building_nodes)
         os.remove(building_nodes_filt)
         os.remove(temp_bboxweight)
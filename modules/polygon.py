@@ -0,0 +1,280 @@
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of grid cells per axis of the edge index.
+max_grid_size = 256
+
+# Earth radius (km) for area calculations.
+earth_radius = 6371
+
+# Cell states of the edge index
+outside = 0
+inside = 1
+boundary = 2
+
+# Loaded polygons {abspath: (mtime_ns, size, polygon)}. Stages running in
+# forked worker processes inherit the polygons loaded before the fork.
+loaded = {}
+
+
+# Return the polygon of poly_path. The file is only read again when it was
+# changed since the last call.
+def load(poly_path):
+    path = os.path.abspath(poly_path)
+    st = os.stat(path)
+    cached = loaded.get(path)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+
+    p = polygon(*read_rings(poly_path))
+    loaded[path] = (st.st_mtime_ns, st.st_size, p)
+    return p
+
+
+# Return the rings of a poly file as lists of (lon, lat) coordinates and a
+# list of flags that mark holes. A poly file can contain several rings, rings
+# with a section name starting with "!" are holes.
+def read_rings(poly_path):
+    try:
+        rings = []
+        holes = []
+        ring = None
+        with open(poly_path) as f:
+            f.readline()  # polygon name
+            for line in f:
+                data = line.split()
+                if not data:
+                    continue
+                if ring is None:
+                    if data[0] == "END":
+                        break
+                    ring = []
+                    rings.append(ring)
+                    holes.append(data[0].startswith("!"))
+                elif data[0] == "END":
+                    ring = None
+                else:
+                    ring.append((float(data[0]), float(data[1])))
+        return rings, holes
+    except Exception as e:
+        logger.error(f"Error reading polygon file {poly_path}: {e}")
+        raise
+
+
+# Area of a ring (km²) in an equirectangular projection around lat_0.
+def ring_area(ring, lat_0):
+    c = math.cos(lat_0) * earth_radius
+    x = [math.radians(p[0]) * c for p in ring]
+    y = [math.radians(p[1]) * earth_radius for p in ring]
+    area = 0
+    for i in range(len(x)):
+        area += x[i - 1] * y[i] - x[i] * y[i - 1]
+    return abs(area) / 2
+
+
+# Check if segment (x1, y1) - (x2, y2) intersects the box (Liang-Barsky).
+def segment_intersects_box(x1, y1, x2, y2, min_x, min_y, max_x, max_y):
+    t0 = 0.0
+    t1 = 1.0
+    dx = x2 - x1
+    dy = y2 - y1
+    for p, q in ((-dx, x1 - min_x), (dx, max_x - x1),
+                 (-dy, y1 - min_y), (dy, max_y - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = q / p
+            if p < 0:
+                if t > t1:
+                    return False
+                t0 = max(t0, t)
+            else:
+                if t < t0:
+                    return False
+                t1 = min(t1, t)
+    return True
+
+
+# Polygon of a map target with bounding box, area and a grid index of its
+# edges for point-in-polygon and box intersection tests. The polygon can
+# consist of several outer rings and holes.
+#
+# The bounding box is divided into a grid. Each row holds the edges that
+# cross its latitude band, each cell the edges that cross the cell. Cells
+# without edges are completely inside or outside the polygon, which is
+# decided once per cell. Points in these cells are answered by a lookup, only
+# points in boundary cells are tested by ray casting against the edges of
+# their row. Rings are combined with the even-odd rule, so a point inside a
+# hole is outside the polygon.
+class polygon:
+    def __init__(self, rings, holes=None):
+        if holes is None:
+            holes = [False] * len(rings)
+        self.rings = [r for r in rings if r]
+        self.holes = [h for r, h in zip(rings, holes) if r]
+        outer = [r for r, h in zip(self.rings, self.holes) if not h]
+        if not outer:
+            raise ValueError("Polygon without outer ring")
+
+        # bounding box of the outer rings
+        self.min_lon = min(p[0] for r in outer for p in r)
+        self.max_lon = max(p[0] for r in outer for p in r)
+        self.min_lat = min(p[1] for r in outer for p in r)
+        self.max_lat = max(p[1] for r in outer for p in r)
+
+        lat_0 = math.radians((self.min_lat + self.max_lat) / 2)
+        self.area = 0
+        for r, hole in zip(self.rings, self.holes):
+            self.area += -ring_area(r, lat_0) if hole else ring_area(r, lat_0)
+        self.area = max(self.area, 0)
+
+        # edges (lon1, lat1, lon2, lat2), rings are closed implicitly
+        self.edges = []
+        for r in self.rings:
+            n = len(r)
+            for i in range(n):
+                (x1, y1), (x2, y2) = r[i], r[(i + 1) % n]
+                if (x1, y1) != (x2, y2):
+                    self.edges.append((x1, y1, x2, y2))
+
+        self.build_index()
+
+    # min_lat, min_lon, max_lat, max_lon like functions.min_max_lat_lon()
+    def bbox(self):
+        return self.min_lat, self.min_lon, self.max_lat, self.max_lon
+
+    def build_index(self):
+        n = min(max_grid_size, max(1, int(2 * math.sqrt(len(self.edges)))))
+        self.cols = n
+        self.rows = n
+        self.cell_w = (self.max_lon - self.min_lon) / n or 1.0
+        self.cell_h = (self.max_lat - self.min_lat) / n or 1.0
+
+        self.row_edges = [[] for r in range(n)]
+        self.cell_edges = {}
+        for e in self.edges:
+            x1, y1, x2, y2 = e
+            r1 = self.row(min(y1, y2))
+            r2 = self.row(max(y1, y2))
+            for r in range(r1, r2 + 1):
+                self.row_edges[r].append(e)
+
+                # longitude range of the edge within the latitude band of r
+                b1 = self.min_lat + r * self.cell_h
+                b2 = b1 + self.cell_h
+                if y1 == y2:
+                    lons = (x1, x2)
+                else:
+                    lons = []
+                    for y in (max(b1, min(y1, y2)), min(b2, max(y1, y2))):
+                        lons.append(x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+                for c in range(self.col(min(lons)), self.col(max(lons)) + 1):
+                    self.cell_edges.setdefault((r, c), []).append(e)
+
+        # state of cells without edges from their center
+        self.cells = []
+        for r in range(n):
+            states = []
+            y = self.min_lat + (r + 0.5) * self.cell_h
+            for c in range(n):
+                if (r, c) in self.cell_edges:
+                    states.append(boundary)
+                else:
+                    x = self.min_lon + (c + 0.5) * self.cell_w
+                    states.append(inside if self.ray_cast(x, y, r)
+                                  else outside)
+            self.cells.append(states)
+
+    def row(self, lat):
+        r = int((lat - self.min_lat) / self.cell_h)
+        return min(max(r, 0), self.rows - 1)
+
+    def col(self, lon):
+        c = int((lon - self.min_lon) / self.cell_w)
+        return min(max(c, 0), self.cols - 1)
+
+    def ray_cast(self, lon, lat, r):
+        result = False
+        for x1, y1, x2, y2 in self.row_edges[r]:
+            if (y1 > lat) != (y2 > lat) and \
+                    lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                result = not result
+        return result
+
+    def in_bbox(self, lon, lat):
+        return self.min_lon <= lon <= self.max_lon and \
+            self.min_lat <= lat <= self.max_lat
+
+    # Check if point lon, lat is inside the polygon.
+    def contains(self, lon, lat):
+        if not self.in_bbox(lon, lat):
+            return False
+        r = self.row(lat)
+        state = self.cells[r][self.col(lon)]
+        if state == boundary:
+            return self.ray_cast(lon, lat, r)
+        return state == inside
+
+    # Check a list of (lon, lat) points at once. Points are grouped by row,
+    # so the cells and edges of a row are only fetched once per group.
+    # Returns a list of booleans in the order of points.
+    def contains_points(self, points):
+        min_lon, max_lon = self.min_lon, self.max_lon
+        min_lat, max_lat = self.min_lat, self.max_lat
+        cell_w, cell_h = self.cell_w, self.cell_h
+        last_row, last_col = self.rows - 1, self.cols - 1
+
+        result = [False] * len(points)
+        by_row = {}
+        for i, (lon, lat) in enumerate(points):
+            if min_lon <= lon <= max_lon and min_lat <= lat <= max_lat:
+                r = min(int((lat - min_lat) / cell_h), last_row)
+                by_row.setdefault(r, []).append(i)
+
+        for r, indices in by_row.items():
+            states = self.cells[r]
+            edges = self.row_edges[r]
+            for i in indices:
+                lon, lat = points[i]
+                state = states[min(int((lon - min_lon) / cell_w), last_col)]
+                if state != boundary:
+                    result[i] = state == inside
+                    continue
+                hit = False
+                for x1, y1, x2, y2 in edges:
+                    if (y1 > lat) != (y2 > lat) and \
+                            lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                        hit = not hit
+                result[i] = hit
+        return result
+
+    # Check if the box min_lat, min_lon, max_lat, max_lon overlaps the
+    # bounding box of the polygon.
+    def bbox_intersects(self, min_lat, min_lon, max_lat, max_lon):
+        return min_lon <= self.max_lon and max_lon >= self.min_lon and \
+            min_lat <= self.max_lat and max_lat >= self.min_lat
+
+    # Check if the box min_lat, min_lon, max_lat, max_lon overlaps the
+    # polygon: the box is inside the polygon, a cell of the box is inside the
+    # polygon or an edge of the polygon crosses the box.
+    def intersects(self, min_lat, min_lon, max_lat, max_lon):
+        if not self.bbox_intersects(min_lat, min_lon, max_lat, max_lon):
+            return False
+        if self.contains((min_lon + max_lon) / 2, (min_lat + max_lat) / 2):
+            return True
+
+        for r in range(self.row(min_lat), self.row(max_lat) + 1):
+            for c in range(self.col(min_lon), self.col(max_lon) + 1):
+                state = self.cells[r][c]
+                if state == inside:
+                    return True
+                if state == boundary:
+                    for e in self.cell_edges[(r, c)]:
+                        if segment_intersects_box(*e, min_lon, min_lat,
+                                                  max_lon, max_lat):
+                            return True
+        return False
@@ -0,0 +1,436 @@
+import logging
+import os
+import time
+
+import osmium
+
+import modules.functions as functions
+import modules.runner as runner
+
+logger = logging.getLogger(__name__)
+
+# Object types of osmfilter options
+types = {"nodes": "n", "ways": "w", "relations": "r"}
+
+
+# Value (or key) pattern of an osmfilter condition: "*" or "" match any
+# value, a leading / trailing "*" is a wildcard.
+def compile_pattern(s):
+    if s in ("", "*"):
+        return lambda v: True
+    if len(s) > 2 and s[0] == "*" and s[-1] == "*":
+        part = s[1:-1]
+        return lambda v: part in v
+    if s[-1] == "*":
+        prefix = s[:-1]
+        return lambda v: v.startswith(prefix)
+    if s[0] == "*":
+        suffix = s[1:]
+        return lambda v: v.endswith(suffix)
+    return lambda v: v == s
+
+
+def is_pattern(s):
+    return "*" in s
+
+
+# Condition key=value1 =value2 ...: the object has tag key with one of the
+# values.
+def compile_condition(key, values):
+    if is_pattern(key):
+        key_match = compile_pattern(key)
+        value_match = [compile_pattern(v) for v in values]
+
+        def match(tags):
+            for k, v in tags.items():
+                if key_match(k) and any(m(v) for m in value_match):
+                    return True
+            return False
+        return match
+
+    if any(v in ("", "*") for v in values):
+        return lambda tags: key in tags
+
+    exact = set(v for v in values if not is_pattern(v))
+    patterns = [compile_pattern(v) for v in values if is_pattern(v)]
+
+    def match(tags):
+        v = tags.get(key)
+        if v is None:
+            return False
+        return v in exact or any(m(v) for m in patterns)
+    return match
+
+
+# Split the tokens of an osmfilter expression, parentheses can be attached to
+# conditions.
+def split_tokens(text):
+    tokens = []
+    for t in text.split():
+        while t.startswith("("):
+            tokens.append("(")
+            t = t[1:]
+        closing = 0
+        while t.endswith(")"):
+            closing += 1
+            t = t[:-1]
+        if t:
+            tokens.append(t)
+        tokens += [")"] * closing
+    return tokens
+
+
+# Expression without conditions
+def never(tags):
+    return False
+
+
+# Compile an osmfilter expression (conditions combined with "and", "or" and
+# parentheses, "or" if there is no operator) into a function of the tags
+# (dict) of an object. An empty expression matches no object.
+def compile_expression(text):
+    tokens = split_tokens(text)
+    if not tokens:
+        return never
+    pos = 0
+
+    def parse_or():
+        nonlocal pos
+        terms = [parse_and()]
+        while pos < len(tokens) and tokens[pos] != ")":
+            if tokens[pos] == "or":
+                pos += 1
+            terms.append(parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda tags: any(t(tags) for t in terms)
+
+    def parse_and():
+        nonlocal pos
+        factors = [parse_factor()]
+        while pos < len(tokens) and tokens[pos] == "and":
+            pos += 1
+            factors.append(parse_factor())
+        if len(factors) == 1:
+            return factors[0]
+        return lambda tags: all(f(tags) for f in factors)
+
+    def parse_factor():
+        nonlocal pos
+        if pos >= len(tokens):
+            raise ValueError("Unexpected end of filter expression: %s" % text)
+        t = tokens[pos]
+        pos += 1
+        if t == "(":
+            result = parse_or()
+            if pos >= len(tokens) or tokens[pos] != ")":
+                raise ValueError("Missing ) in filter expression: %s" % text)
+            pos += 1
+            return result
+        if "=" not in t or t[0] == "=" or t in ("and", "or", ")"):
+            raise ValueError("Invalid condition %s in filter expression: %s"
+                             % (t, text))
+        key, value = t.split("=", 1)
+        values = [value]
+        # further values of the same key: key=v1 =v2 =v3
+        while pos < len(tokens) and tokens[pos][0] == "=":
+            values.append(tokens[pos][1:])
+            pos += 1
+        return compile_condition(key, values)
+
+    result = parse_or()
+    if pos != len(tokens):
+        raise ValueError("Unexpected %s in filter expression: %s"
+                         % (tokens[pos], text))
+    return result
+
+
+# Tags removed by --drop-tags. Tags with a key that is dropped regardless of
+# its value are remembered, so most tags are decided by a dict lookup.
+class tag_dropper:
+    def __init__(self, text):
+        self.any_keys = set()
+        self.key_values = {}
+        self.patterns = []
+        for t in text.split():
+            key, value = t.split("=", 1) if "=" in t else (t, "*")
+            if is_pattern(key):
+                self.patterns.append((compile_pattern(key),
+                                      compile_pattern(value)))
+            elif value in ("", "*"):
+                self.any_keys.add(key)
+            else:
+                self.key_values.setdefault(key, []).append(
+                    compile_pattern(value))
+        # {key: True (drop) / False (keep) / None (depends on value)}
+        self.keys = {}
+
+    def key_state(self, k):
+        state = self.keys.get(k)
+        if state is None and k not in self.keys:
+            if k in self.any_keys:
+                state = True
+            elif k in self.key_values or \
+                    any(km(k) for km, vm in self.patterns):
+                state = None
+            else:
+                state = False
+            self.keys[k] = state
+        return state
+
+    def drops(self, k, v):
+        state = self.key_state(k)
+        if state is not None:
+            return state
+        if any(m(v) for m in self.key_values.get(k, [])):
+            return True
+        return any(km(k) and vm(v) for km, vm in self.patterns)
+
+    # Return the remaining tags of tags (dict) or None if no tag is dropped.
+    def apply(self, tags):
+        for k, v in tags.items():
+            if self.drops(k, v):
+                return {k: v for k, v in tags.items() if not self.drops(k, v)}
+        return None
+
+
+# Selection of an osmfilter parameter file (osmfilter_parameters/*.txt):
+# --keep, --keep-nodes / -ways / -relations, --drop-nodes / -ways /
+# -relations, --drop-tags and --ignore-dependencies.
+#
+# Like osmfilter, all objects are kept if there is no --keep option, a type
+# specific option replaces --keep for its type. Unless dependencies are
+# ignored, the nodes of kept ways and the member nodes and ways (with their
+# nodes) of kept relations are kept, too.
+class rule:
+    def __init__(self, path):
+        self.path = path
+        options = {}
+        option = None
+        with open(path) as f:
+            for t in f.read().split():
+                if t.startswith("--"):
+                    option, sep, value = t[2:].partition("=")
+                    options[option] = value
+                elif option is None:
+                    raise ValueError("Invalid parameter %s in %s" % (t, path))
+                else:
+                    options[option] += " " + t
+
+        self.keep = {}
+        self.drop_all = set()
+        self.ignore_dependencies = False
+        self.drop_tags = None
+        for option, value in options.items():
+            if option == "keep":
+                continue
+            elif option.startswith("keep-") and option[5:] in types:
+                self.keep[types[option[5:]]] = compile_expression(value)
+            elif option.startswith("drop-") and option[5:] in types:
+                self.drop_all.add(types[option[5:]])
+            elif option == "drop-tags":
+                self.drop_tags = tag_dropper(value)
+            elif option == "ignore-dependencies":
+                self.ignore_dependencies = True
+            else:
+                raise ValueError("Unsupported option --%s in %s"
+                                 % (option, path))
+        if "keep" in options:
+            keep = compile_expression(options["keep"])
+            for t in types.values():
+                self.keep.setdefault(t, keep)
+
+        # ids of dependencies, collected for the types in dependencies
+        self.nodes = osmium.index.IdSet()
+        self.ways = osmium.index.IdSet()
+        self.dependencies = set()
+
+    # Check if an object of type t with tags (dict) is selected.
+    def matches(self, tags, t):
+        if t in self.drop_all:
+            return False
+        keep = self.keep.get(t)
+        return keep is None or (len(tags) > 0 and keep(tags))
+
+    # Dependencies only matter if ways or relations are selected by an
+    # expression.
+    def needs(self, t):
+        return not self.ignore_dependencies and t not in self.drop_all and \
+            self.keep.get(t, never) is not never
+
+    def dependency_ids(self, t):
+        if t in self.drop_all or t not in self.dependencies:
+            return None
+        return self.nodes if t == "n" else self.ways
+
+    # Check if object oid of type t with tags is selected or a dependency of
+    # a selected object.
+    def keeps(self, t, oid, tags):
+        if self.matches(tags, t):
+            return True
+        ids = self.dependency_ids(t)
+        return ids is not None and oid in ids
+
+
+# Tags of an object as dict, most nodes have no tags.
+def object_tags(o):
+    tags = o.tags
+    if len(tags) == 0:
+        return {}
+    return dict(tags)
+
+
+# Pass 1: member nodes and ways of selected relations.
+class collect_relation_members(osmium.SimpleHandler):
+    def __init__(self, rules):
+        osmium.SimpleHandler.__init__(self)
+        self.rules = rules
+
+    def relation(self, r):
+        tags = object_tags(r)
+        for ru in self.rules:
+            if ru.matches(tags, "r"):
+                for m in r.members:
+                    if m.type == "n":
+                        ru.nodes.set(m.ref)
+                    elif m.type == "w":
+                        ru.ways.set(m.ref)
+
+
+# Pass 2: nodes of selected ways.
+class collect_way_nodes(osmium.SimpleHandler):
+    def __init__(self, rules):
+        osmium.SimpleHandler.__init__(self)
+        self.rules = rules
+
+    def way(self, w):
+        tags = object_tags(w)
+        wid = w.id
+        for ru in self.rules:
+            if ru.keeps("w", wid, tags):
+                for n in w.nodes:
+                    ru.nodes.set(n.ref)
+
+
+# Pass 3: write the selected objects of each rule to its writer.
+class write_selections(osmium.SimpleHandler):
+    def __init__(self, rules, writers):
+        osmium.SimpleHandler.__init__(self)
+        # {type: [(rule, writer, expression or None for all, dependency ids
+        # or None)]} without rules that can't select objects of the type
+        self.selectors = {}
+        for t in types.values():
+            self.selectors[t] = []
+            for ru, writer in zip(rules, writers):
+                keep = ru.keep.get(t)
+                ids = ru.dependency_ids(t)
+                if t in ru.drop_all or (keep is never and ids is None):
+                    continue
+                self.selectors[t].append((ru, writer, keep, ids))
+
+    def selected(self, t, oid, tags):
+        for ru, writer, keep, ids in self.selectors[t]:
+            if keep is None or (tags and keep(tags)) or \
+                    (ids is not None and oid in ids):
+                yield ru, writer
+
+    def write(self, ru, o, tags, add):
+        if ru.drop_tags is not None and tags:
+            tags = ru.drop_tags.apply(tags)
+            if tags is not None:
+                o = o.replace(tags=tags)
+        add(o)
+
+    def node(self, n):
+        tags = object_tags(n)
+        for ru, writer in self.selected("n", n.id, tags):
+            self.write(ru, n, tags, writer.add_node)
+
+    def way(self, w):
+        tags = object_tags(w)
+        for ru, writer in self.selected("w", w.id, tags):
+            self.write(ru, w, tags, writer.add_way)
+
+    def relation(self, r):
+        tags = object_tags(r)
+        for ru, writer in self.selected("r", r.id, tags):
+            self.write(ru, r, tags, writer.add_relation)
+
+
+# Apply the osmfilter parameter files with osmfilter itself (engine
+# "osmfilter"). osmfilter can't read pbf, so a pbf file_in is converted to o5m
+# once (the extract stage writes o5m for this engine if possible), every
+# selection is a separate osmfilter run converted to pbf by osmconvert.
+def run_osmfilter(file_in, parameter_files, files_out, tmp_dir):
+    try:
+        start_time = time.time()
+
+        temp_o5m = file_in
+        if not file_in.endswith(".o5m"):
+            temp_o5m = os.path.join(tmp_dir, "temp_prefilter.o5m")
+            cmd = "osmconvert " + file_in + " -o=" + temp_o5m
+            result = runner.run(cmd)
+            if result != 0:
+                logger.error(f"osmconvert failed with exit code {result}")
+                raise Exception("osmconvert command failed")
+
+        for parameter_file, file_out in zip(parameter_files, files_out):
+            cmd = ("osmfilter " + temp_o5m + " "
+                   "--parameter-file=" + parameter_file + " "
+                   "-t=" + os.path.join(tmp_dir, "osmfilter_tempfile") + " |"
+                   " osmconvert - --drop-version -o=" + file_out)
+            result = runner.run(cmd)
+            if result != 0:
+                logger.error(f"osmfilter/osmconvert failed with exit code "
+                             f"{result}")
+                raise Exception("osmfilter command failed")
+
+        if temp_o5m != file_in:
+            os.remove(temp_o5m)
+
+        logging.info("    %s seconds" % round((time.time() - start_time), 1))
+    except Exception as e:
+        logger.error(f"Error in run_osmfilter/prefilter.py: {e}")
+        raise
+
+
+# Apply the osmfilter parameter files parameter_files to file_in and write
+# the selections to the corresponding files_out. Objects of all selections
+# are written in a single pass over file_in. If a selection depends on the
+# ways or relations it keeps, their member ids are collected in up to two
+# passes that only read relations / ways. With engine "osmfilter", the
+# selections are made by osmfilter (see run_osmfilter()).
+def run(file_in, parameter_files, files_out, engine="pyosmium",
+        tmp_dir=None):
+    if engine == "osmfilter":
+        run_osmfilter(file_in, parameter_files, files_out, tmp_dir)
+        return
+
+    try:
+        start_time = time.time()
+        rules = [rule(p) for p in parameter_files]
+
+        rel_rules = [ru for ru in rules if ru.needs("r")]
+        if rel_rules:
+            for ru in rel_rules:
+                ru.dependencies.update(["n", "w"])
+            collect_relation_members(rel_rules).apply_file(file_in)
+
+        way_rules = [ru for ru in rules if ru.needs("w") or
+                     (ru in rel_rules and "w" not in ru.drop_all)]
+        if way_rules:
+            for ru in way_rules:
+                ru.dependencies.add("n")
+            collect_way_nodes(way_rules).apply_file(file_in)
+
+        writers = [functions.osm_writer(f) for f in files_out]
+        try:
+            write_selections(rules, writers).apply_file(file_in)
+        finally:
+            for w in writers:
+                w.close()
+
+        logging.info("    %s seconds" % round((time.time() - start_time), 1))
+    except Exception as e:
+        logger.error(f"Error in run/prefilter.py: {e}")
+        raise
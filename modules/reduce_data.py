@@ -3,6 +3,9 @@ import osmium
 import os
 import time
 
+import modules.id_store as id_store
+import modules.relevance as relevance
+
 logger = logging.getLogger(__name__)
 
 # redlist of tags to remove if a way exceeds the mapsforge 15 tags limit
@@ -46,73 +49,35 @@ whitelist = {3474227}
 threshold = 15
 
 
-# read an xml file and add all osm tag keys identified by preceeding
-# key_identifier and key_end to target_set. Multiple keys can be separated
-# by "|".
-def read_xml_keys(file_in, target_set, key_identifier, key_end):
-    f = open(file_in, "r")
-    content = f.readlines()
-    f.close()
-
-    for line in content:
-        key_found = line.find(key_identifier)
-        if key_found > 0:
-            start = key_found+len(key_identifier)+1
-            end = start+line[start:].find(key_end)
-            key = line[start:end]
-            if key != "*":
-                if key.find("|") > 0:
-                    keys = key.split("|")
-                    for k in keys:
-                        target_set.add(k)
-                else:
-                    target_set.add(key)
-
-
-# read up to two tagmapping-files and up to two xml map themes and return their
-# osm tag keys as key_set
-def read_osm_tag_keys(tm1, tm2, theme1, theme2):
-    key_set = set()
-    if tm1 != "":
-        read_xml_keys(tm1, key_set, "key=", "'")
-    if tm2 != "":
-        read_xml_keys(tm2, key_set, "key=", "'")
-    if theme1 != "":
-        read_xml_keys(theme1, key_set, "k=", "\"")
-    if theme2 != "":
-        read_xml_keys(theme2, key_set, "k=", "\"")
-
-    return key_set
-
-
 # This class mainly does three things:
 # 1. Check relations if they can be deleted or have relevant tags, see comments
 #    below.
-# 2. Check ways if they are candidates for deletion based on their tags.
+# 2. Check ways if they are candidates for deletion based on their tags
+#    (key and value, see relevance.rule_set).
 # 3. Check the maspforge writer tag limt per way and reduce way tags (according
 #    to redlist) if necessary.
 class collect_data_and_limit_tags(osmium.SimpleHandler):
-    def __init__(self, threshold, writer_limit, key_set):
+    def __init__(self, threshold, writer_limit, rules):
         osmium.SimpleHandler.__init__(self)
         self.threshold = threshold
         self.writer_limit = writer_limit
-        self.key_set = key_set
+        self.rules = rules
 
         # set of all osm ways (ids) that are members of a relation with
-        # one or more tags of key_set
-        self.relation_ways = set()
+        # one or more relevant tags
+        self.relation_ways = id_store.id_set()
 
         # Relation to be deleted. Member ways of these relations will not be
         # added to self.relation_ways as they don't need to be kept.
-        self.del_rels = set()
+        self.del_rels = id_store.id_set()
 
         # Relations to be deleted. Member ways of these relations should not be
         # deleted and are added to self.relation_ways.
-        self.del_rels_with_relevant_ways = set()
+        self.del_rels_with_relevant_ways = id_store.id_set()
 
         # Ways that are candidates to be deleted because of their tags.
-        self.del_ways = set()
-        self.coastline_ways = set()
+        self.del_ways = id_store.id_set()
+        self.coastline_ways = id_store.id_set()
 
     def relation(self, r):
         if r.id in blacklist:
@@ -131,15 +96,12 @@ class collect_data_and_limit_tags(osmium.SimpleHandler):
             self.__add_members_to_relation_ways(r.members)
 
     def way(self, w):
-        # Store ways without relevant tags (defined by key_set) and store
-        # coastline ways
-        relevant = False
+        # Store ways without relevant tags (defined by the tag-mapping and
+        # map theme) and store coastline ways
         tags = {}
         for k, v in w.tags:
             tags[k] = v
-            if k in self.key_set:
-                relevant = True
-        if relevant is False:
+        if not self.rules.any_relevant("w", tags.items()):
             self.del_ways.add(w.id)
 
         if "natural" in tags:
@@ -193,18 +155,15 @@ class collect_data_and_limit_tags(osmium.SimpleHandler):
 
             # Keep relation if it has relevant tags. Member ways will also be
             # excluded from deletion.
-            elif k in self.key_set:
+            elif self.rules.relevant("w", k, v):
                 relevant = True
 
         return relevant
 
     def __check_tag_limit(self, w, tags):
         if len(tags.keys()) > self.threshold:
-            n = 0
-            for t in tags.keys():
-                # only count relevant tags
-                if t in self.key_set:
-                    n = n + 1
+            # only count tags written by the mapwriter
+            n = self.rules.count_mapped("w", tags.items())
 
             # reduce tags if necessary
             if n > self.threshold:
@@ -217,36 +176,17 @@ class collect_data_and_limit_tags(osmium.SimpleHandler):
                 self.writer_limit.add_way(way)
 
 
-# pass an empty way with id w_id to the writer
-def write_empty_way(writer, w_id):
-    try:
-        w = osmium.osm.Way("").replace(id=w_id, nodes=[], version=1, visible=True,
-                                       changeset=1,
-                                       timestamp="1970-01-01T00:59:59Z", uid=1,
-                                       user="", tags=[])
-        writer.add_way(w)
-    except Exception as e:
-        logger.error("Error writing empty way %d: %s" % (w_id, str(e)))
-
-
-# pass an empty relation with osm id r_id to the writer
-def write_empty_relation(writer, r_id):
-    try:
-        r = osmium.osm.Relation("").replace(id=r_id, members=[], version=1,
-                                            visible=True, changeset=1,
-                                            timestamp="1970-01-01T00:59:59Z",
-                                            uid=1, user="", tags=[])
-        writer.add_relation(r)
-    except Exception as e:
-        logger.error("Error writing empty relation %d: %s" % (r_id, str(e)))
+# Write the ids of ways and relations to delete to file_out, sorted by type
+# and id, one object per line like "w123" (the id file format of osmium
+# getid/removeid, read by merge.read_id_list).
+def write_ids(file_out, ways, relations):
+    with open(file_out, "w") as f:
+        for t, ids in (("w", ways), ("r", relations)):
+            for oid in ids:
+                f.write("%s%d\n" % (t, oid))
 
 
 def run(file_in, file_out_subtract, file_out_limit):
-    if os.path.exists(file_out_subtract) and os.path.exists(file_out_limit):
-        logging.info("    Files %s and %s already exists."
-                     % (file_out_subtract, file_out_limit))
-        return
-
     start_time = time.time()
 
     tm1 = "tt_tm/tagmapping-urban.xml"
@@ -255,11 +195,10 @@ def run(file_in, file_out_subtract, file_out_limit):
     theme2 = "themes/Elevate/Elements.xml"
 
     try:
-        # read relevant osm keys from tag-mapping and map themes
-        key_set = read_osm_tag_keys(tm1, tm2, theme1, theme2)
-        key_set.remove("bBoxWeight")
+        # relevant osm tags from tag-mapping and map themes
+        rules = relevance.load([tm1, tm2], [theme1, theme2])
     except Exception as e:
-        logger.error("Error reading osm keys: %s" % str(e))
+        logger.error("Error reading tag relevance rules: %s" % str(e))
         return
 
     try:
@@ -271,7 +210,7 @@ def run(file_in, file_out_subtract, file_out_limit):
 
     try:
         writer_limit = osmium.SimpleWriter(file_out_limit)
-        cd = collect_data_and_limit_tags(threshold, writer_limit, key_set)
+        cd = collect_data_and_limit_tags(threshold, writer_limit, rules)
         cd.apply_file(file_in)
         writer_limit.close()
     except Exception as e:
@@ -285,56 +224,21 @@ def run(file_in, file_out_subtract, file_out_limit):
         return
 
     # is the way in a relation that has relevant tags?
-    del_ways2 = set()
-    for w in cd.del_ways:
-        if w not in cd.relation_ways:
-            del_ways2.add(w)
+    del_ways = cd.del_ways.difference(cd.relation_ways)
 
     # also delete coastlines that are in no relation
     for w in cd.coastline_ways:
         if w not in cd.relation_ways:
-            del_ways2.add(w)
+            del_ways.add(w)
             break
 
-    # prepare output file
     try:
-        temp_file_subtract = "tmp/temp_subtract.pbf"
-        if os.path.exists(temp_file_subtract):
-            os.remove(temp_file_subtract)
-    except Exception as e:
-        logger.error("Error removing previous output file: %s" % str(e))
-        return
-
-    try:
-        writer = osmium.SimpleWriter(temp_file_subtract)
-
-        for w in del_ways2:
-            write_empty_way(writer, w)
-        logging.info("    %d ways deleted" % len(del_ways2))
-
-        del_rels = cd.del_rels
-        del_rels.update(cd.del_rels_with_relevant_ways)
-
-        for r_id in del_rels:
-            write_empty_relation(writer, r_id)
+        del_rels = cd.del_rels.union(cd.del_rels_with_relevant_ways)
+        write_ids(file_out_subtract, del_ways, del_rels)
+        logging.info("    %d ways deleted" % len(del_ways))
         logging.info("    %d relations deleted" % len(del_rels))
-
-        writer.close()
     except Exception as e:
         logger.error("Error during deletion of ways and relations: %s" % str(e))
         return
 
-    # temp file is not sorted yet --> sort
-    cmd = "osmosis -q --rbf " + temp_file_subtract + " --s --wb "
-    cmd += file_out_subtract
-    result = os.system(cmd)
-    if result != 0:
-        logger.error("os.system() failed for command: %s" % cmd)
-        return
-
-    try:
-        os.remove(temp_file_subtract)
-    except Exception as e:
-        logging.warning("Warning removing temp files: %s" % str(e))
-
     logging.info("    %s seconds" % round((time.time() - start_time), 1))
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import os
+import xml.parsers.expat
+
+logger = logging.getLogger(__name__)
+
+# Directory for compiled rule sets, named by the hash of their source files
+cache_dir = "tmp/cache/relevance/"
+
+# Version of the cached rule format, part of the cache key
+cache_version = 2
+
+# Any value of a key (tag-mapping values %s, %f, %d, ..., theme value *)
+any_value = "*"
+
+# Keys that never make an object relevant (bBoxWeight is added to the
+# polygon label nodes by osmconvert)
+ignored_keys = {"bBoxWeight"}
+
+# Element types of tag-mapping sections and theme rules. Relations are
+# written as ways (multipolygons), so they use the way rules.
+section_types = {"pois": "n", "ways": "w"}
+theme_types = {"node": ("n",), "way": ("w",), "any": ("n", "w")}
+
+
+# Call handler(name, attributes) for every start tag of the xml file. Map
+# themes include other files as external entities, these are skipped (the
+# included files are read on their own).
+def read_elements(path, handler):
+    p = xml.parsers.expat.ParserCreate()
+    p.SetParamEntityParsing(
+        xml.parsers.expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+    p.UseForeignDTD(True)
+    p.ExternalEntityRefHandler = lambda *args: 1
+    p.StartElementHandler = lambda name, attrs: \
+        handler(name.split(":")[-1], attrs)
+    with open(path, "rb") as f:
+        p.ParseFile(f)
+
+
+def tag_value(v):
+    return any_value if v.startswith("%") or v == "*" else v
+
+
+# Rules of a mapsforge tag-mapping file: (type, key, value, zoom-appear,
+# renderable, written) per osm-tag element and equivalent value. Tags with
+# renderable='false' are written, but don't make an object visible.
+def read_tag_mapping(path):
+    rules = []
+    section = []
+
+    def handler(name, attrs):
+        if name in section_types:
+            section.append(section_types[name])
+        elif name == "osm-tag" and section:
+            values = [attrs.get("value", "")]
+            values += [e for e in attrs.get("equivalent-values",
+                                            "").split(",") if e]
+            zoom = int(attrs.get("zoom-appear", 0))
+            renderable = attrs.get("renderable", "true") != "false"
+            for v in values:
+                rules.append((section[-1], attrs.get("key", ""),
+                              tag_value(v), zoom, renderable, True))
+
+    read_elements(path, handler)
+    return rules
+
+
+# Rules of a mapsforge render theme: (type, key, value, zoom-min, True,
+# False) for every key and value of a rule element, the mapwriter only
+# writes tags of the tag-mapping. Values ~ (key not present) don't make a
+# tag relevant, negated value lists (-) match any value.
+def read_theme(path):
+    rules = []
+
+    def handler(name, attrs):
+        if name != "rule":
+            return
+        keys = [k for k in attrs.get("k", "").split("|") if k != "*"]
+        values = attrs.get("v", "*").split("|")
+        if "-" in values or "*" in values:
+            values = [any_value]
+        values = [v for v in values if v != "~"]
+        zoom = int(attrs.get("zoom-min", 0))
+        for t in theme_types.get(attrs.get("e", "any"), ("n", "w")):
+            for k in keys:
+                for v in values:
+                    rules.append((t, k, v, zoom, True, False))
+
+    read_elements(path, handler)
+    return rules
+
+
+# Relevance of tags for the map: the (key, value) combinations of the
+# tag-mapping and the map theme per element type ("n" for nodes, "w" for
+# ways and relations). Compiled into lookup tables {type: {key: set of
+# values}}, any_value in the set matches every value of the key.
+# - relevant: renderable tags, an object without relevant tags can never
+#   be shown on the map
+# - mapped: all tags of the tag-mapping, written by the mapwriter (tag
+#   limit)
+# Rules with a zoom level above max_zoom are ignored.
+class rule_set:
+    def __init__(self, rules, max_zoom=None):
+        self.rules = rules
+        self.relevant_tags = {t: {} for t in section_types.values()}
+        self.mapped_tags = {t: {} for t in section_types.values()}
+        for t, k, v, zoom, renderable, written in rules:
+            if k in ignored_keys or (max_zoom is not None and
+                                     zoom > max_zoom):
+                continue
+            if written:
+                self.mapped_tags[t].setdefault(k, set()).add(v)
+            if renderable:
+                self.relevant_tags[t].setdefault(k, set()).add(v)
+
+    def relevant(self, t, k, v):
+        values = self.relevant_tags[t].get(k)
+        return values is not None and (v in values or any_value in values)
+
+    def mapped(self, t, k, v):
+        values = self.mapped_tags[t].get(k)
+        return values is not None and (v in values or any_value in values)
+
+    # Check if any tag (k, v) of tags is relevant for type t.
+    def any_relevant(self, t, tags):
+        relevant_tags = self.relevant_tags[t]
+        for k, v in tags:
+            values = relevant_tags.get(k)
+            if values is not None and (v in values or any_value in values):
+                return True
+        return False
+
+    # Number of tags of tags written by the mapwriter for type t.
+    def count_mapped(self, t, tags):
+        return sum(1 for k, v in tags if self.mapped(t, k, v))
+
+
+# Rule set that accepts every value of keys (no tag-mapping available).
+def from_keys(keys):
+    return rule_set([(t, k, any_value, 0, True, True) for t in ("n", "w")
+                     for k in keys])
+
+
+def files_hash(paths):
+    h = hashlib.sha256(str(cache_version).encode())
+    for p in paths:
+        h.update(p.encode())
+        with open(p, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+# Return the rule set of the tag-mapping and theme files. The rules are
+# stored in cache_dir, keyed by the hash of the files, so they are only
+# parsed again if a file changed.
+def load(tag_mappings, themes, max_zoom=None):
+    tag_mappings = [f for f in tag_mappings if f]
+    themes = [f for f in themes if f]
+    cache_file = os.path.join(cache_dir,
+                              files_hash(tag_mappings + themes) + ".json")
+
+    rules = None
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                rules = [tuple(r) for r in json.load(f)]
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring invalid rule cache %s: %s"
+                           % (cache_file, e))
+
+    if rules is None:
+        rules = []
+        for f in tag_mappings:
+            rules += read_tag_mapping(f)
+        for f in themes:
+            rules += read_theme(f)
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temp = cache_file + ".%d" % os.getpid()
+        with open(temp, "w") as f:
+            json.dump(rules, f)
+        os.replace(temp, cache_file)
+
+    return rule_set(rules, max_zoom)
@@ -0,0 +1,81 @@
+import datetime
+import logging
+import os
+import time
+
+import osmium.replication.server as rserv
+import osmium.replication.utils as rutils
+
+import modules.downloads as downloads
+
+logger = logging.getLogger(__name__)
+
+# Replication server for the planet file, if its header doesn't name one.
+planet_replication = "https://planet.openstreetmap.org/replication/day/"
+
+# Maximum size (kB) of diffs that are downloaded and applied at once.
+max_diff_size = 100 * 1024
+
+
+# Return the url of the replication server for osm file file_in: the map
+# target setting "replication", the url in the file header or the Geofabrik
+# updates directory of the source file.
+def replication_url(map_, file_in, use_planet):
+    if map_.get("replication"):
+        return map_["replication"]
+
+    header = rutils.get_replication_header(file_in)
+    if header.url:
+        return header.url
+
+    if use_planet:
+        return planet_replication
+    if map_["source"].endswith("-latest.osm.pbf"):
+        return map_["source"][:-len("-latest.osm.pbf")] + "-updates"
+    return None
+
+
+# Bring osm file file_in up to date by applying the replication diffs
+# (.osc.gz) published since its sequence number / timestamp. The updated file
+# replaces file_in. Return False if file_in has no replication information.
+def update(file_in, map_, use_planet):
+    start_time = time.time()
+    url = replication_url(map_, file_in, use_planet)
+    header = rutils.get_replication_header(file_in)
+    if url is None or (header.sequence is None and header.timestamp is None):
+        logger.warning("No replication information for %s" % file_in)
+        return False
+
+    server = rserv.ReplicationServer(downloads.mirror_url(url))
+    sequence = header.sequence
+    if sequence is None:
+        sequence = server.timestamp_to_sequence(header.timestamp, True)
+        if sequence is None:
+            raise Exception("No replication diffs found for %s at %s"
+                            % (file_in, url))
+
+    temp = os.path.splitext(file_in)[0] + ".part.pbf"
+    applied = 0
+    while True:
+        if os.path.exists(temp):
+            os.remove(temp)
+        # the header keeps the original url if a mirror is used
+        result = server.apply_diffs_to_file(
+            file_in, temp, sequence + 1, max_size=max_diff_size,
+            extra_headers={"osmosis_replication_base_url": url})
+        if result is None:
+            break
+
+        os.replace(temp, file_in)
+        applied += result[0] - sequence
+        sequence, newest = result
+        if sequence >= newest:
+            break
+
+    state = server.get_state_info(sequence)
+    if state is not None:
+        age = datetime.datetime.now(datetime.timezone.utc) - state.timestamp
+        logging.info("    Applied %d diffs, data is %s hours old."
+                     % (applied, round(age.total_seconds() / 3600, 1)))
+    logging.info("    %s seconds" % round((time.time() - start_time), 1))
+    return True
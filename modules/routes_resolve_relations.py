@@ -3,6 +3,8 @@ import math
 import os
 import osmium
 
+import modules.id_store as id_store
+
 logger = logging.getLogger(__name__)
 
 # if set to True, ways for mtb and cycle routes are copys of the
@@ -133,12 +135,13 @@ def del_key_list(dct, name_list):
 # Collect data necessarc for resolving route relations. Resolving route
 # relations means to pass route tags from the route with the highest priority
 # to the underlying ways. the following data is collected:
-# - ways_hk/_cy/_mtb: dict to store all relations a way is member of
-#                     {"way_id1": [{'id': '1', 'ref': '', 'route': '',
-#                                   'network': ''}, {'id': '2', ...}, ...]
-#                     {"way_id2": [...], ...}
-# - ways_nodecount: dict of all ways with their number of nodes
-#                   {"way_id1": x, "way_id2: y}
+# - ways_hk/_cy/_mtb: id_store.id_multimap to store all relations a way is
+#                     member of
+#                     way_id1 -> [{'id': '1', 'ref': '', 'route': '',
+#                                  'network': ''}, {'id': '2', ...}, ...]
+#                     way_id2 -> [...], ...
+# - ways_nodecount: id_store.id_map of all ways with their number of nodes
+#                   way_id1 -> x, way_id2 -> y
 # - osmc_symbols: dict of all ways of every relation. Later, funktion
 #                 distribute_osmc_symbols will add the information wheter a
 #                 way should receive an osmc symbol. Value 1: Way should
@@ -149,11 +152,11 @@ def del_key_list(dct, name_list):
 class collect_route_data(osmium.SimpleHandler):
     def __init__(self):
         osmium.SimpleHandler.__init__(self)
-        self.ways_hk = {}
-        self.ways_cy = {}
-        self.ways_chw = {}
-        self.ways_mtb = {}
-        self.ways_nodecount = {}
+        self.ways_hk = id_store.id_multimap()
+        self.ways_cy = id_store.id_multimap()
+        self.ways_chw = id_store.id_multimap()
+        self.ways_mtb = id_store.id_multimap()
+        self.ways_nodecount = id_store.id_map("l")
         self.osmc_symbols = {}
 
     def relation(self, r):
@@ -242,9 +245,9 @@ class collect_route_data(osmium.SimpleHandler):
             self.__add_ways(r.members, self.ways_mtb, relation, True)
 
     def way(self, w):
-        self.ways_nodecount[w.id] = len(w.nodes)
+        self.ways_nodecount.add(w.id, len(w.nodes))
 
-    # Add all members of type way to dictionary "ways", together with
+    # Add all members of type way to id_multimap "ways", together with
     # information about the parent relation (rel_dict). For mtb-routes, add
     # role forwared/backward to rel_dict.
     def __add_ways(self, members, ways, rel_dict, mtb):
@@ -256,9 +259,7 @@ class collect_route_data(osmium.SimpleHandler):
                     if m.role in {"forward", "backward"}:
                         rel_dict["mtb_role"] = m.role
 
-                if m.ref not in ways:
-                    ways[m.ref] = []
-                ways[m.ref].append(rel_dict)
+                ways.add(m.ref, rel_dict)
 
     # Get route tag value if it matches the desired network_type.
     def __get_route_tag(self, r_tags, network_type):
@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import subprocess
+import time
+
+import modules.governor as governor
+
+logger = logging.getLogger(__name__)
+
+# Resource usage of all external commands started by the current process
+# since the last call of take_records().
+records = []
+
+
+# Read I/O counters of process pid. read_bytes / write_bytes are the bytes
+# fetched from / sent to the storage layer, rchar / wchar include reads and
+# writes served by the page cache.
+def read_proc_io(pid="self"):
+    io = {}
+    try:
+        with open("/proc/%s/io" % pid) as f:
+            for line in f:
+                k, v = line.split(":")
+                io[k] = int(v)
+    except (OSError, ValueError):
+        pass
+    return io
+
+
+def io_record(io):
+    return {
+        "read_bytes": io.get("read_bytes", 0),
+        "write_bytes": io.get("write_bytes", 0),
+        "rchar": io.get("rchar", 0),
+        "wchar": io.get("wchar", 0),
+    }
+
+
+def is_osmosis(cmd):
+    if not isinstance(cmd, str):
+        cmd = " ".join(cmd)
+    return re.search(r"(^|[|;&]\s*)osmosis\s", cmd) is not None
+
+
+# Run cmd (shell command string or argument list) and return its exit code.
+# Wall time, CPU time, peak RSS and I/O bytes of the command (including all
+# processes of a shell pipeline) are appended to records.
+# osmosis gets a heap size from the governor unless env is given.
+# If feed is given, it is called with the stdin pipe of the command, e.g. to
+# stream a download into it. If feed fails, the command is killed.
+# A non-zero exit code fails the stage (see scheduler.execute_stage), unless
+# check is False.
+def run(cmd, env=None, stdout=None, feed=None, check=True):
+    start_time = time.time()
+    if env is None and is_osmosis(cmd):
+        env = governor.osmosis_env()
+
+    p = subprocess.Popen(cmd, shell=isinstance(cmd, str), env=env,
+                         stdout=stdout,
+                         stdin=subprocess.PIPE if feed is not None else None)
+
+    if feed is not None:
+        try:
+            feed(p.stdin)
+            p.stdin.close()
+        except BaseException:
+            p.kill()
+            p.wait()
+            raise
+
+    # Wait for the process to terminate without reaping it, so its I/O
+    # counters (which include all reaped child processes) can still be read.
+    try:
+        os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+        io = read_proc_io(p.pid)
+    except ChildProcessError:
+        io = {}
+
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+
+    rec = {
+        "cmd": cmd if isinstance(cmd, str) else " ".join(cmd),
+        "exit_code": p.returncode,
+        "check": check,
+        "wall": round(time.time() - start_time, 3),
+        "user": round(usage.ru_utime, 3),
+        "sys": round(usage.ru_stime, 3),
+        "max_rss_kb": usage.ru_maxrss,
+    }
+    rec.update(io_record(io))
+    records.append(rec)
+
+    return p.returncode
+
+
+# Return and clear all records of the current process.
+def take_records():
+    result = list(records)
+    records.clear()
+    return result
+
+
+# Measure resource usage of a stage that runs in the current process.
+# Python code of the stage is included as well as all external commands.
+class stage_usage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        take_records()
+        self.start_time = time.time()
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.io = read_proc_io()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        io = read_proc_io()
+        io_delta = {k: io.get(k, 0) - self.io.get(k, 0) for k in io}
+
+        self.record = {
+            "name": self.name,
+            "pid": os.getpid(),
+            "wall": round(time.time() - self.start_time, 3),
+            "user": round(usage.ru_utime - self.usage.ru_utime, 3),
+            "sys": round(usage.ru_stime - self.usage.ru_stime, 3),
+            # peak RSS of the process so far, not only of this stage
+            "max_rss_kb": usage.ru_maxrss,
+        }
+        self.record.update(io_record(io_delta))
+        self.record["commands"] = take_records()
+        return False
+
+
+def system_info():
+    mem_total = 0
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    mem_total = int(line.split()[1])
+    except OSError:
+        pass
+
+    return {
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "mem_total_kb": mem_total,
+    }
+
+
+# Write a json report with all stage records of a build.
+def write_report(file_out, map_name, stage_records, total_time):
+    report = {
+        "map": map_name,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "system": system_info(),
+        "total_wall": round(total_time, 3),
+        "stages": stage_records,
+    }
+
+    folder = os.path.dirname(file_out)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    with open(file_out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    logging.info("    Profile written to %s" % file_out)
@@ -0,0 +1,281 @@
+import concurrent.futures
+import logging
+import os
+import time
+
+import modules.functions as functions
+import modules.runner as runner
+
+logger = logging.getLogger(__name__)
+
+# Resource classes of stages. Stages that start an osmosis JVM need a lot of
+# memory (see JAVACMD_OPTIONS), all other stages (osmconvert, pyosmium,
+# pyhgtmap, ogr2ogr, downloads) are considered lightweight.
+resource_jvm = "jvm"
+resource_light = "light"
+
+
+# Directory for temporary files of a single build. Passed to stage functions
+# like a plain path, but its location doesn't influence the stage results, so
+# it is not part of the key of cached stage results.
+class scratch_dir(str):
+    pass
+
+
+# A single step of the map creation process. func(*args) is executed after
+# all stages named in depends have finished.
+# - inputs: files read by the stage (usually outputs of other stages)
+# - outputs: files created by the stage
+# - config: parameter files which influence the result (osmfilter
+#           parameters, tag-transform, poly files, ...)
+# - map_keys: keys of the map target dict used by the stage, None for all
+# inputs, config and map_keys are used to identify cached stage results.
+class stage:
+    def __init__(self, name, message, func, args, depends=(),
+                 resource=resource_light, inputs=(), outputs=(), config=(),
+                 map_keys=None):
+        self.name = name
+        self.message = message
+        self.func = func
+        self.args = args
+        self.depends = set(depends)
+        self.resource = resource
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.config = list(config)
+        self.map_keys = map_keys
+
+
+# Check that all dependencies exist and return the stages in a valid
+# execution order (same order as stage_list if possible).
+def topological_order(stage_list):
+    names = {s.name for s in stage_list}
+    for s in stage_list:
+        missing = s.depends - names
+        if missing:
+            raise Exception("Stage %s depends on unknown stage(s) %s"
+                            % (s.name, ", ".join(sorted(missing))))
+
+    order = []
+    done = set()
+    remaining = list(stage_list)
+    while remaining:
+        ready = [s for s in remaining if s.depends <= done]
+        if not ready:
+            raise Exception("Cyclic stage dependencies: %s"
+                            % ", ".join(s.name for s in remaining))
+        for s in ready:
+            order.append(s)
+            done.add(s.name)
+            remaining.remove(s)
+
+    return order
+
+
+# Intermediate files of a build that are removed as soon as all stages
+# reading them (inputs) are finished. Files no stage reads are left for the
+# caller.
+class cleanup:
+    def __init__(self, stage_list, files):
+        self.readers = {}
+        for f in files:
+            readers = {s.name for s in stage_list if f in s.inputs}
+            if readers:
+                self.readers[f] = readers
+        self.removed = set(self.readers)
+
+    # True if outputs of s are removed during the build. These are not stored
+    # in the stage cache, a hard link in the cache would keep their disk space
+    # until the cache entry is evicted.
+    def removes(self, s):
+        return any(f in self.removed for f in s.outputs)
+
+    def finished(self, s):
+        done = []
+        for f in s.inputs:
+            readers = self.readers.get(f)
+            if readers is None:
+                continue
+            readers.discard(s.name)
+            if not readers:
+                del self.readers[f]
+                done.append(f)
+        for f in done:
+            if os.path.exists(f):
+                logging.info("    Removing %s (no longer needed)" % f)
+        functions.remove_files(done)
+
+
+# Execute a stage or restore its outputs from cache. Stages without outputs
+# (e.g. downloads) are always executed. Return the resource usage of the
+# stage and its external commands (see runner.stage_usage) and, if a build
+# manifest is used, the checksums of the stage files.
+def run_stage(s, cache=None, build_manifest=None, store=True):
+    with runner.stage_usage(s.name) as usage:
+        cached = execute_stage(s, cache, store)
+
+    usage.record["resource"] = s.resource
+    usage.record["cached"] = cached
+    usage.record["input_bytes"] = sum(os.path.getsize(f) for f in s.inputs)
+    usage.record["output_bytes"] = sum(os.path.getsize(f)
+                                       for f in s.outputs)
+    if build_manifest is not None:
+        usage.record["checksums"] = build_manifest.stage_checksums(s)
+    return usage.record
+
+
+# Replace all output files in the stage arguments by their temporary names.
+def replace_outputs(args, parts):
+    result = []
+    for a in args:
+        if isinstance(a, str):
+            a = parts.get(a, a)
+        elif isinstance(a, list):
+            a = [parts.get(x, x) if isinstance(x, str) else x for x in a]
+        result.append(a)
+    return tuple(result)
+
+
+# The stage writes its outputs to temporary names, which are renamed after
+# the stage was successful. So an output file is either complete or missing,
+# even if a stage or an external tool is killed. With store=False, the outputs
+# are not added to the cache.
+def execute_stage(s, cache, store=True):
+    key = None
+    if cache is not None and s.outputs:
+        key = cache.key(s)
+        if cache.restore(key, s.outputs):
+            logging.info("    Using cached result for stage %s." % s.name)
+            return True
+
+    parts = {f: functions.part_file(f) for f in s.outputs}
+    functions.remove_files(list(parts) + list(parts.values()))
+
+    try:
+        s.func(*replace_outputs(s.args, parts))
+
+        # most stage modules only log failed commands, commands run with
+        # check=False may fail (see runner.run)
+        for r in runner.records:
+            if r["exit_code"] != 0 and r.get("check", True):
+                raise Exception("Stage %s: command failed with exit code %s: "
+                                "%s" % (s.name, r["exit_code"], r["cmd"]))
+
+        for f, part in parts.items():
+            if not os.path.exists(part):
+                raise Exception("Stage %s did not create %s" % (s.name, f))
+    except BaseException:
+        functions.remove_files(parts.values())
+        raise
+
+    for f, part in parts.items():
+        os.replace(part, f)
+
+    if key is not None and store:
+        cache.store(key, s.outputs)
+
+    return False
+
+
+# Check if the stage was already completed in a previous, interrupted run of
+# the build.
+def is_completed(s, build_manifest):
+    if build_manifest is None or not build_manifest.is_complete(s):
+        return False
+
+    logging.info("    Stage %s already completed." % s.name)
+    return True
+
+
+# Run all stages one after another in the current process.
+def run_serial(stage_list, cache, build_manifest, intermediates):
+    records = []
+    for s in topological_order(stage_list):
+        logging.info("\n*** " + s.message)
+        if not is_completed(s, build_manifest):
+            store = intermediates is None or not intermediates.removes(s)
+            records.append(run_stage(s, cache, build_manifest, store))
+            if build_manifest is not None:
+                build_manifest.add(s, records[-1].pop("checksums"))
+        if intermediates is not None:
+            intermediates.finished(s)
+    return records
+
+
+# Run stages in a process pool. A stage is started as soon as all of its
+# dependencies are finished and the limit for its resource class is not
+# reached. jobs limits the total number of stages running at the same time,
+# jvm_jobs the number of stages running osmosis.
+def run_parallel(stage_list, jobs, jvm_jobs, cache, build_manifest,
+                 intermediates):
+    pending = topological_order(stage_list)
+    done = set()
+    records = []
+    running = {}
+    limits = {resource_jvm: max(1, min(jvm_jobs, jobs)),
+              resource_light: jobs}
+    active = {resource_jvm: 0, resource_light: 0}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            for s in list(pending):
+                if len(running) >= jobs:
+                    break
+                if not s.depends <= done:
+                    continue
+                if active[s.resource] >= limits[s.resource]:
+                    continue
+
+                logging.info("\n*** " + s.message)
+                pending.remove(s)
+                if is_completed(s, build_manifest):
+                    done.add(s.name)
+                    if intermediates is not None:
+                        intermediates.finished(s)
+                    continue
+
+                store = intermediates is None or not intermediates.removes(s)
+                running[pool.submit(run_stage, s, cache, build_manifest,
+                                    store)] = (s, time.time())
+                active[s.resource] += 1
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for f in finished:
+                s, start_time = running.pop(f)
+                active[s.resource] -= 1
+                try:
+                    records.append(f.result())
+                    if build_manifest is not None:
+                        build_manifest.add(s, records[-1].pop("checksums"))
+                except BaseException as e:
+                    logger.error("Error in stage %s: %s" % (s.name, e))
+                    for r in running:
+                        r.cancel()
+                    raise
+
+                done.add(s.name)
+                logging.info("    Stage %s finished after %s seconds"
+                             % (s.name, round((time.time() - start_time), 1)))
+                if intermediates is not None:
+                    intermediates.finished(s)
+
+    return records
+
+
+# Run all stages and return a list with their resource usage records. Stages
+# that are listed as completed in build_manifest are skipped. Intermediate
+# files in remove are deleted as soon as the last stage reading them is
+# finished (see cleanup).
+def run(stage_list, jobs=1, jvm_jobs=1, cache=None, build_manifest=None,
+        remove=None):
+    intermediates = None
+    if remove is not None:
+        intermediates = cleanup(stage_list, remove)
+
+    if jobs <= 1:
+        return run_serial(stage_list, cache, build_manifest, intermediates)
+    else:
+        return run_parallel(stage_list, jobs, jvm_jobs, cache,
+                            build_manifest, intermediates)
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+import types
+
+import modules.downloads as downloads
+import modules.scheduler as scheduler
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks read for hashing
+block_size = 1024 * 1024
+
+
+# Return a hash of the complete file content. Results are remembered in a
+# small sidecar file per path, together with size and modification time, so
+# every file version is only hashed once (large source files only once after
+# each download or update). Files installed from downloaded resources
+# (tag-mapping, themes, land polygons, ...) are identified by their remote
+# version (ETag / Last-Modified) instead.
+def fingerprint(path, memo_dir=None):
+    version = downloads.file_version(path)
+    if version is not None:
+        return version
+
+    st = os.stat(path)
+
+    memo = None
+    if memo_dir is not None:
+        name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        memo = os.path.join(memo_dir, name)
+        try:
+            with open(memo) as f:
+                size, mtime, digest = f.read().split()
+            if int(size) == st.st_size and int(mtime) == st.st_mtime_ns:
+                return digest
+        except (OSError, ValueError):
+            pass
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block_size), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    if memo is not None:
+        os.makedirs(memo_dir, exist_ok=True)
+        temp = memo + ".%d" % os.getpid()
+        with open(temp, "w") as f:
+            f.write("%d %d %s" % (st.st_size, st.st_mtime_ns, digest))
+        os.replace(temp, memo)
+
+    return digest
+
+
+# Return a hash of the source code of the module that defines func and of all
+# modules of this project it (indirectly) imports.
+def code_version(func):
+    h = hashlib.sha256()
+    todo = [sys.modules[func.__module__]]
+    seen = set()
+    while todo:
+        m = todo.pop()
+        if m.__name__ in seen:
+            continue
+        seen.add(m.__name__)
+        with open(m.__file__, "rb") as f:
+            h.update(f.read())
+        for v in vars(m).values():
+            if isinstance(v, types.ModuleType) and \
+                    v.__name__.startswith("modules."):
+                todo.append(v)
+    return h.hexdigest()
+
+
+# Replace the map target dict in the stage arguments by the subset of keys the
+# stage actually uses, so unrelated settings don't invalidate a stage. The
+# per-build scratch directory is replaced by a constant.
+def relevant_args(s):
+    args = []
+    for a in s.args:
+        if isinstance(a, dict) and s.map_keys is not None:
+            a = {k: a.get(k) for k in s.map_keys}
+        elif isinstance(a, scheduler.scratch_dir):
+            a = "scratch_dir"
+        args.append(a)
+    return args
+
+
+# Cache for stage outputs. Each cache entry is a directory named by a key
+# which is calculated from the stage code, its arguments and the content of
+# all input and config files. Outputs are hard linked into the cache
+# directory if possible, so caching doesn't need additional disk space as long
+# as the intermediate files exist.
+class stage_cache:
+    def __init__(self, cache_dir="tmp/cache/", max_size=50):
+        self.cache_dir = cache_dir
+        self.memo_dir = os.path.join(cache_dir, "fingerprints")
+        # maximum cache size in GB
+        self.max_size = max_size
+
+    def key(self, s):
+        data = {
+            "stage": s.name,
+            "code": code_version(s.func),
+            "args": relevant_args(s),
+            "inputs": [fingerprint(f, self.memo_dir) for f in s.inputs],
+            "config": [fingerprint(f, self.memo_dir) for f in s.config
+                       if os.path.exists(f)],
+        }
+        data = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.cache_dir, "stages", key)
+
+    # Link or copy all cached outputs to their target paths. Return False if
+    # the cache does not contain a complete entry for key.
+    def restore(self, key, outputs):
+        entry = self.entry(key)
+        if not os.path.isdir(entry):
+            return False
+
+        cached = [os.path.join(entry, str(i)) for i in range(len(outputs))]
+        if not all(os.path.exists(c) for c in cached):
+            return False
+
+        for c, o in zip(cached, outputs):
+            if os.path.exists(o):
+                os.remove(o)
+            link_or_copy(c, o)
+
+        # remember last usage for cache eviction
+        os.utime(entry)
+        return True
+
+    def store(self, key, outputs):
+        entry = self.entry(key)
+        temp = entry + ".%d" % os.getpid()
+        if os.path.isdir(temp):
+            shutil.rmtree(temp)
+        os.makedirs(temp)
+
+        for i, o in enumerate(outputs):
+            link_or_copy(o, os.path.join(temp, str(i)))
+
+        if os.path.isdir(entry):
+            shutil.rmtree(temp)
+        else:
+            os.rename(temp, entry)
+
+    # Delete least recently used cache entries until the cache size is below
+    # max_size.
+    def evict(self):
+        stages_dir = os.path.join(self.cache_dir, "stages")
+        if not os.path.isdir(stages_dir):
+            return
+
+        entries = []
+        total = 0
+        for e in os.listdir(stages_dir):
+            path = os.path.join(stages_dir, e)
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+
+        limit = self.max_size * 1024**3
+        for mtime, size, path in sorted(entries):
+            if total <= limit:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            logging.info("    Removed cache entry from %s (%s MB)"
+                         % (time.ctime(mtime), round(size / 1024**2)))
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
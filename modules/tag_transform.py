@@ -0,0 +1,441 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+
+import modules.functions as functions
+import modules.merge as merge
+
+logger = logging.getLogger(__name__)
+
+# Tag-transform file of the map (osmosis --tag-transform format)
+tt_file = "tt_tm/tt_andromaps.xml"
+
+# Hashes of the tag-transform files for which both engines produced the same
+# tags (see utilities/compare_tag_transform.py)
+verified_file = "tmp/cache/tag_transform_verified.json"
+
+# Object types of the match attribute type, empty: all types
+types = {"": ("n", "w", "r"), "node": ("n",), "way": ("w",),
+         "relation": ("r",)}
+
+# Characters of a regular expression that is not a literal key
+regex_chars = set(".^$*+?{}[]\\|()")
+
+# {n} arguments of osmosis output templates (java.text.MessageFormat)
+template_arg = re.compile(r"\{(\d+)\}")
+
+# Compiled tag-transform files {abspath: (mtime_ns, size, transform)}
+loaded = {}
+
+
+# Return the compiled tag-transform of tt_path. The file is only compiled
+# again when it was changed since the last call.
+def load(tt_path):
+    path = os.path.abspath(tt_path)
+    st = os.stat(path)
+    cached = loaded.get(path)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+
+    tt = transform(tt_path)
+    loaded[path] = (st.st_mtime_ns, st.st_size, tt)
+    return tt
+
+
+# Regular expression of a tag or notag element. Like java.util.regex.Matcher
+# matches(), the whole key / value has to match.
+def compile_regex(s):
+    try:
+        return re.compile(s)
+    except re.error as e:
+        raise ValueError("Unsupported regular expression %s: %s" % (s, e))
+
+
+def is_literal(s):
+    return not any(c in regex_chars for c in s)
+
+
+# Match of a tag element: match_id and the groups of the key and value
+# regex (group 0 is the whole key / value). A notag element matches with
+# an empty key.
+class tag_match:
+    def __init__(self, match_id, key, value):
+        self.match_id = match_id
+        self.key = key
+        self.value = value
+
+
+null_match = tag_match(None, (), ())
+
+
+# Matcher of <tag k="regex" v="regex" match_id="id"/>: one match per
+# matching tag.
+class tag_matcher:
+    def __init__(self, e):
+        self.k = e.get("k", "")
+        self.key = compile_regex(self.k)
+        self.value = compile_regex(e.get("v", ""))
+        self.match_id = e.get("match_id") or None
+        if is_literal(self.k):
+            self.keys = {self.k}
+        else:
+            self.keys = None
+
+    def match(self, tags, t):
+        if self.keys is not None:
+            v = tags.get(self.k)
+            if v is None:
+                return []
+            vm = self.value.fullmatch(v)
+            if vm is None:
+                return []
+            return [tag_match(self.match_id, (self.k,),
+                              (vm.group(0),) + vm.groups())]
+
+        matches = []
+        for k, v in tags.items():
+            km = self.key.fullmatch(k)
+            if km is not None:
+                vm = self.value.fullmatch(v)
+                if vm is not None:
+                    matches.append(tag_match(self.match_id,
+                                             (km.group(0),) + km.groups(),
+                                             (vm.group(0),) + vm.groups()))
+        return matches
+
+
+# Matcher of <notag k="regex" v="regex"/>: matches if no tag matches.
+class notag_matcher:
+    keys = None
+
+    def __init__(self, e):
+        self.key = compile_regex(e.get("k", ""))
+        self.value = compile_regex(e.get("v", ""))
+
+    def match(self, tags, t):
+        for k, v in tags.items():
+            if self.key.fullmatch(k) and self.value.fullmatch(v):
+                return []
+        return [null_match]
+
+
+# Matcher of <match mode="and|or" type="node|way|relation"> (and <find>)
+# with tag, notag and nested match elements. keys is a set of keys of which
+# at least one is needed for a match or None if the matcher can match
+# objects with any tags.
+class group_matcher:
+    def __init__(self, e):
+        self.mode = e.get("mode", "and")
+        if self.mode not in ("and", "or"):
+            raise ValueError("Unsupported match mode %s" % self.mode)
+        type_ = e.get("type", "")
+        if type_ not in types:
+            raise ValueError("Unsupported match type %s" % type_)
+        self.types = types[type_]
+        for a in ("user", "uid"):
+            if e.get(a):
+                raise ValueError("Unsupported match attribute %s" % a)
+
+        self.matchers = []
+        for c in e:
+            if c.tag == "tag":
+                self.matchers.append(tag_matcher(c))
+            elif c.tag == "notag":
+                self.matchers.append(notag_matcher(c))
+            elif c.tag == "match":
+                self.matchers.append(group_matcher(c))
+            else:
+                raise ValueError("Unsupported match element %s" % c.tag)
+
+        keys = [m.keys for m in self.matchers]
+        if self.mode == "and":
+            known = [k for k in keys if k is not None]
+            self.keys = min(known, key=len) if known else None
+        elif keys and all(k is not None for k in keys):
+            self.keys = set().union(*keys)
+        else:
+            self.keys = None
+
+    def match(self, tags, t):
+        if t not in self.types:
+            return []
+        matches = []
+        for m in self.matchers:
+            found = m.match(tags, t)
+            if not found and self.mode == "and":
+                return []
+            matches += found
+        return matches
+
+
+# Output elements of a translation. Each adds tags of the matched object
+# (tags) and the matches to new_tags.
+def copy_all(tags, new_tags, matches):
+    new_tags.update(tags)
+
+
+def copy_matched(tags, new_tags, matches):
+    for m in matches:
+        if m.key:
+            new_tags[m.key[0]] = m.value[0]
+
+
+def copy_unmatched(tags, new_tags, matches):
+    matched = set(m.key[0] for m in matches if m.key)
+    for k, v in tags.items():
+        if k not in matched:
+            new_tags[k] = v
+
+
+# Template of a tag output like java.text.MessageFormat: {n} is replaced by
+# group n of the match, {n} without group n is kept and groups that did not
+# participate in the match become "null". '' is a literal quote.
+def compile_template(s):
+    parts = []
+    pos = 0
+    for a in template_arg.finditer(s):
+        parts.append(s[pos:a.start()])
+        parts.append(int(a.group(1)))
+        pos = a.end()
+    parts.append(s[pos:])
+    for p in parts:
+        if isinstance(p, str) and ("{" in p or "}" in p or "'" in p):
+            raise ValueError("Unsupported output template %s" % s)
+    return parts
+
+
+def format_template(parts, args):
+    result = []
+    for p in parts:
+        if isinstance(p, str):
+            result.append(p)
+        elif p < len(args):
+            result.append("null" if args[p] is None else args[p])
+        else:
+            result.append("{%d}" % p)
+    return "".join(result)
+
+
+# <tag k="template" v="template" from_match="id"/>: one tag per match with
+# match_id id, a single tag without from_match.
+class tag_output:
+    def __init__(self, e):
+        self.key = compile_template(e.get("k", ""))
+        self.value = compile_template(e.get("v", ""))
+        self.from_match = e.get("from_match") or None
+
+    def __call__(self, tags, new_tags, matches):
+        if self.from_match is None:
+            new_tags[format_template(self.key, ())] = \
+                format_template(self.value, ())
+            return
+        for m in matches:
+            if m.match_id == self.from_match:
+                new_tags[format_template(self.key, m.key)] = \
+                    format_template(self.value, m.value)
+
+
+outputs = {"copy-all": copy_all, "copy-matched": copy_matched,
+           "copy-unmatched": copy_unmatched}
+
+
+# <translation> with match, optional find and output elements. If the match
+# matches, the tags of the object are replaced by the outputs. The matches
+# of find are added to the matches for the outputs.
+class translation:
+    def __init__(self, e):
+        self.name = e.findtext("name", "")
+        self.matcher = None
+        self.finder = None
+        self.outputs = []
+        for c in e:
+            if c.tag == "match":
+                self.matcher = group_matcher(c)
+            elif c.tag == "find":
+                self.finder = group_matcher(c)
+            elif c.tag == "output":
+                for o in c:
+                    if o.tag == "tag":
+                        self.outputs.append(tag_output(o))
+                    elif o.tag in outputs:
+                        self.outputs.append(outputs[o.tag])
+                    else:
+                        raise ValueError("Unsupported output element %s in "
+                                         "translation %s" % (o.tag,
+                                                             self.name))
+            elif c.tag not in ("name", "description"):
+                raise ValueError("Unsupported element %s in translation %s"
+                                 % (c.tag, self.name))
+        if self.matcher is None:
+            raise ValueError("Translation %s without match" % self.name)
+
+    # Return the new tags or None if the translation doesn't match.
+    def apply(self, tags, t):
+        matches = self.matcher.match(tags, t)
+        if not matches:
+            return None
+        if self.finder is not None:
+            matches = matches + self.finder.match(tags, t)
+        new_tags = {}
+        for o in self.outputs:
+            o(tags, new_tags, matches)
+        return new_tags
+
+
+# Translations of an osmosis tag-transform file, applied in file order. Each
+# translation works on the tags produced by the previous ones, like osmosis
+# --tag-transform.
+#
+# Most translations need a tag with a certain key, so for every object type
+# the translations are indexed by these keys. Only translations indexed by a
+# key of the object and those that can match any object are tested. After a
+# translation changed the tags, the remaining candidates are looked up again.
+class transform:
+    def __init__(self, tt_path):
+        try:
+            root = ET.parse(tt_path).getroot()
+        except ET.ParseError as e:
+            raise ValueError("Invalid tag-transform file %s: %s"
+                             % (tt_path, e))
+        self.translations = [translation(e) for e in root.iter("translation")]
+
+        # {type: {key: [translation index]}}, {type: [translation index]}
+        self.by_key = {t: {} for t in types[""]}
+        self.any_tags = {t: [] for t in types[""]}
+        for i, tr in enumerate(self.translations):
+            for t in tr.matcher.types:
+                if tr.matcher.keys is None:
+                    self.any_tags[t].append(i)
+                else:
+                    for k in tr.matcher.keys:
+                        self.by_key[t].setdefault(k, []).append(i)
+
+        # objects without tags, most nodes
+        self.empty = {t: self.apply(t, {}) for t in types[""]}
+
+    def candidates(self, t, tags, after):
+        by_key = self.by_key[t]
+        found = set(i for i in self.any_tags[t] if i > after)
+        for k in tags:
+            for i in by_key.get(k, ()):
+                if i > after:
+                    found.add(i)
+        return sorted(found)
+
+    # Return the transformed tags (dict) of an object of type t or None if
+    # no translation matches.
+    def apply(self, t, tags):
+        result = None
+        todo = self.candidates(t, tags, -1)
+        pos = 0
+        while pos < len(todo):
+            i = todo[pos]
+            pos += 1
+            new_tags = self.translations[i].apply(tags, t)
+            if new_tags is None:
+                continue
+            result = new_tags
+            if new_tags != tags:
+                tags = new_tags
+                todo = self.candidates(t, tags, i)
+                pos = 0
+        return result
+
+    def transform_tags(self, t, tags):
+        if not tags:
+            return self.empty[t]
+        return self.apply(t, tags)
+
+
+# Merge the osm files of file_list and apply the tag-transform file to all
+# objects, the result is written to file_out (pbf without metadata). Like
+# osmosis --merge, objects with the same type and id are taken from the
+# first file of file_list.
+def transform_files(file_list, file_out, tt_path):
+    tt = load(tt_path)
+    with functions.osm_writer(file_out) as writer:
+        for o in merge.objects(file_list, last_wins=False):
+            tags = o.tags
+            new_tags = tt.transform_tags(o.type_str(),
+                                         dict(tags) if len(tags) else {})
+            if new_tags is None:
+                writer.add(o)
+            else:
+                writer.add(o.replace(tags=new_tags))
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_verified():
+    if not os.path.exists(verified_file):
+        return []
+    try:
+        with open(verified_file) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring invalid file %s: %s" % (verified_file, e))
+        return []
+
+
+# True if both engines produced the same tags with the current content of
+# tt_path.
+def is_verified(tt_path):
+    return (os.path.exists(tt_path)
+            and file_hash(tt_path) in read_verified())
+
+
+def set_verified(tt_path):
+    verified = read_verified()
+    h = file_hash(tt_path)
+    if h not in verified:
+        verified.append(h)
+        os.makedirs(os.path.dirname(verified_file), exist_ok=True)
+        with open(verified_file, "w") as f:
+            json.dump(verified, f)
+
+
+# Engine of the map target option "tag_transform_engine". "auto" is
+# pyosmium if utilities/compare_tag_transform.py found the same tags as
+# osmosis for the current tag-transform file, osmosis otherwise.
+def select_engine(option):
+    if option == "auto":
+        return "pyosmium" if is_verified(tt_file) else "osmosis"
+    return option
+
+
+# Merge the files of file_list and apply the tag-transform with the engine
+# of the map target ("auto", "pyosmium" or "osmosis", see select_engine()).
+# The pyosmium engine falls back to osmosis if the tag-transform file uses
+# elements it doesn't support.
+def run(file_list, file_out, engine, silent):
+    try:
+        start_time = time.time()
+
+        engine = select_engine(engine)
+        if engine == "pyosmium":
+            try:
+                load(tt_file)
+            except ValueError as e:
+                logger.warning(f"Tag-transform with osmosis: {e}")
+                engine = "osmosis"
+
+        if engine == "pyosmium":
+            transform_files(file_list, file_out, tt_file)
+        else:
+            functions.merge_map_and_tt(file_list, file_out, True)
+
+        if not silent:
+            logging.info("    %s seconds" % round((time.time() - start_time), 1))
+    except Exception as e:
+        logger.error(f"Error in run/tag_transform.py: {e}")
+        raise
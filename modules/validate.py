@@ -0,0 +1,249 @@
+import logging
+import time
+
+import osmium
+
+import modules.merge as merge
+import modules.reduce_data as reduce_data
+import modules.relevance as relevance
+
+logger = logging.getLogger(__name__)
+
+# id ranges of the map data (see README, OSM ID ranges): (category, types,
+# first id, last id + 1). Nodes created by osmconvert --all-to-nodes get the
+# offset once (ways) or twice (relations).
+id_ranges = [
+    ("map border / land polygons", "nwr", -10000000000, 0),
+    ("land polygons (grid split)", "nwr", -20000000000, -10000000000),
+    ("sea area", "nwr", -30000000000, -20000000000),
+    ("administrative boundaries", "w", -40000000000, -30000000000),
+    ("pistes", "w", -50000000000, -40000000000),
+    ("routes", "w", -60000000000, -50000000000),
+    ("resolved superroutes", "r", -70000000000, -60000000000),
+    ("crags", "nwr", -80000000000, -70000000000),
+    ("osm data", "nwr", 1, 50000000000),
+    ("contour lines", "nw", 50000000000, 100000000000),
+    ("polygon labels / building housenumbers", "n", 100000000000,
+     1000000000000),
+]
+
+# Ways and relations above these sizes are reported as warnings, they slow
+# down the mapwriter (see utilities/identify_large_*.py).
+max_way_nodes = 100000
+max_relation_members = 10000
+
+# Number of example ids per problem in the report
+max_examples = 10
+
+
+# Set of osm ids of one type, IdSet only stores ids >= 0.
+class id_set:
+    def __init__(self):
+        self.positive = osmium.index.IdSet()
+        self.negative = osmium.index.IdSet()
+
+    def set(self, oid):
+        if oid >= 0:
+            self.positive.set(oid)
+        else:
+            self.negative.set(-oid)
+
+    def __contains__(self, oid):
+        if oid >= 0:
+            return oid in self.positive
+        return -oid in self.negative
+
+
+# Problems found in the map data: {description: [count, example ids]}.
+# Errors make the mapwriter fail or produce a broken map, warnings are only
+# reported.
+class report:
+    def __init__(self):
+        self.errors = {}
+        self.warnings = {}
+
+    def add(self, problems, description, oid):
+        p = problems.setdefault(description, [0, []])
+        p[0] += 1
+        if len(p[1]) < max_examples:
+            p[1].append(oid)
+
+    def error(self, description, oid):
+        self.add(self.errors, description, oid)
+
+    def warning(self, description, oid):
+        self.add(self.warnings, description, oid)
+
+    def lines(self):
+        lines = []
+        for title, problems in (("Errors", self.errors),
+                                ("Warnings", self.warnings)):
+            lines.append("%s: %d" % (title, sum(p[0] for p in
+                                                problems.values())))
+            for description, (count, examples) in problems.items():
+                lines.append("    %s: %d (e.g. %s)"
+                             % (description, count,
+                                ", ".join(str(e) for e in examples)))
+        return lines
+
+
+# Single pass over the merged map data. Nodes are stored before ways and ways
+# before relations, so references of ways are checked against the nodes read
+# so far. Member relations can follow their parent, they are checked at the
+# end. Most objects are nodes of the osm data, so the checks of an object
+# with an id in the osm data range and few tags only need a few comparisons.
+class check_map_data(osmium.SimpleHandler):
+    def __init__(self, rules, threshold):
+        osmium.SimpleHandler.__init__(self)
+        self.rules = rules
+        self.threshold = threshold
+        self.report = report()
+        self.ids = {t: id_set() for t in merge.type_order}
+        self.node_ids = self.ids["n"].positive
+        self.member_relations = []
+        # type and id of the last object
+        self.type = None
+        self.last = None
+        # objects of a type after objects of a later type (e.g. nodes after
+        # ways)
+        self.unsorted_types = False
+        self.count = 0
+        # {type: [(first id, last id + 1)]}
+        self.ranges = {t: [(lo, hi) for name, types, lo, hi in id_ranges
+                           if t in types] for t in merge.type_order}
+        self.osm_min, self.osm_max = [r[2:] for r in id_ranges
+                                      if r[0] == "osm data"][0]
+
+    # Sort order, duplicates and id range of object oid of type t. These are
+    # warnings, the mapwriter reads unsorted data and the producers of the
+    # intermediate files (pyhgtmap, osmconvert) don't guarantee them.
+    def check_id(self, t, oid):
+        if t != self.type:
+            if self.type is not None and \
+                    merge.type_order[t] < merge.type_order[self.type]:
+                self.report.warning("not sorted by type and id", t + str(oid))
+                self.unsorted_types = True
+            self.type = t
+            self.last = oid - 1
+        if oid <= self.last:
+            if oid == self.last:
+                self.report.warning("duplicate id", t + str(oid))
+            else:
+                self.report.warning("not sorted by type and id",
+                                    t + str(oid))
+        self.last = oid
+        self.ids[t].set(oid)
+
+        if not self.osm_min <= oid < self.osm_max and \
+                not any(lo <= oid < hi for lo, hi in self.ranges[t]):
+            self.report.warning("id outside the documented id ranges",
+                                t + str(oid))
+
+    def node(self, n):
+        self.count += 1
+        oid = n.id
+        if self.type == "n" and self.last < oid and \
+                self.osm_min <= oid < self.osm_max:
+            self.last = oid
+            self.node_ids.set(oid)
+        else:
+            self.check_id("n", oid)
+
+        tags = n.tags
+        if len(tags) > self.threshold and \
+                self.rules.count_mapped("n", tags) > self.threshold:
+            self.report.warning("nodes above the tag limit", "n%d" % oid)
+
+    def way(self, w):
+        self.count += 1
+        oid = w.id
+        self.check_id("w", oid)
+
+        tags = w.tags
+        if len(tags) > self.threshold and \
+                self.rules.count_mapped("w", tags) > self.threshold:
+            self.report.error("ways above the tag limit", "w%d" % oid)
+
+        nodes = w.nodes
+        if len(nodes) > max_way_nodes:
+            self.report.warning("ways with more than %d nodes"
+                                % max_way_nodes, "w%d" % oid)
+        node_ids = self.node_ids
+        for n in nodes:
+            ref = n.ref
+            if ref < 0:
+                found = ref in self.ids["n"]
+            else:
+                found = ref in node_ids
+            if not found:
+                self.report.error("ways with missing nodes", "w%d" % oid)
+                break
+
+    def relation(self, r):
+        self.count += 1
+        oid = r.id
+        self.check_id("r", oid)
+
+        members = r.members
+        if len(members) > max_relation_members:
+            self.report.warning("relations with more than %d members"
+                                % max_relation_members, "r%d" % oid)
+        missing = False
+        for m in members:
+            if m.type == "r":
+                self.member_relations.append((oid, m.ref))
+            elif m.ref not in self.ids[m.type]:
+                missing = True
+        # usual for relations that leave the area of interest
+        if missing:
+            self.report.warning("relations with missing members",
+                                "r%d" % oid)
+
+    def check_member_relations(self):
+        missing = set()
+        for rid, ref in self.member_relations:
+            if ref not in self.ids["r"] and rid not in missing:
+                missing.add(rid)
+                self.report.warning("relations with missing member relations",
+                                    "r%d" % rid)
+        self.member_relations = []
+
+
+# Check the merged map data file_in before the mapwriter starts: sort order
+# and duplicate ids, the id ranges, references of ways and relations, the
+# tag limit and the size of ways and relations. The report is written to
+# file_out. If errors are found, an exception stops the build.
+def run(file_in, file_out):
+    try:
+        start_time = time.time()
+
+        rules = relevance.load(
+            ["tt_tm/tagmapping-urban.xml", "tt_tm/tagmapping-min.xml"],
+            ["themes/Elevate/Elevate.xml", "themes/Elevate/Elements.xml"])
+
+        cm = check_map_data(rules, reduce_data.threshold)
+        cm.apply_file(file_in)
+        cm.check_member_relations()
+
+        r = cm.report
+        if cm.unsorted_types and "ways with missing nodes" in r.errors:
+            # nodes of ways were only checked against the nodes read before
+            # the way
+            r.warnings["ways with missing nodes (unsorted data)"] = \
+                r.errors.pop("ways with missing nodes")
+        if cm.count == 0:
+            r.error("no objects", file_in)
+        lines = ["%s: %d objects" % (file_in, cm.count)] + r.lines()
+        with open(file_out, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        for line in lines[1:]:
+            logging.info("    " + line)
+
+        if r.errors:
+            raise Exception("Invalid map data %s, see %s"
+                            % (file_in, file_out))
+
+        logging.info("    %s seconds" % round((time.time() - start_time), 1))
+    except Exception as e:
+        logger.error(f"Error in run/validate.py: {e}")
+        raise
@@ -1,141 +1,392 @@
 #!/usr/bin/python3
 
 import argparse
+import concurrent.futures
+import os
+import shutil
 import sys
+import tempfile
 import time
 import logging
 
 import modules.admin_relations as admin_relations
 import modules.contour as contour
 import modules.crags_os_open_data as crags
+import modules.downloads as downloads
 import modules.functions as functions
+import modules.governor as governor
 import modules.land_sea as land_sea
+import modules.manifest as manifest
 import modules.map_border as map_border
 import modules.map_targets as map_targets
+import modules.merge as merge
 import modules.peaks_saddles as peaks_saddles
 import modules.pistes as pistes
 import modules.places_popcat as places_popcat
+import modules.planner as planner
 import modules.poly_nodes as poly_nodes
+import modules.polygon as polygon
+import modules.prefilter as prefilter
 import modules.reduce_data as reduce_data
 import modules.routes as routes
+import modules.runner as runner
+import modules.scheduler as scheduler
+import modules.stage_cache as stage_cache
+import modules.tag_transform as tag_transform
+import modules.validate as validate
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
-def run(map_name, result_map, use_planet, keep_temp, delete_source):
-    start_t = time.time()
+# Extract of the area of interest of map_. osmfilter reads o5m, so the extract
+# is written as o5m if osmconvert extracts it for the osmfilter engine. With
+# shared, the extract is written by osmium extract for several map targets
+# (batch mode), which only writes pbf.
+def extracted_file(map_, work_dir, shared=False):
+    ext = ".pbf"
+    if (not shared and map_["extract_engine"] == "osmconvert"
+            and map_["filter_engine"] == "osmfilter"):
+        ext = ".o5m"
+    return os.path.join(work_dir, map_["name"] + "_extr" + ext)
 
-    map_ = map_targets.map_targets[map_name]
-    tmp_files = set()
 
-    logging.info("\n*** Downloading OSM source file")
-    data_source = functions.download_osm_source(map_, use_planet)
+# Create a new scratch directory below base_dir for the temporary files of a
+# single build. As every build uses its own directory, several builds can run
+# on the same host at the same time.
+def make_scratch_dir(base_dir, name):
+    if not os.path.isdir(base_dir):
+        os.makedirs(base_dir)
+    return scheduler.scratch_dir(
+        tempfile.mkdtemp(prefix="build_" + name + "_", dir=base_dir))
 
-    logging.info("\n*** Downloading auxiliary sources (tag-transform/tag-mapping/...)")
-    functions.download_auxiliary_sources()
 
-    logging.info("\n*** Extracting area of interest")
-    data_extracted = "tmp/" + map_["name"] + "_extr.o5m"
-    functions.extract_target_area(data_source, map_, data_extracted)
-    tmp_files.add(data_extracted)
+def remove_scratch_dir(scratch, args):
+    if not args.keep_temp:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def profile_file(name):
+    return ("tmp/profiles/" + name + "_" + time.strftime("%Y%m%d_%H%M%S")
+            + ".json")
+
+
+# Manifest of completed stages. With --resume, stages completed by a previous
+# interrupted run are skipped.
+def get_manifest(name, args):
+    path = os.path.join(args.work_dir, name + "_manifest.json")
+    return manifest.manifest(path, args.resume, "tmp/cache/fingerprints/")
+
+
+def get_cache(args):
+    if args.no_cache:
+        return None
+    return stage_cache.stage_cache("tmp/cache/", args.cache_size)
 
-    logging.info("\n*** Removing unnecessary tags")
-    data_filtered = "tmp/" + map_["name"] + "_extr_filt.pbf"
-    functions.filter_data(data_extracted, map_, data_filtered)
-    tmp_files.add(data_filtered)
 
-    logging.info("\n*** Creating map border")
-    map_border_ways = "tmp/" + map_["name"] + "_map_border.osm"
-    map_border.run(map_, map_border_ways)
+# Return all stages to create map result_map for map target map_, the set of
+# intermediate files and the osm source file (None if data_extracted is
+# given). args are the command line options, scratch is the scratch directory
+# of the build. If data_extracted is given, the area of interest was already
+# extracted from the osm source file (see run_batch()).
+def create_stages(map_, result_map, args, scratch, data_extracted=None):
+    tmp_files = set()
+    stages = []
+    jvm = scheduler.resource_jvm
+    work = os.path.join(args.work_dir, map_["name"])
+
+    poly_file = "polygons/" + map_["name"] + ".poly"
+    tt = tag_transform.tt_file
+    # only the osmosis tag-transform engine starts a JVM
+    if tag_transform.select_engine(map_["tag_transform_engine"]) == "osmosis":
+        tt_resource = jvm
+    else:
+        tt_resource = scheduler.resource_light
+    osmfilter_dir = "osmfilter_parameters/"
+    pps_dir = "popcat_peaks_saddles/"
+
+    data_source = None
+    extract_depends = []
+    if data_extracted is None:
+        data_source = functions.osm_source(map_, args.planet)[1]
+        extract_input = data_source
+        if args.stream and not os.path.exists(data_source):
+            # download and pre-extract in one pass, the pre-extract is
+            # written by the stage itself (no stage outputs), as it depends
+            # on the downloaded file
+            extract_input = work + "_pre_extract.pbf"
+            stages.append(scheduler.stage(
+                "source", "Downloading OSM source file and pre-extracting "
+                "area of interest",
+                functions.pre_extract_osm_source,
+                (map_, args.planet, extract_input)))
+            tmp_files.add(extract_input)
+        else:
+            stages.append(scheduler.stage(
+                "source", "Downloading OSM source file",
+                functions.download_osm_source,
+                (map_, args.planet, args.update)))
+
+    stages.append(scheduler.stage(
+        "auxiliary", "Downloading auxiliary sources "
+        "(tag-transform/tag-mapping/...)",
+        functions.download_auxiliary_sources, (map_,),
+        map_keys=["has_sea", "has_crags"]))
+
+    if data_extracted is None:
+        data_extracted = extracted_file(map_, args.work_dir)
+        stages.append(scheduler.stage(
+            "extract", "Extracting area of interest",
+            functions.extract_target_area,
+            (extract_input, map_, data_extracted, scratch),
+            ["source"],
+            inputs=[extract_input], outputs=[data_extracted],
+            config=[poly_file],
+            map_keys=["name", "use_polygon_shape", "extract_engine"]))
+        extract_depends = ["extract"]
+    tmp_files.add(data_extracted)
+
+    # one pass over the extract creates the filtered data and the
+    # sub-extracts of the stages that select objects by osmfilter parameters
+    data_filtered = work + "_extr_filt.pbf"
+    poly_label_data = work + "_poly_label_data.pbf"
+    building_relation_data = work + "_building_relation_data.pbf"
+    peak_saddle_data = work + "_peak_saddle_data.pbf"
+    popcat_data = work + "_popcat_data.pbf"
+    filter_params = [osmfilter_dir + "tags_filter_data.txt",
+                     osmfilter_dir + "poly_labels.txt",
+                     osmfilter_dir + "building_relations_step_1.txt",
+                     osmfilter_dir + "peaks_saddles.txt",
+                     osmfilter_dir + "popcat_nodes.txt"]
+    filter_outputs = [data_filtered, poly_label_data, building_relation_data,
+                      peak_saddle_data, popcat_data]
+    stages.append(scheduler.stage(
+        "filter", "Removing unnecessary tags and pre-filtering stage data",
+        prefilter.run,
+        (data_extracted, filter_params, filter_outputs,
+         map_["filter_engine"], scratch),
+        extract_depends,
+        inputs=[data_extracted], outputs=filter_outputs,
+        config=filter_params, map_keys=[]))
+    tmp_files.update(filter_outputs)
+
+    map_border_ways = work + "_map_border.osm"
+    stages.append(scheduler.stage(
+        "map_border", "Creating map border",
+        map_border.run, (map_, map_border_ways),
+        outputs=[map_border_ways], config=[poly_file],
+        map_keys=["name", "use_polygon_shape"]))
     tmp_files.add(map_border_ways)
 
-    logging.info("\n*** Resolving admin relations")
-    admin_ways = "tmp/" + map_["name"] + "_admin_ways.pbf"
-    admin_relations.run(data_filtered, admin_ways)
+    admin_ways = work + "_admin_ways.pbf"
+    stages.append(scheduler.stage(
+        "admin", "Resolving admin relations",
+        admin_relations.run, (data_filtered, admin_ways, scratch),
+        ["filter"], jvm,
+        inputs=[data_filtered], outputs=[admin_ways]))
     tmp_files.add(admin_ways)
 
-    logging.info("\n*** Creating and filtering polygon label nodes")
-    poly_label_nodes = "tmp/" + map_["name"] + "_poly_label_nodes.pbf"
-    poly_nodes.run(data_extracted, map_, poly_label_nodes)
+    poly_label_nodes = work + "_poly_label_nodes.pbf"
+    stages.append(scheduler.stage(
+        "poly_nodes", "Creating and filtering polygon label nodes",
+        poly_nodes.run,
+        (poly_label_data, building_relation_data, map_, poly_label_nodes,
+         scratch),
+        ["filter", "auxiliary"], tt_resource,
+        inputs=[poly_label_data, building_relation_data],
+        outputs=[poly_label_nodes],
+        config=[osmfilter_dir + "building_relations_step_2.txt", tt],
+        map_keys=["tag_transform_engine"]))
     tmp_files.add(poly_label_nodes)
 
-    logging.info("\n*** Adding peak distance and saddle direction tags")
-    peak_saddle_nodes = "tmp/" + map_["name"] + "_peaks_saddles.pbf"
-    peaks_saddles.run(data_extracted, map_, peak_saddle_nodes)
+    peak_saddle_nodes = work + "_peaks_saddles.pbf"
+    stages.append(scheduler.stage(
+        "peaks_saddles", "Adding peak distance and saddle direction tags",
+        peaks_saddles.run, (peak_saddle_data, map_, peak_saddle_nodes),
+        ["filter", "auxiliary"],
+        inputs=[peak_saddle_data], outputs=[peak_saddle_nodes],
+        config=[pps_dir + "topographic_isolation_viefinderpanoramas.txt",
+                pps_dir + "saddledirection_viefinderpanoramas.100.txt"],
+        map_keys=[]))
     tmp_files.add(peak_saddle_nodes)
 
-    logging.info("\n*** Adding popcat tags to place nodes")
-    popcat_nodes = "tmp/" + map_["name"] + "_popcat_nodes.pbf"
-    places_popcat.run(data_extracted, map_, popcat_nodes)
+    popcat_nodes = work + "_popcat_nodes.pbf"
+    stages.append(scheduler.stage(
+        "popcat", "Adding popcat tags to place nodes",
+        places_popcat.run, (popcat_data, map_, popcat_nodes),
+        ["filter", "auxiliary"],
+        inputs=[popcat_data], outputs=[popcat_nodes],
+        config=[pps_dir + "PopCatFile4OAM.csv"],
+        map_keys=[]))
     tmp_files.add(popcat_nodes)
 
-    logging.info("\n*** Splitting pistes from ways and resolving piste relations")
-    piste_ways = "tmp/" + map_["name"] + "_pistes.pbf"
-    pistes.run(data_filtered, map_, piste_ways)
+    piste_ways = work + "_pistes.pbf"
+    stages.append(scheduler.stage(
+        "pistes", "Splitting pistes from ways and resolving piste relations",
+        pistes.run, (data_filtered, map_, piste_ways, scratch),
+        ["filter"], jvm,
+        inputs=[data_filtered], outputs=[piste_ways], map_keys=[]))
     tmp_files.add(piste_ways)
 
-    logging.info("\n*** Merging first set of data and performing tag-transform")
-    data_tag_transformed = "tmp/" + map_["name"] + "_tt.pbf"
+    data_tag_transformed = work + "_tt.pbf"
     file_list = [poly_label_nodes, popcat_nodes, peak_saddle_nodes,
                  data_filtered]
-    functions.merge_map_and_tt(file_list, data_tag_transformed, False)
+    stages.append(scheduler.stage(
+        "tag_transform", "Merging first set of data and performing "
+        "tag-transform",
+        tag_transform.run,
+        (file_list, data_tag_transformed, map_["tag_transform_engine"],
+         False),
+        ["poly_nodes", "popcat", "peaks_saddles", "filter", "auxiliary"],
+        tt_resource,
+        inputs=file_list, outputs=[data_tag_transformed], config=[tt],
+        map_keys=["tag_transform_engine"]))
     tmp_files.add(data_tag_transformed)
 
-    logging.info("\n*** Processing routes")
-    route_ways = "tmp/" + map_["name"] + "_route_ways.pbf"
-    routes.run(data_tag_transformed, map_, route_ways)
+    route_ways = work + "_route_ways.pbf"
+    stages.append(scheduler.stage(
+        "routes", "Processing routes",
+        routes.run, (data_tag_transformed, map_, route_ways, scratch),
+        ["tag_transform"], jvm,
+        inputs=[data_tag_transformed], outputs=[route_ways],
+        config=[osmfilter_dir + "routes_nodes_ways.txt"], map_keys=[]))
     tmp_files.add(route_ways)
 
-    logging.info("\n*** Downloading and preparing contour lines")
-    contour_ways = "tmp/"+map_["name"] + "_contour_ways.pbf"
-    contour.run(map_, contour_ways)
+    contour_ways = work + "_contour_ways.pbf"
+    stages.append(scheduler.stage(
+        "contour", "Downloading and preparing contour lines",
+        contour.run, (map_, contour_ways, scratch),
+        outputs=[contour_ways], config=[poly_file],
+        map_keys=["name", "use_polygon_shape", "contour"]))
     tmp_files.add(contour_ways)
 
     if map_["has_sea"]:
-        logging.info("\n*** Preparing land and sea")
-        land_sea_polys = "tmp/" + map_["name"] + "_land_sea.pbf"
-        land_sea.run(map_, land_sea_polys)
+        land_sea_polys = work + "_land_sea.pbf"
+        stages.append(scheduler.stage(
+            "land_sea", "Preparing land and sea",
+            land_sea.run, (map_, land_sea_polys, scratch), ["auxiliary"], jvm,
+            outputs=[land_sea_polys],
+            config=[poly_file, "templates/sea_template.osm",
+                    "tmp/land-polygons-split-4326/land_polygons.shp"],
+            map_keys=["name", "use_land_grid_split"]))
         tmp_files.add(land_sea_polys)
 
     if map_["has_crags"]:
-        logging.info("\n*** Preparing crags based on OS Open Data. On the first run, "
-              "this may take a while.")
-        crag_polys = "tmp/" + map_["name"] + "_crags.pbf"
-        crags.run("tmp/os_open_data/", map_, crag_polys)
+        crag_polys = work + "_crags.pbf"
+        stages.append(scheduler.stage(
+            "crags", "Preparing crags based on OS Open Data. On the first "
+            "run, this may take a while.",
+            crags.run, ("tmp/os_open_data/", map_, crag_polys, scratch),
+            ["auxiliary"], jvm,
+            outputs=[crag_polys], config=[poly_file],
+            map_keys=["name", "use_polygon_shape"]))
         tmp_files.add(crag_polys)
 
     # Routes and pistes are not included in input file.
     # They are checked against the 15 tag limit in their subroutines.
-    logging.info("\n*** Reducing data for mapwriter performance and checking tag limit")
-    osm_ids_to_subtract = "tmp/" + map_["name"] + "_ids_to_subtract.pbf"
-    tag_limit_ways = "tmp/" + map_["name"] + "_tag_limit.pbf"
-    reduce_data.run(data_tag_transformed, osm_ids_to_subtract, tag_limit_ways)
+    osm_ids_to_subtract = work + "_ids_to_subtract.txt"
+    tag_limit_ways = work + "_tag_limit.pbf"
+    stages.append(scheduler.stage(
+        "reduce", "Reducing data for mapwriter performance and checking tag "
+        "limit",
+        reduce_data.run,
+        (data_tag_transformed, osm_ids_to_subtract, tag_limit_ways),
+        ["tag_transform", "auxiliary"],
+        inputs=[data_tag_transformed],
+        outputs=[osm_ids_to_subtract, tag_limit_ways],
+        config=["tt_tm/tagmapping-urban.xml", "tt_tm/tagmapping-min.xml",
+                "themes/Elevate/Elevate.xml", "themes/Elevate/Elements.xml"]))
     tmp_files.update([osm_ids_to_subtract, tag_limit_ways])
 
-    # A different file sequence is necessary for osmosis / osmconvert (osmosis
-    # gives priority to the first input file, osmconvert to the last input
-    # file, if objects have the same osm id/no version
-    logging.info("\n*** Merging final map including contour lines and land/sea")
-    data_map = "tmp/" + map_["name"] + "_data_map.pbf"
-    file_list_osmconvert = [data_tag_transformed, route_ways, admin_ways,
-                            piste_ways, tag_limit_ways, map_border_ways,
-                            contour_ways]
+    # Objects with the same osm id are taken from the last input file (see
+    # merge.run)
+    data_map = work + "_data_map.pbf"
+    merge_files = [data_tag_transformed, route_ways, admin_ways,
+                   piste_ways, tag_limit_ways, map_border_ways,
+                   contour_ways]
+    merge_depends = ["tag_transform", "routes", "admin", "pistes", "reduce",
+                     "map_border", "contour"]
     if map_["has_sea"]:
-        file_list_osmconvert.append(land_sea_polys)
+        merge_files.append(land_sea_polys)
+        merge_depends.append("land_sea")
     if map_["has_crags"]:
-        file_list_osmconvert.append(crag_polys)
-    functions.merge_map_osmconvert(file_list_osmconvert, osm_ids_to_subtract,
-                                   data_map)
+        merge_files.append(crag_polys)
+        merge_depends.append("crags")
+    stages.append(scheduler.stage(
+        "merge", "Merging final map including contour lines and land/sea",
+        merge.run,
+        (merge_files, osm_ids_to_subtract, data_map, scratch),
+        merge_depends,
+        inputs=merge_files + [osm_ids_to_subtract],
+        outputs=[data_map]))
     tmp_files.add(data_map)
 
-    logging.info("\n*** Applying tag mapping and producing final map")
-    functions.start_mapwriter(data_map, map_, result_map)
+    validation_report = work + "_data_map_validation.txt"
+    stages.append(scheduler.stage(
+        "validate", "Validating final map data",
+        validate.run, (data_map, validation_report),
+        ["merge", "auxiliary"],
+        inputs=[data_map], outputs=[validation_report],
+        config=["tt_tm/tagmapping-urban.xml", "tt_tm/tagmapping-min.xml",
+                "themes/Elevate/Elevate.xml", "themes/Elevate/Elements.xml"]))
+    tmp_files.add(validation_report)
+
+    stages.append(scheduler.stage(
+        "mapwriter", "Applying tag mapping and producing final map",
+        functions.start_mapwriter, (data_map, map_, result_map),
+        ["validate"], jvm,
+        inputs=[data_map], outputs=[result_map],
+        config=[poly_file, map_["tag-mapping"]],
+        map_keys=["name", "preferred_languages", "tag-mapping",
+                  "simplification-factor", "zoom-interval-conf"]))
+
+    return stages, tmp_files, data_source
+
+
+# Create map result_map for map target map_name. args are the command line
+# options. If data_extracted is given, the area of interest was already
+# extracted from the osm source file (see run_batch()).
+def run(map_name, result_map, args, data_extracted=None):
+    start_t = time.time()
 
-    if not keep_temp:
+    map_ = map_targets.map_targets[map_name]
+
+    # read the polygon once, the stage processes inherit it
+    polygon.load("polygons/" + map_["name"] + ".poly")
+
+    # shared downloads (source files, land polygons, hgt files, ...) are
+    # stored in tmp/, intermediate results in args.work_dir
+    for d in ["tmp", args.work_dir]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    scratch = make_scratch_dir(args.scratch_dir, map_["name"])
+
+    stages, tmp_files, data_source = create_stages(
+        map_, result_map, args, scratch, data_extracted)
+
+    cache = get_cache(args)
+    build_manifest = get_manifest(map_["name"], args)
+    tmp_files.add(build_manifest.path)
+    # intermediate files are removed as soon as no stage needs them anymore
+    remove = None if args.keep_temp else tmp_files
+    try:
+        records = scheduler.run(stages, args.jobs, args.jvm_jobs, cache,
+                                build_manifest, remove)
+    finally:
+        remove_scratch_dir(scratch, args)
+
+    if cache is not None:
+        cache.evict()
+
+    if args.profile:
+        runner.write_report(profile_file(map_["name"]), map_["name"], records,
+                            time.time() - start_t)
+
+    if not args.keep_temp:
         logging.info("\n*** Removing temporary files")
         functions.remove_files(tmp_files)
 
-    if delete_source:
+    # in batch mode, source files are deleted by run_batch()
+    if args.delete_source and data_source is not None:
         logging.info("\n*** Deleting source file")
         functions.remove_files([data_source])
 
@@ -143,6 +394,95 @@ def run(map_name, result_map, use_planet, keep_temp, delete_source):
     logging.info("    Total: %s seconds" % round((time.time() - start_t), 1))
 
 
+def run_target(map_name, result_map, args, data_extracted):
+    run(map_name, result_map, args, data_extracted)
+    return map_name
+
+
+# Create maps for several map targets. Targets that use the same osm source
+# file are extracted together in a single run of osmium extract, so large
+# source files are only read once. Afterwards, the map creation for the
+# individual targets runs in parallel (up to args.batch_jobs at a time).
+def run_batch(map_names, result_dir, args):
+    start_t = time.time()
+
+    for d in ["tmp", args.work_dir, result_dir]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    scratch = make_scratch_dir(args.scratch_dir, "batch")
+
+    # group map targets by source
+    groups = {}
+    for map_name in map_names:
+        map_ = map_targets.map_targets[map_name]
+        src = functions.osm_source(map_, args.planet)[0]
+        if src not in groups:
+            groups[src] = []
+        groups[src].append(map_)
+
+    stages = []
+    sources = set()
+    extracts = {}
+    for i, src in enumerate(groups):
+        maps = groups[src]
+        data_source = functions.osm_source(maps[0], args.planet)[1]
+        sources.add(data_source)
+        stages.append(scheduler.stage(
+            "source_%d" % i, "Downloading OSM source file " + src,
+            functions.download_osm_source,
+            (maps[0], args.planet, args.update)))
+
+        # all targets of the source share one run of osmium extract (the
+        # extract engine of the target if it is a single target)
+        extracted = [extracted_file(m, args.work_dir, len(maps) > 1)
+                     for m in maps]
+        extracts.update(zip((m["name"] for m in maps), extracted))
+        names = ", ".join(m["name"] for m in maps)
+        stages.append(scheduler.stage(
+            "extract_%d" % i, "Extracting areas of interest: " + names,
+            functions.extract_target_areas,
+            (data_source, maps, extracted, scratch),
+            ["source_%d" % i],
+            inputs=[data_source], outputs=extracted,
+            config=["polygons/" + m["name"] + ".poly" for m in maps],
+            map_keys=["name", "use_polygon_shape", "extract_engine"]))
+
+    cache = get_cache(args)
+    build_manifest = get_manifest("batch_" + "_".join(map_names), args)
+    try:
+        records = scheduler.run(stages, args.jobs, args.jvm_jobs, cache,
+                                build_manifest)
+    finally:
+        remove_scratch_dir(scratch, args)
+
+    if args.profile:
+        runner.write_report(profile_file("batch"), ",".join(map_names),
+                            records, time.time() - start_t)
+
+    # Each target build uses args.jobs parallel stages on its own.
+    jobs = max(1, args.batch_jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for map_name in map_names:
+            map_ = map_targets.map_targets[map_name]
+            result_map = os.path.join(result_dir, map_name + ".map")
+            futures.append(pool.submit(run_target, map_name, result_map, args,
+                                       extracts[map_name]))
+
+        for f in concurrent.futures.as_completed(futures):
+            logging.info("\n*** Finished map target %s." % f.result())
+
+    if not args.keep_temp:
+        functions.remove_files([build_manifest.path])
+
+    if args.delete_source:
+        logging.info("\n*** Deleting source files")
+        functions.remove_files(sources)
+
+    logging.info("\n*** Finished batch.")
+    logging.info("    Total: %s seconds" % round((time.time() - start_t), 1))
+
+
 if __name__ == "__main__":
 
     name = "osm-map-generator"
@@ -154,29 +494,169 @@ if __name__ == "__main__":
                                 description=descr,
                                 epilog=epilog)
     p.add_argument("map_name",
+                   nargs="?",
                    help="Name of map to be rendered (defined in "
                    "modules/map_target.py)")
     p.add_argument("result_file",
+                   nargs="?",
                    help="Result map filename (.map-file)")
+    p.add_argument("-b",
+                   "--batch",
+                   nargs="+",
+                   metavar="MAP_NAME",
+                   help="Create maps for several map targets (instead of "
+                   "map_name / result_file). Targets with the same source "
+                   "file are extracted together. Result maps are saved as "
+                   "MAP_NAME.map in --output_dir.")
+    p.add_argument("-o",
+                   "--output_dir",
+                   default=".",
+                   help="Directory for result maps in batch mode (default: "
+                   "current directory).")
+    p.add_argument("-bj",
+                   "--batch_jobs",
+                   type=int,
+                   default=1,
+                   help="Number of map targets to create in parallel in "
+                   "batch mode (default: %(default)s).")
     p.add_argument("-p",
                    "--planet",
                    action="store_true",
                    help="Use the osm planet file hosted at gwdg as input file,"
                    "instead of the source defined in modules/map_target.py. "
                    "Download and target area extraction may take a while.")
+    p.add_argument("-u",
+                   "--update",
+                   action="store_true",
+                   help="Update existing osm source files with the "
+                   "replication diffs published since their creation "
+                   "instead of using them as they are. The replication "
+                   "server is taken from the map target setting "
+                   "\"replication\" or the source file header.")
+    p.add_argument("--stream",
+                   action="store_true",
+                   help="If the osm source file needs to be downloaded, cut "
+                   "out the bounding box of the map (plus a margin) while "
+                   "downloading, so the following extraction only reads the "
+                   "smaller pre-extract. Ways and relations are only "
+                   "complete within the margin (see README).")
     p.add_argument("-k",
                    "--keep_temp",
                    action="store_true",
                    help="Don't delete intermediate results (tag-transformed "
-                   "data, map_border, route_ways...).")
+                   "data, map_border, route_ways...). By default, they are "
+                   "deleted as soon as no stage needs them anymore.")
     p.add_argument("-ds",
                    "--delete_source",
                    action="store_true",
                    help="Delete downloaded source data (default: False).")
+    p.add_argument("-w",
+                   "--work_dir",
+                   default="tmp/",
+                   help="Directory for intermediate results of the map "
+                   "creation stages (default: %(default)s). These files can "
+                   "be large.")
+    p.add_argument("-s",
+                   "--scratch_dir",
+                   default="tmp/",
+                   help="Base directory for temporary files of the stage "
+                   "modules (default: %(default)s). Each build uses its own "
+                   "subdirectory, which is removed afterwards unless -k is "
+                   "set. E.g. a tmpfs like /dev/shm can speed up processing "
+                   "of small maps.")
+    p.add_argument("-j",
+                   "--jobs",
+                   type=int,
+                   default=governor.default_jobs(),
+                   help="Maximum number of independent stages to run in "
+                   "parallel (default: %(default)s). Use 1 to run all stages "
+                   "one after another.")
+    p.add_argument("-jj",
+                   "--jvm_jobs",
+                   type=int,
+                   default=1,
+                   help="Maximum number of osmosis based stages to run in "
+                   "parallel (default: %(default)s). The available memory "
+                   "is shared between them (unless -Xmx is set in "
+                   "JAVACMD_OPTIONS).")
+    p.add_argument("-nc",
+                   "--no_cache",
+                   action="store_true",
+                   help="Don't use cached stage results from previous runs, "
+                   "always execute all stages.")
+    p.add_argument("--cache_size",
+                   type=float,
+                   default=50,
+                   help="Maximum size of the stage cache in tmp/cache/ in GB "
+                   "(default: %(default)s). Least recently used results are "
+                   "removed first.")
+    p.add_argument("-r",
+                   "--resume",
+                   action="store_true",
+                   help="Resume an interrupted build: skip all stages that "
+                   "were completed before and whose input and output files "
+                   "are unchanged (see <work_dir>/<map_name>_manifest.json).")
+    p.add_argument("--plan",
+                   action="store_true",
+                   help="Don't create maps, only print the estimated runtime, "
+                   "memory and disk usage of all stages and the settings "
+                   "that would be used. Estimates are calibrated with the "
+                   "profiles in tmp/profiles/ (see --profile).")
+    p.add_argument("--profile",
+                   action="store_true",
+                   help="Record wall time, CPU time, peak memory and I/O of "
+                   "all stages and external tools and write a json report "
+                   "to tmp/profiles/.")
+    p.add_argument("--mirror",
+                   help="Download all files from a mirror instead of the "
+                   "original hosts, e.g. http://localhost:8000/ (a file "
+                   "https://host/path is then downloaded from "
+                   "http://localhost:8000/host/path).")
+    p.add_argument("--refresh_days",
+                   type=float,
+                   default=downloads.default_refresh_days,
+                   help="Check downloaded auxiliary sources (themes, "
+                   "tag-mapping, land polygons, ...) for updates after this "
+                   "number of days (default: %(default)s). Unchanged files "
+                   "are not downloaded again. 0 checks on every run, a "
+                   "negative value never.")
     args = p.parse_args()
 
-    if args.map_name not in map_targets.map_targets:
-        logging.error("Error: Could not find map target %s." % args.map_name)
+    if args.batch:
+        if args.map_name is not None:
+            p.error("map_name / result_file can't be used with --batch")
+        map_names = args.batch
+    else:
+        if args.result_file is None:
+            p.error("map_name and result_file are required")
+        map_names = [args.map_name]
+
+    for map_name in map_names:
+        if map_name not in map_targets.map_targets:
+            logging.error("Error: Could not find map target %s." % map_name)
+            sys.exit()
+
+    downloads.configure(args.mirror, args.refresh_days)
+
+    # all parallel builds share the memory for osmosis
+    if args.batch:
+        governor.configure(args.jvm_jobs * args.batch_jobs, args.jobs,
+                           args.batch_jobs)
+    else:
+        governor.configure(args.jvm_jobs, args.jobs)
+
+    if args.plan:
+        for map_name in map_names:
+            map_ = map_targets.map_targets[map_name]
+            scratch = scheduler.scratch_dir(args.scratch_dir)
+            stages, tmp_files, data_source = create_stages(
+                map_, map_name + ".map", args, scratch)
+            planner.plan(map_, stages, data_source,
+                         extracted_file(map_, args.work_dir), args)
+        sys.exit()
+
+    if args.batch:
+        run_batch(map_names, args.output_dir, args)
         sys.exit()
 
     # args.result_file to map name with valid extension
@@ -185,5 +665,4 @@ if __name__ == "__main__":
     else:
         result_map = args.result_file + ".map"
 
-    run(args.map_name, result_map, args.planet, args.keep_temp,
-        args.delete_source)
+    run(args.map_name, result_map, args)
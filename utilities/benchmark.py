@@ -0,0 +1,453 @@
+#!/usr/bin/python3
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import osmium
+
+# run from the repository root or from utilities/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import modules.admin_relations as admin_relations
+import modules.functions as functions
+import modules.land_sea_grid_split as land_grid_split
+import modules.merge as merge
+import modules.peaks_saddles as peaks_saddles
+import modules.pistes as pistes
+import modules.prefilter as prefilter
+import modules.reduce_data as reduce_data
+import modules.relevance as relevance
+import modules.routes_process_route_refs as routes_process_route_refs
+import modules.routes_resolve_relations as routes_resolve_relations
+import modules.routes_resolve_superroutes as routes_resolve_superroutes
+import modules.tag_transform as tag_transform
+import synthetic_osm
+
+# osm keys used for reduce_data if the tag-mapping / theme files were not
+# downloaded yet (any value is relevant)
+default_key_set = {"highway", "name", "ref", "natural", "route", "network",
+                   "piste:type", "piste:difficulty", "boundary",
+                   "admin_level", "ele", "osmc:symbol", "surface",
+                   "sac_scale", "mtb_scale", "tracktype", "access", "foot",
+                   "bicycle", "trail_visibility"}
+
+
+# Input files of a benchmark run (see prepare()).
+class fixture:
+    def __init__(self, folder, scale):
+        self.folder = folder
+        self.scale = scale
+        prefix = os.path.join(folder, "synthetic_%sx" % scale)
+        self.data = prefix + ".pbf"
+        self.land = prefix + "_land.pbf"
+        self.info = prefix + ".json"
+
+    def path(self, name):
+        return os.path.join(self.folder, "bench_%s_%sx.pbf" % (name,
+                                                              self.scale))
+
+
+def prepare(folder, scale):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    f = fixture(folder, scale)
+    if not os.path.exists(f.data) or not os.path.exists(f.info):
+        print("Creating synthetic data (scale %s)" % scale)
+        synthetic_osm.generate(f.data, scale)
+    if not os.path.exists(f.land):
+        synthetic_osm.generate_land(f.land, scale)
+    return f
+
+
+def rules():
+    tag_mappings = ["tt_tm/tagmapping-urban.xml", "tt_tm/tagmapping-min.xml"]
+    themes = ["themes/Elevate/Elevate.xml", "themes/Elevate/Elements.xml"]
+    if all(os.path.exists(f) for f in tag_mappings + themes):
+        return relevance.load(tag_mappings, themes)
+    return relevance.from_keys(default_key_set)
+
+
+# Benchmark cases. Each case returns the time of its in-process part and the
+# input file it processed. Input files created by other cases are created
+# first if necessary (not included in the time).
+def bench_reduce_data(f):
+    rs = rules()
+    out = f.path("reduce_data")
+    start = time.perf_counter()
+    with osmium.SimpleWriter(out, overwrite=True) as writer:
+        cd = reduce_data.collect_data_and_limit_tags(reduce_data.threshold,
+                                                     writer, rs)
+        cd.apply_file(f.data)
+    return time.perf_counter() - start, f.data
+
+
+def bench_routes_superroutes(f):
+    out = f.path("routes_superroutes")
+    remove(out)
+    start = time.perf_counter()
+    routes_resolve_superroutes.run(f.data, out)
+    return time.perf_counter() - start, f.data
+
+
+def bench_routes_refs(f):
+    file_in = f.path("routes_superroutes")
+    if not os.path.exists(file_in):
+        bench_routes_superroutes(f)
+    out = f.path("routes_refs")
+    remove(out)
+    start = time.perf_counter()
+    routes_process_route_refs.run(file_in, out)
+    return time.perf_counter() - start, file_in
+
+
+def bench_routes_relations(f):
+    file_in = f.path("routes_refs")
+    if not os.path.exists(file_in):
+        bench_routes_refs(f)
+    out = f.path("routes_relations")
+    remove(out)
+    start = time.perf_counter()
+    routes_resolve_relations.run(file_in, out)
+    return time.perf_counter() - start, file_in
+
+
+def bench_pistes(f):
+    out = f.path("pistes")
+    start = time.perf_counter()
+    cpr = pistes.Collect_Piste_Rels()
+    cpr.apply_file(f.data)
+    with osmium.SimpleWriter(out, overwrite=True) as writer:
+        ppw = pistes.Process_Piste_Ways(cpr.way_rels, writer)
+        ppw.apply_file(f.data)
+    return time.perf_counter() - start, f.data
+
+
+def bench_admin_relations(f):
+    out = f.path("admin_relations")
+    start = time.perf_counter()
+    carw = admin_relations.collect_admin_relation_ways()
+    carw.apply_file(f.data)
+    with osmium.SimpleWriter(out, overwrite=True) as writer:
+        pw = admin_relations.process_ways(carw.all_ways, writer)
+        pw.apply_file(f.data)
+    return time.perf_counter() - start, f.data
+
+
+def bench_land_grid_split(f):
+    out = f.path("land_grid_split")
+    start = time.perf_counter()
+    land_grid_split.run(f.land, out)
+    return time.perf_counter() - start, f.land
+
+
+def bench_peaks_saddles(f):
+    with open(f.info) as fi:
+        info = json.load(fi)
+
+    # every second peak / saddle has data (ID;LON;LAT;dominance|direction)
+    peaks = [(str(i), str(lon), str(lat), str(j * 100))
+             for j, (i, lon, lat) in enumerate(info["peaks"][::2])]
+    saddles = [(str(i), str(lon), str(lat), str(j % 360))
+               for j, (i, lon, lat) in enumerate(info["saddles"][::2])]
+
+    out = f.path("peaks_saddles")
+    start = time.perf_counter()
+    with osmium.SimpleWriter(out, overwrite=True) as writer:
+        pps = peaks_saddles.process_peaks_saddles(writer, list(zip(*peaks)),
+                                                  list(zip(*saddles)))
+        pps.apply_file(f.data)
+    return time.perf_counter() - start, f.data
+
+
+# Pre-filter stage: tag filter and the selections of the polygon label,
+# building, peak/saddle and popcat stages in one run, by pyosmium or osmfilter
+# (see map target key "filter_engine").
+def bench_prefilter(f, engine):
+    names = ["tags_filter_data", "poly_labels", "building_relations_step_1",
+             "peaks_saddles", "popcat_nodes"]
+    params = ["osmfilter_parameters/%s.txt" % n for n in names]
+    outputs = [f.path("prefilter_%s_%s" % (engine, n)) for n in names]
+    start = time.perf_counter()
+    prefilter.run(f.data, params, outputs, engine, f.folder)
+    return time.perf_counter() - start, f.data
+
+
+# Tag-transform of the synthetic data with the pyosmium engine, needs the
+# downloaded tag-transform file (tt_tm/tt_andromaps.xml).
+def bench_tag_transform(f):
+    out = f.path("tag_transform")
+    start = time.perf_counter()
+    tag_transform.transform_files([f.data], out, tag_transform.tt_file)
+    return time.perf_counter() - start, f.data
+
+
+# Extraction of the synthetic data with the polygon of a map target (Alps,
+# Italy), by osmconvert or osmium extract (see map target key
+# "extract_engine").
+def bench_extract(f, map_name, engine):
+    map_ = {"name": map_name, "use_polygon_shape": True,
+            "extract_engine": engine}
+    out = f.path("extract_%s_%s" % (engine, map_name.lower()))
+    remove(out)
+    start = time.perf_counter()
+    functions.extract_target_area(f.data, map_, out, f.folder)
+    return time.perf_counter() - start, f.data
+
+
+# Final merge of the synthetic data and land polygons by osmconvert,
+# subtracting every fourth way and relation of the data (id list like
+# reduce_data).
+def bench_merge(f):
+    subtract = os.path.join(f.folder, "bench_merge_subtract_%sx.txt" % f.scale)
+    if not os.path.exists(subtract):
+        ways = []
+        relations = []
+        for o in osmium.FileProcessor(f.data, osmium.osm.WAY |
+                                      osmium.osm.RELATION):
+            if o.id % 4 == 0:
+                (ways if o.is_way() else relations).append(o.id)
+        reduce_data.write_ids(subtract, ways, relations)
+    out = f.path("merge")
+    start = time.perf_counter()
+    merge.run([f.data, f.land], subtract, out, f.folder)
+    return time.perf_counter() - start, f.data
+
+
+cases = {
+    "reduce_data": bench_reduce_data,
+    "routes_superroutes": bench_routes_superroutes,
+    "routes_refs": bench_routes_refs,
+    "routes_relations": bench_routes_relations,
+    "pistes": bench_pistes,
+    "admin_relations": bench_admin_relations,
+    "land_grid_split": bench_land_grid_split,
+    "peaks_saddles": bench_peaks_saddles,
+    "prefilter_pyosmium": lambda f: bench_prefilter(f, "pyosmium"),
+    "prefilter_osmfilter": lambda f: bench_prefilter(f, "osmfilter"),
+    "tag_transform": bench_tag_transform,
+    "merge": bench_merge,
+    "extract_osmconvert_alps":
+        lambda f: bench_extract(f, "Alps", "osmconvert"),
+    "extract_osmium_alps":
+        lambda f: bench_extract(f, "Alps", "osmium"),
+    "extract_osmconvert_italy":
+        lambda f: bench_extract(f, "Italy", "osmconvert"),
+    "extract_osmium_italy":
+        lambda f: bench_extract(f, "Italy", "osmium"),
+}
+
+
+def remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class count_objects(osmium.SimpleHandler):
+    def __init__(self):
+        osmium.SimpleHandler.__init__(self)
+        self.count = 0
+
+    def node(self, n):
+        self.count += 1
+
+    def way(self, w):
+        self.count += 1
+
+    def relation(self, r):
+        self.count += 1
+
+
+# Run a single case in the current process and send time, number of input
+# objects and peak memory to conn. Peak memory is the larger one of the case
+# process and the external commands it started (e.g. osmconvert).
+def run_case(name, f, conn):
+    seconds, file_in = cases[name](f)
+    co = count_objects()
+    co.apply_file(file_in)
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    conn.send((seconds, co.count, peak))
+    conn.close()
+
+
+# Run each case repeat times, every time in a new process so peak memory is
+# measured per case. Returns the fastest time and largest peak memory.
+# Processes are spawned, a forked process would start with the peak memory of
+# the parent.
+def run(names, f, repeat):
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for name in names:
+        times = []
+        peaks = []
+        for i in range(repeat):
+            parent, child = ctx.Pipe()
+            p = ctx.Process(target=run_case,
+                            args=(name, f, child))
+            p.start()
+            p.join()
+            if not parent.poll():
+                break
+            seconds, objects, peak = parent.recv()
+            times.append(seconds)
+            peaks.append(peak)
+
+        if not times:
+            print("    %-24s failed (exit code %s)" % (name, p.exitcode),
+                  flush=True)
+            continue
+
+        seconds = min(times)
+        results[name] = {
+            "seconds": round(seconds, 4),
+            "objects": objects,
+            "objects_per_second": round(objects / seconds) if seconds else 0,
+            "peak_memory_mb": round(max(peaks) / 1024, 1),
+        }
+        print("    %-24s %8.3f s %10d obj/s %8.1f MB"
+              % (name, seconds, results[name]["objects_per_second"],
+                 results[name]["peak_memory_mb"]), flush=True)
+    return results
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# Compare results with the baseline. Returns a list of report rows and the
+# number of regressions (time or memory increased by more than threshold).
+def compare(results, baseline, scale, threshold):
+    rows = []
+    regressions = 0
+    base = baseline.get(str(scale), {})
+    for name, r in results.items():
+        b = base.get(name)
+        if b is None:
+            rows.append([name, r["seconds"], "", "", r["peak_memory_mb"], "",
+                         "", "no baseline"])
+            continue
+
+        d_time = r["seconds"] / b["seconds"] - 1 if b["seconds"] else 0
+        d_mem = (r["peak_memory_mb"] / b["peak_memory_mb"] - 1
+                 if b["peak_memory_mb"] else 0)
+        status = []
+        if d_time > threshold:
+            status.append("TIME REGRESSION")
+        if d_mem > threshold:
+            status.append("MEMORY REGRESSION")
+        if d_time < -threshold:
+            status.append("faster")
+        regressions += d_time > threshold or d_mem > threshold
+        rows.append([name, r["seconds"], b["seconds"],
+                     "%+.1f %%" % (100 * d_time), r["peak_memory_mb"],
+                     b["peak_memory_mb"], "%+.1f %%" % (100 * d_mem),
+                     ", ".join(status) or "ok"])
+    return rows, regressions
+
+
+def print_report(rows):
+    header = ["case", "time", "baseline", "change", "memory", "baseline",
+              "change", "status"]
+    print("\n*** Comparison with baseline")
+    print("    %-24s %9s %9s %9s %9s %9s %9s  %s" % tuple(header))
+    for row in rows:
+        print("    %-24s %9s %9s %9s %9s %9s %9s  %s" % tuple(row))
+
+
+if __name__ == "__main__":
+
+    name = "Benchmark"
+    descr = ("Script to benchmark the in-process part of the stage modules "
+             "with synthetic osm data and compare the results with a stored "
+             "baseline.")
+    epilog = "https://github.com/marfrh/osm-map-generator"
+
+    p = argparse.ArgumentParser(prog=name, description=descr, epilog=epilog)
+    p.add_argument("-s",
+                   "--scale",
+                   type=float,
+                   nargs="+",
+                   default=[1],
+                   help="Scale(s) of the synthetic data, e.g. 1 10 100 "
+                   "(default: 1).")
+    p.add_argument("-c",
+                   "--cases",
+                   nargs="+",
+                   choices=list(cases),
+                   default=list(cases),
+                   help="Cases to run (default: all).")
+    p.add_argument("-r",
+                   "--repeat",
+                   type=int,
+                   default=3,
+                   help="Number of runs per case, the fastest one counts "
+                   "(default: %(default)s).")
+    p.add_argument("-d",
+                   "--data_dir",
+                   default="tmp/benchmark/",
+                   help="Directory for synthetic data and results (default: "
+                   "%(default)s).")
+    p.add_argument("-b",
+                   "--baseline",
+                   default="tmp/benchmark/baseline.json",
+                   help="Baseline file (default: %(default)s).")
+    p.add_argument("--save_baseline",
+                   action="store_true",
+                   help="Store the results as new baseline.")
+    p.add_argument("-t",
+                   "--threshold",
+                   type=float,
+                   default=0.1,
+                   help="Relative increase of time or memory reported as "
+                   "regression (default: %(default)s).")
+    p.add_argument("--csv",
+                   help="Additionally write the comparison to a csv file.")
+    args = p.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    all_rows = []
+    regressions = 0
+    for scale in args.scale:
+        scale = int(scale) if scale == int(scale) else scale
+        print("\n*** Scale %sx" % scale)
+        f = prepare(args.data_dir, scale)
+        results = run(args.cases, f, args.repeat)
+
+        rows, n = compare(results, baseline, scale, args.threshold)
+        all_rows += [[str(scale) + "x"] + row for row in rows]
+        regressions += n
+        print_report(rows)
+
+        if args.save_baseline:
+            baseline.setdefault(str(scale), {}).update(results)
+
+    if args.save_baseline:
+        folder = os.path.dirname(args.baseline)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print("\nBaseline saved to %s" % args.baseline)
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["scale", "case", "time", "baseline_time",
+                             "time_change", "memory", "baseline_memory",
+                             "memory_change", "status"])
+            writer.writerows(all_rows)
+
+    if regressions:
+        print("\n%d regression(s) found." % regressions)
+        sys.exit(1)
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import sys
+import time
+
+import osmium
+
+# run from the repository root or from utilities/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import modules.functions as functions
+import modules.merge as merge
+import modules.tag_transform as tag_transform
+import synthetic_osm
+
+# Tag-transform file of the repository that uses all elements supported by
+# the pyosmium engine
+sample_tt_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "compare_tag_transform.xml")
+
+
+# Key of an object for the comparison, files are sorted by type and id.
+def object_key(o):
+    return merge.type_order[o.type_str()], o.id
+
+
+# Compare the tags of the objects of file_a and file_b. Returns the number
+# of compared objects and a list of differences (type, id, tags a, tags b),
+# tags are None if the object is missing in a file.
+def compare(file_a, file_b):
+    a = iter(osmium.FileProcessor(file_a))
+    b = iter(osmium.FileProcessor(file_b))
+    oa = next(a, None)
+    ob = next(b, None)
+    count = 0
+    differences = []
+    while oa is not None or ob is not None:
+        count += 1
+        if ob is None or (oa is not None and object_key(oa) < object_key(ob)):
+            differences.append((oa.type_str(), oa.id, dict(oa.tags), None))
+            oa = next(a, None)
+        elif oa is None or object_key(ob) < object_key(oa):
+            differences.append((ob.type_str(), ob.id, None, dict(ob.tags)))
+            ob = next(b, None)
+        else:
+            tags_a = dict(oa.tags)
+            tags_b = dict(ob.tags)
+            if tags_a != tags_b:
+                differences.append((oa.type_str(), oa.id, tags_a, tags_b))
+            oa = next(a, None)
+            ob = next(b, None)
+    return count, differences
+
+
+# Compare both engines for the tag-transform file tt_path. If they produce
+# the same tags, tt_path is recorded as verified (see
+# tag_transform.select_engine()).
+def run(file_list, tt_path, tmp_dir, limit):
+    if not os.path.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+    out_osmosis = os.path.join(tmp_dir, "compare_tt_osmosis.pbf")
+    out_pyosmium = os.path.join(tmp_dir, "compare_tt_pyosmium.pbf")
+
+    print("Tag-transform %s with %s and osmosis."
+          % (", ".join(file_list), tt_path))
+    start = time.time()
+    functions.merge_map_and_tt(file_list, out_osmosis, True, tt_path)
+    time_osmosis = time.time() - start
+
+    print("Tag-transform %s with %s and pyosmium."
+          % (", ".join(file_list), tt_path))
+    start = time.time()
+    tag_transform.transform_files(file_list, out_pyosmium, tt_path)
+    time_pyosmium = time.time() - start
+
+    count, differences = compare(out_osmosis, out_pyosmium)
+    print("osmosis: %.1f s, pyosmium: %.1f s" % (time_osmosis,
+                                                 time_pyosmium))
+    print("%d objects compared, %d differences" % (count, len(differences)))
+    for t, oid, tags_osmosis, tags_pyosmium in differences[:limit]:
+        print("%s%d" % (t, oid))
+        print("    osmosis:  %s" % tags_osmosis)
+        print("    pyosmium: %s" % tags_pyosmium)
+    if not differences:
+        tag_transform.set_verified(tt_path)
+    return len(differences)
+
+
+if __name__ == "__main__":
+
+    name = "Compare tag-transform"
+    descr = ("Script to compare the tags produced by the osmosis and the "
+             "pyosmium tag-transform engine for the same input files.")
+    epilog = "https://github.com/marfrh/osm-map-generator"
+
+    p = argparse.ArgumentParser(prog=name, description=descr, epilog=epilog)
+    p.add_argument("file_list",
+                   nargs="*",
+                   help="Input files (sorted osm, pbf), merged like in the "
+                   "tag_transform stage (default: synthetic data, see "
+                   "synthetic_osm.py).")
+    p.add_argument("-f",
+                   "--tt_files",
+                   nargs="+",
+                   help="Tag-transform files (default: %s and, if "
+                   "downloaded, %s)." % (os.path.relpath(sample_tt_file),
+                                         tag_transform.tt_file))
+    p.add_argument("-s",
+                   "--scale",
+                   type=float,
+                   default=1,
+                   help="Scale of the synthetic data (default: "
+                   "%(default)s).")
+    p.add_argument("-t",
+                   "--tmp_dir",
+                   default="tmp/compare_tt/",
+                   help="Directory for the results of both engines "
+                   "(default: %(default)s).")
+    p.add_argument("-l",
+                   "--limit",
+                   type=int,
+                   default=20,
+                   help="Number of differences to print (default: "
+                   "%(default)s).")
+    args = p.parse_args()
+
+    file_list = args.file_list
+    if not file_list:
+        data = os.path.join(args.tmp_dir, "synthetic_%sx.pbf" % args.scale)
+        if not os.path.exists(data):
+            if not os.path.isdir(args.tmp_dir):
+                os.makedirs(args.tmp_dir)
+            synthetic_osm.generate(data, args.scale)
+        file_list = [data]
+
+    tt_files = args.tt_files
+    if tt_files is None:
+        tt_files = [sample_tt_file]
+        if os.path.exists(tag_transform.tt_file):
+            tt_files.append(tag_transform.tt_file)
+
+    failed = 0
+    for tt_path in tt_files:
+        failed += run(file_list, tt_path, args.tmp_dir, args.limit)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import math
+import os
+import random
+
+import osmium
+
+# Number of objects of each kind at scale 1
+base_counts = {
+    "highways": 2000,
+    "routes": 200,
+    "superroutes": 20,
+    "networks": 4,
+    "piste_ways": 100,
+    "piste_relations": 30,
+    "admin_relations": 20,
+    "coastlines": 5,
+    "peaks": 500,
+    "saddles": 100,
+    "land_polygons": 10,
+}
+
+# Area of the synthetic data
+min_lon = 10.0
+min_lat = 46.0
+size = 1.0
+
+# Relevant and irrelevant tags (see reduce_data.py) for synthetic ways
+highway_values = ["path", "track", "footway", "residential", "unclassified"]
+extra_tags = ["surface", "foot", "bicycle", "access", "mtb_scale",
+              "sac_scale", "trail_visibility", "incline", "width", "smoothness",
+              "tracktype", "lit", "oneway", "maxspeed", "source", "note",
+              "fixme", "description"]
+networks = {"hiking": ["lwn", "rwn", "nwn", "iwn"],
+            "bicycle": ["lcn", "rcn", "ncn", "icn"],
+            "mtb": ["lmn", "rmn", "nmn", "imn"]}
+piste_types = ["downhill", "nordic", "skitour", "sled"]
+piste_difficulties = ["novice", "easy", "intermediate", "advanced", "expert"]
+
+
+# Collects all objects in memory, so they can be written osm-sorted (nodes,
+# ways, relations) at the end.
+class osm_data:
+    def __init__(self, seed):
+        self.rnd = random.Random(seed)
+        self.nodes = []
+        self.ways = []
+        self.relations = []
+        self.peaks = []
+        self.saddles = []
+
+    def add_node(self, lon, lat, tags={}):
+        self.nodes.append((lon, lat, tags))
+        return len(self.nodes)
+
+    def add_way(self, refs, tags):
+        self.ways.append((refs, tags))
+        return len(self.ways)
+
+    def add_relation(self, members, tags):
+        self.relations.append((members, tags))
+        return len(self.relations)
+
+    def random_point(self):
+        return (min_lon + self.rnd.random() * size,
+                min_lat + self.rnd.random() * size)
+
+    # Random walk of count nodes starting at a random point.
+    def add_line(self, count, step=0.0005):
+        lon, lat = self.random_point()
+        refs = []
+        for i in range(count):
+            lon += self.rnd.uniform(-step, step)
+            lat += self.rnd.uniform(-step, step)
+            refs.append(self.add_node(lon, lat))
+        return refs
+
+    # Closed polygon with count nodes around a random center. Counter-clockwise
+    # like osm coastlines around islands, clockwise like the outer rings of
+    # shapefile polygons.
+    def add_ring(self, count, radius, clockwise=False):
+        c_lon, c_lat = self.random_point()
+        direction = -1 if clockwise else 1
+        refs = []
+        for i in range(count):
+            angle = direction * 2 * math.pi * i / count
+            r = radius * self.rnd.uniform(0.8, 1.2)
+            refs.append(self.add_node(c_lon + r * math.cos(angle),
+                                      c_lat + r * math.sin(angle)))
+        refs.append(refs[0])
+        return refs
+
+
+def counts_for_scale(scale):
+    return {k: max(1, int(v * scale)) for k, v in base_counts.items()}
+
+
+def add_highways(data, count):
+    highways = []
+    for i in range(count):
+        tags = {"highway": data.rnd.choice(highway_values)}
+        r = data.rnd.random()
+        if r < 0.05:
+            # exceeds the mapsforge tag limit
+            for k in extra_tags:
+                tags[k] = "yes"
+            tags["name"] = "Way %d" % i
+            tags["ref"] = str(i)
+        elif r < 0.15:
+            # no relevant tags
+            tags = {"source": "survey", "note": "synthetic"}
+        elif r < 0.5:
+            tags["name"] = "Way %d" % i
+        highways.append(data.add_way(data.add_line(data.rnd.randint(5, 15)),
+                                     tags))
+    return highways
+
+
+# Route relations, superroutes of routes and network relations of
+# superroutes (three level hierarchy).
+def add_routes(data, highways, counts):
+    routes = []
+    for i in range(counts["routes"]):
+        route = data.rnd.choice(list(networks))
+        network = data.rnd.choice(networks[route])
+        members = [("w", w, "") for w in
+                   data.rnd.sample(highways, data.rnd.randint(5, 20))]
+        tags = {"type": "route", "route": route, "network": network,
+                "ref": "R%d" % i, "name": "Route %d" % i}
+        if route == "hiking":
+            tags["osmc:symbol"] = "red:white:red_bar"
+        routes.append((data.add_relation(members, tags), route, network))
+
+    superroutes = []
+    for i in range(counts["superroutes"]):
+        parts = data.rnd.sample(routes, data.rnd.randint(3, 10))
+        route, network = parts[0][1], parts[0][2]
+        members = [("r", r[0], "") for r in parts]
+        tags = {"type": "superroute", "route": route, "network": network,
+                "ref": "S%d" % i, "name": "Superroute %d" % i}
+        superroutes.append(data.add_relation(members, tags))
+
+    for i in range(counts["networks"]):
+        members = [("r", r, "") for r in
+                   data.rnd.sample(superroutes,
+                                   min(len(superroutes), 5))]
+        tags = {"type": "network", "network": "rwn",
+                "name": "Network %d" % i}
+        data.add_relation(members, tags)
+
+
+def add_pistes(data, highways, counts):
+    piste_ways = []
+    for i in range(counts["piste_ways"]):
+        tags = {"piste:type": data.rnd.choice(piste_types),
+                "piste:difficulty": data.rnd.choice(piste_difficulties)}
+        if data.rnd.random() < 0.3:
+            tags["piste:grooming"] = "classic"
+            tags["piste:oneway"] = "yes"
+        piste_ways.append(data.add_way(data.add_line(8), tags))
+
+    for i in range(counts["piste_relations"]):
+        ways = data.rnd.sample(piste_ways, 3) + data.rnd.sample(highways, 2)
+        tags = {"type": "route", "route": "piste",
+                "piste:type": data.rnd.choice(piste_types),
+                "piste:difficulty": data.rnd.choice(piste_difficulties),
+                "piste:name": "Piste %d" % i, "piste:ref": str(i)}
+        data.add_relation([("w", w, "") for w in ways], tags)
+
+
+# Admin boundaries, neighbouring levels share some of their ways.
+def add_admin_boundaries(data, counts):
+    shared = []
+    for i in range(counts["admin_relations"]):
+        ways = [data.add_way(data.add_line(50, 0.002),
+                             {"boundary": "administrative"})
+                for j in range(4)]
+        if shared:
+            ways += data.rnd.sample(shared, min(2, len(shared)))
+        shared = ways
+        tags = {"type": "boundary", "boundary": "administrative",
+                "admin_level": str(2 + i % 7), "name": "Admin %d" % i}
+        data.add_relation([("w", w, "outer") for w in ways], tags)
+
+
+def add_coastlines(data, counts):
+    for i in range(counts["coastlines"]):
+        data.add_way(data.add_ring(2000, 0.05), {"natural": "coastline"})
+
+
+def add_peaks(data, counts):
+    for i in range(counts["peaks"]):
+        lon, lat = data.random_point()
+        tags = {"natural": "peak", "ele": str(data.rnd.randint(500, 4000)),
+                "name": "Peak %d" % i}
+        data.peaks.append((data.add_node(lon, lat, tags), lon, lat))
+    for i in range(counts["saddles"]):
+        lon, lat = data.random_point()
+        tags = {"natural": "saddle", "ele": str(data.rnd.randint(500, 3000))}
+        data.saddles.append((data.add_node(lon, lat, tags), lon, lat))
+
+
+def write(data, file_out):
+    if os.path.exists(file_out):
+        os.remove(file_out)
+
+    with osmium.SimpleWriter(file_out) as writer:
+        for i, (lon, lat, tags) in enumerate(data.nodes, 1):
+            writer.add_node(osmium.osm.mutable.Node(
+                id=i, location=(lon, lat), tags=tags, version=1))
+        for i, (refs, tags) in enumerate(data.ways, 1):
+            writer.add_way(osmium.osm.mutable.Way(
+                id=i, nodes=refs, tags=tags, version=1))
+        for i, (members, tags) in enumerate(data.relations, 1):
+            writer.add_relation(osmium.osm.mutable.Relation(
+                id=i, members=members, tags=tags, version=1))
+
+
+# Create a synthetic osm file with highways, route hierarchies, pistes, admin
+# boundaries, coastlines and peaks. The number of objects is multiplied by
+# scale. Object counts and the ids of peaks and saddles are saved in a json
+# file next to file_out.
+def generate(file_out, scale=1, seed=1):
+    counts = counts_for_scale(scale)
+    data = osm_data(seed)
+
+    highways = add_highways(data, counts["highways"])
+    add_routes(data, highways, counts)
+    add_pistes(data, highways, counts)
+    add_admin_boundaries(data, counts)
+    add_coastlines(data, counts)
+    add_peaks(data, counts)
+    write(data, file_out)
+
+    info = {
+        "scale": scale,
+        "nodes": len(data.nodes),
+        "ways": len(data.ways),
+        "relations": len(data.relations),
+        "objects": len(data.nodes) + len(data.ways) + len(data.relations),
+        "peaks": data.peaks,
+        "saddles": data.saddles,
+    }
+    with open(os.path.splitext(file_out)[0] + ".json", "w") as f:
+        json.dump(info, f)
+    return info
+
+
+# Create a land polygon file like esri_shp_to_osm.py does: the nodes of each
+# polygon are written right before the polygon way (not osm-sorted) and the
+# polygons are clockwise, as expected by land_sea_grid_split.py.
+def generate_land(file_out, scale=1, seed=1):
+    counts = counts_for_scale(scale)
+    data = osm_data(seed)
+
+    if os.path.exists(file_out):
+        os.remove(file_out)
+
+    objects = 0
+    with osmium.SimpleWriter(file_out) as writer:
+        for i in range(counts["land_polygons"]):
+            first = len(data.nodes) + 1
+            refs = data.add_ring(data.rnd.randint(600, 3000), 0.1,
+                                 clockwise=True)
+            for n in range(first, len(data.nodes) + 1):
+                lon, lat, tags = data.nodes[n - 1]
+                writer.add_node(osmium.osm.mutable.Node(
+                    id=n, location=(lon, lat), tags={}, version=1))
+            writer.add_way(osmium.osm.mutable.Way(
+                id=i + 1, nodes=refs, tags={"natural": "nosea"}, version=1))
+            objects += len(refs)
+
+    return {"scale": scale, "objects": objects}
+
+
+if __name__ == "__main__":
+
+    name = "Synthetic OSM"
+    descr = ("Script to create synthetic osm data (routes, pistes, admin "
+             "boundaries, coastlines, peaks) for benchmarks.")
+    epilog = "https://github.com/marfrh/osm-map-generator"
+
+    p = argparse.ArgumentParser(prog=name, description=descr, epilog=epilog)
+    p.add_argument("file_out",
+                   help="Output file (osm, pbf)")
+    p.add_argument("-s",
+                   "--scale",
+                   type=float,
+                   default=1,
+                   help="Multiply the number of objects by scale (default: "
+                   "%(default)s).")
+    p.add_argument("-l",
+                   "--land",
+                   help="Additionally create a land polygon file for "
+                   "land_sea_grid_split.py.")
+    p.add_argument("--seed",
+                   type=int,
+                   default=1,
+                   help="Random seed (default: %(default)s).")
+    args = p.parse_args()
+
+    info = generate(args.file_out, args.scale, args.seed)
+    print("%d nodes, %d ways, %d relations written to %s"
+          % (info["nodes"], info["ways"], info["relations"], args.file_out))
+
+    if args.land:
+        info = generate_land(args.land, args.scale, args.seed)
+        print("%d land polygon nodes written to %s"
+              % (info["objects"], args.land))